@@ -0,0 +1,112 @@
+"""
+Cold start cost of each lambda: the time to import its main module (the
+Lambda init phase) in a fresh interpreter, as lambda_runtime.report_cold_start
+logs it as init_ms. Pass --ref to measure a git revision as well, e.g. the
+commit before clients were built lazily.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_cold_start --runs 5 --ref HEAD~1
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+lambdas = [
+    "crawler-govuk-reference-content",
+    "email-forwarder",
+    "hackerone-zendesk-integration",
+    "zendesk_backup",
+]
+
+env = {
+    "AWS_DEFAULT_REGION": "eu-west-2",
+    "S3_PROCESSED_BUCKET": "benchmark",
+    "HACKERONE_API_USER": "benchmark",
+    "HACKERONE_API_PASS": "benchmark",
+    "ZENDESK_API_KEY": "benchmark",
+    "ZENDESK_API_EMAIL": "api@example.gov.uk",
+    "ZENDESK_SUBDOMAIN": "example",
+    "ZENDESK_EMAIL": "vm@example.gov.uk",
+}
+
+# imported the way the Lambda runtime does it: the package contents (the
+# lambda's own files plus lambda_runtime.py) on sys.path, then `import main`
+import_script = """
+import sys, time
+sys.path[:0] = {paths!r}
+start = time.perf_counter()
+import main
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def import_ms(tree: str, name: str) -> float:
+    paths = [os.path.join(tree, "lambda_", name), os.path.join(tree, "lambda_", "shared")]
+    out = subprocess.run(
+        [sys.executable, "-c", import_script.format(paths=paths)],
+        cwd=tempfile.gettempdir(),
+        env={**os.environ, **env},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def checkout(ref: str, path: str):
+    archive = subprocess.run(
+        ["git", "archive", "--format=tar", ref, "lambda_"],
+        cwd=repo_path,
+        capture_output=True,
+        check=True,
+    )
+    archive_path = os.path.join(path, "tree.tar")
+    with open(archive_path, "wb") as f:
+        f.write(archive.stdout)
+    with tarfile.open(archive_path) as tar:
+        tar.extractall(path)
+
+
+def measure(tree: str, runs: int) -> dict:
+    return {
+        name: statistics.median(import_ms(tree, name) for _ in range(runs))
+        for name in lambdas
+        if os.path.exists(os.path.join(tree, "lambda_", name, "main.py"))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--ref", help="git revision to compare against")
+    args = parser.parse_args()
+
+    results = {"working tree": measure(repo_path, args.runs)}
+    if args.ref:
+        path = tempfile.mkdtemp()
+        try:
+            checkout(args.ref, path)
+            results[args.ref] = measure(path, args.runs)
+        finally:
+            shutil.rmtree(path)
+
+    print(f"median import time of main over {args.runs} fresh interpreters")
+    print(f"{'lambda':>32}" + "".join(f"  {x:>14}" for x in results))
+    for name in lambdas:
+        row = [results[x].get(name, None) for x in results]
+        print(
+            f"{name:>32}"
+            + "".join(f"  {x:>12.1f}ms" if x is not None else f"  {'-':>14}" for x in row)
+        )
+
+
+if __name__ == "__main__":
+    main()
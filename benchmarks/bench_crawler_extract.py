@@ -0,0 +1,156 @@
+"""
+Compare the single-pass crawler entity extractor against the previous
+extract_emails()/extract_domain() implementation over synthetic organisation
+documents shaped like the gov.uk organisations and content API responses.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_crawler_extract --organisations 1200
+"""
+import argparse
+import os
+import random
+import re
+import time
+
+os.environ.setdefault("S3_PROCESSED_BUCKET", "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+
+from tests import load_lambda_module  # noqa: E402
+
+crawler = load_lambda_module("crawler-govuk-reference-content")
+
+
+def legacy_extract_emails(obj: dict):
+    res = []
+    for item in obj.values():
+        if type(item) == dict:
+            res.extend(legacy_extract_emails(item))
+        if type(item) == str:
+            if "@" in item:
+                email_search = re.finditer(
+                    r"[\w\-\'\.]+@[\w\-\.]+\.\w+",
+                    item,
+                    re.IGNORECASE | re.MULTILINE,
+                )
+                for email_result in email_search:
+                    email = email_result.group(0).lower()
+                    if email not in res:
+                        res.append(email)
+    return list(set(res))
+
+
+def legacy_extract_domain(text: str):
+    res = []
+    domain_search = re.finditer(
+        r"(@|://)(?P<domain>[\w\-\.]+\.\w+)", text, re.IGNORECASE | re.MULTILINE
+    )
+    for domain_result in domain_search:
+        domain = domain_result.groupdict().get("domain", None)
+        if domain:
+            domain = domain.lower()
+            if domain.startswith("www."):
+                res.append(domain[4:])
+            else:
+                res.append(domain)
+    return res
+
+
+def legacy_extract(obj: dict):
+    emails = legacy_extract_emails(obj)
+    domains = []
+    for email in emails:
+        domains.extend(legacy_extract_domain(email))
+    return emails, list(set(domains))
+
+
+def generate_organisation(n: int, rng: random.Random) -> dict:
+    slug = f"organisation-{n}"
+    domain = f"{slug}.gov.uk"
+    paragraph = " ".join(rng.choice(["the", "department", "public", "service", "policy", "data"]) for _ in range(60))
+    return {
+        "id": f"https://www.gov.uk/api/organisations/{slug}",
+        "title": f"Organisation {n}",
+        "format": "Executive agency",
+        "updated_at": "2024-03-15T15:50:18.000+00:00",
+        "web_url": f"https://www.gov.uk/government/organisations/{slug}",
+        "details": {
+            "slug": slug,
+            "abbreviation": f"ORG{n}",
+            "govuk_status": "live",
+            "content_id": f"00000000-0000-0000-0000-{n:012d}",
+        },
+        "parent_organisations": [{"id": f"https://www.gov.uk/api/organisations/parent-{n % 25}"}],
+        "child_organisations": [],
+        "content": {
+            "description": paragraph,
+            "details": {
+                "body": f"{paragraph} Contact enquiries@{domain} for help. {paragraph}",
+                "social_media_links": [
+                    {"href": f"https://www.{domain}", "service_type": "website"},
+                    {"href": f"https://twitter.com/{slug}", "service_type": "twitter"},
+                ],
+                "ordered_featured_documents": [
+                    {"title": f"Document {d}", "summary": paragraph} for d in range(6)
+                ],
+                "contacts": [
+                    {
+                        "title": f"Team {c}",
+                        "email_addresses": [{"email": f"team{c}@{domain}"}, {"email": f"foi@{domain}"}],
+                        "description": f"Press office: press@{domain}. {paragraph}",
+                    }
+                    for c in range(8)
+                ],
+            },
+        },
+    }
+
+
+def lists_as_dicts(obj):
+    """
+    The legacy extractor never descends into lists, so give it the same
+    strings keyed by index to make the comparison like-for-like.
+    """
+    if type(obj) == list:
+        return {str(i): lists_as_dicts(v) for i, v in enumerate(obj)}
+    if type(obj) == dict:
+        return {k: lists_as_dicts(v) for k, v in obj.items()}
+    return obj
+
+
+def run(func, documents: list) -> float:
+    start = time.perf_counter()
+    for document in documents:
+        func(document)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--organisations", type=int, default=1200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    documents = [generate_organisation(n, rng) for n in range(args.organisations)]
+
+    legacy_documents = [lists_as_dicts(document) for document in documents]
+
+    legacy = min(run(legacy_extract, legacy_documents) for _ in range(args.repeat))
+    current = min(run(crawler.extract_entities, documents) for _ in range(args.repeat))
+
+    legacy_found = sum(len(legacy_extract(document)[0]) for document in legacy_documents)
+    current_found = sum(len(crawler.extract_entities(document)[0]) for document in documents)
+    skipped_found = sum(len(legacy_extract(document)[0]) for document in documents)
+
+    print(f"organisations: {args.organisations}")
+    print(f"emails found (legacy on original documents): {skipped_found}")
+    print(f"emails found (legacy, lists as dicts):       {legacy_found}")
+    print(f"emails found (extract_entities):             {current_found}")
+    print(f"legacy extract_emails + extract_domain: {legacy:.4f}s")
+    print(f"extract_entities:                      {current:.4f}s")
+    print(f"speed-up:                              {legacy / current:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
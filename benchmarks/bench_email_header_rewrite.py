@@ -0,0 +1,75 @@
+"""
+Compare forwarding an email through create_message() (parse the whole email,
+edit the headers, render it again) with create_forward_message() (rewrite the
+header bytes and pass the body through).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_email_header_rewrite --sizes 100000,1000000,10000000
+"""
+import argparse
+import base64
+import contextlib
+import io
+import os
+import time
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("MailSenderDomain", "gc3.security.gov.uk")
+
+from tests import load_lambda_module  # noqa: E402
+
+forwarder = load_lambda_module("email-forwarder")
+
+
+def generate_email(size: int) -> bytes:
+    attachment = base64.encodebytes(os.urandom(size * 3 // 4))
+    return (
+        b"Received-SPF: pass (spfCheck: domain of example.gov.uk)\r\n"
+        b"Authentication-Results: amazonses.com; spf=pass; dkim=pass\r\n"
+        b"DKIM-Signature: v=1; a=rsa-sha256; d=example.gov.uk; h=From:To; bh=abc=\r\n"
+        b"From: Sender <sender@example.gov.uk>\r\n"
+        b"To: report@gc3.security.gov.uk\r\n"
+        b"Subject: Incident report\r\n"
+        b"MIME-Version: 1.0\r\n"
+        b'Content-Type: multipart/mixed; boundary="b1"\r\n'
+        b"\r\n"
+        b"--b1\r\n"
+        b"Content-Type: text/plain; charset=utf-8\r\n"
+        b"\r\n"
+        b"Please see the attached logs.\r\n"
+        b"--b1\r\n"
+        b"Content-Type: application/octet-stream\r\n"
+        b'Content-Disposition: attachment; filename="logs.bin"\r\n'
+        b"Content-Transfer-Encoding: base64\r\n"
+        b"\r\n" + attachment + b"--b1--\r\n"
+    )
+
+
+def run(func, file_dict: dict, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func(file_dict, "im@gccc.zendesk.com", "im@gc3.security.gov.uk")
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100000,1000000,10000000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>10}  {'create_message':>15}  {'header rewrite':>15}  {'speed-up':>8}")
+    for size in [int(x) for x in args.sizes.split(",")]:
+        file_dict = {"file": generate_email(size)}
+        parsed = run(forwarder.create_message, file_dict, args.repeat)
+        fast = run(forwarder.create_forward_message, file_dict, args.repeat)
+        print(f"{len(file_dict['file']):>10}  {parsed:>14.5f}s  {fast:>14.5f}s  {parsed / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
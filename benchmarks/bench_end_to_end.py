@@ -0,0 +1,489 @@
+"""
+End-to-end throughput of each lambda_handler against the in-process service
+stand-ins in benchmarks/fakes.py, over synthetic datasets of a configurable
+size (tickets, organisations, reports, emails or tables, depending on the
+scenario).
+
+Each scenario and size runs in a fresh interpreter, like a cold Lambda
+execution environment, --repeat times, and reports from the fastest run:
+
+- wall time of the handler invocations
+- API calls made, in total and per operation (--verbose)
+- bytes written: objects put, emails sent and request bodies
+- log output in bytes
+- peak RSS of the process, as Lambda's "Max Memory Used" is
+
+Results are compared against a stored baseline, and the run exits non-zero if
+any scenario regressed beyond the tolerances. Wall time and memory depend on
+the machine, so refresh the baseline (--update-baseline) on the machine that
+does the comparing before relying on them.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_end_to_end --sizes 1000,10000,100000
+    python -m benchmarks.bench_end_to_end --scenarios hackerone-reconcile --verbose
+    python -m benchmarks.bench_end_to_end --sizes 1000 --update-baseline
+"""
+
+import argparse
+import contextlib
+import gc
+import hashlib
+import hmac
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import httpx
+
+from benchmarks import fakes
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_baseline = os.path.join(repo_path, "benchmarks", "baseline_end_to_end.json")
+
+
+class LogSink(io.TextIOBase):
+    """
+    Where the lambdas' logs go during a run: counted, then dropped.
+    """
+
+    def __init__(self):
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        self.written += len(s)
+        return len(s)
+
+
+def load(lambda_name: str, env: dict):
+    # the lambdas read their configuration when they're imported
+    os.environ.update(env)
+    from tests import load_lambda_module
+
+    return load_lambda_module(lambda_name)
+
+
+def crawler(stack, metrics, event: dict, organisations: int = 0, services: int = 0):
+    crawler = load(
+        "crawler-govuk-reference-content",
+        {
+            "S3_PROCESSED_BUCKET": "processed",
+            "AWS_DEFAULT_REGION": "eu-west-2",
+            "GOVUK_REQUESTS_PER_SECOND": "0",
+        },
+    )
+    govuk = fakes.GovukAPI(metrics, organisations=organisations, services=services)
+    s3 = fakes.FakeS3(metrics)
+    client = httpx.Client(transport=govuk.transport(), follow_redirects=True)
+    stack.enter_context(mock.patch.object(crawler, "s3", s3))
+    stack.enter_context(mock.patch.object(crawler.fetcher, "client", client))
+
+    def run():
+        crawler.lambda_handler(event, None)
+
+    def check():
+        kinds = ["organisations"] * bool(organisations) + ["services"] * bool(services)
+        for kind in kinds:
+            key = f"{crawler.key_prefix}/crawl-state/{kind}.json"
+            if ("processed", key) not in s3.objects:
+                raise AssertionError(f"crawl of {kind} didn't complete")
+
+    return run, check
+
+
+def crawler_organisations(stack, metrics, size: int):
+    return crawler(stack, metrics, {"organisation": True}, organisations=size)
+
+
+def crawler_services(stack, metrics, size: int):
+    return crawler(stack, metrics, {"service": True}, services=size)
+
+
+def zendesk_backup(stack, metrics, event: dict, tickets: int = 0, articles: int = 0):
+    backup = load(
+        "zendesk_backup", {"S3_BUCKET": "backup", "AWS_DEFAULT_REGION": "eu-west-2"}
+    )
+    rnd = random.Random(1)
+    zendesk = fakes.ZendeskAPI(
+        metrics,
+        tickets=[fakes.zendesk_ticket(rnd, 1 + i) for i in range(tickets)],
+        comments_per_ticket=3,
+        articles=articles,
+    )
+    s3 = fakes.FakeS3(metrics)
+    zenpy = zendesk.zenpy()
+    stack.enter_context(mock.patch.object(backup, "s3_client", lambda: s3))
+    stack.enter_context(mock.patch.object(backup, "zenpy_client", lambda: zenpy))
+
+    def run():
+        backup.lambda_handler(event, None)
+
+    def check():
+        # the handler logs and swallows errors, so count what was written
+        expected = tickets or (
+            len(zendesk.categories) + len(zendesk.sections) + 2 * articles
+        )
+        if metrics.calls["s3.PutObject"] != expected:
+            raise AssertionError(
+                f"{metrics.calls['s3.PutObject']} objects written, expected {expected}"
+            )
+
+    return run, check
+
+
+def zendesk_backup_support(stack, metrics, size: int):
+    return zendesk_backup(stack, metrics, {"only_support": True}, tickets=size)
+
+
+def zendesk_backup_helpcentre(stack, metrics, size: int):
+    return zendesk_backup(stack, metrics, {"only_helpcentre": True}, articles=size)
+
+
+def hackerone_integration(stack, metrics, size: int):
+    """
+    Four in five reports already have a ticket (mapped, referenced in
+    HackerOne and out of date); the rest need one creating.
+    """
+    integration = load(
+        "hackerone-zendesk-integration",
+        {
+            "HACKERONE_API_USER": "benchmark",
+            "HACKERONE_API_PASS": "benchmark",
+            "HACKERONE_PROGRAM": "gc3",
+            "HACKERONE_WEBHOOK_SECRET": "benchmark",
+            "ZENDESK_API_EMAIL": "api@example.gov.uk",
+            "ZENDESK_API_KEY": "benchmark",
+            "ZENDESK_SUBDOMAIN": "example",
+            "ZENDESK_EMAIL": "vm@example.gov.uk",
+            "TICKET_MAP_BUCKET": "state",
+            "REPORT_LOCK_BUCKET": "state",
+            "RECONCILE_CURSOR_BUCKET": "state",
+            "AWS_DEFAULT_REGION": "eu-west-2",
+        },
+    )
+    rnd = random.Random(1)
+    s3 = fakes.FakeS3(metrics)
+    reports = []
+    tickets = []
+    for n in range(size):
+        zendesk_id = None
+        if n % 5:
+            zendesk_id = 1 + len(tickets)
+            tickets.append(fakes.zendesk_ticket(rnd, zendesk_id, str(100000 + n)))
+        report = fakes.hackerone_report(rnd, n, zendesk_id)
+        reports.append(report)
+        if zendesk_id:
+            s3.add(
+                "state",
+                f"ticket-map/{report['id']}.json",
+                json.dumps({"zendesk_id": zendesk_id}).encode("utf-8"),
+            )
+
+    hackerone_api = fakes.HackerOneAPI(metrics, reports)
+    zendesk_api = fakes.ZendeskAPI(metrics, tickets=tickets)
+    hackerone = integration.hackerone
+    lambda_runtime = integration.lambda_runtime
+    for name, value in [
+        ("client", hackerone.create_client(hackerone_api.transport())),
+        ("async_client", hackerone.create_async_client(hackerone_api.transport())),
+    ]:
+        stack.enter_context(mock.patch.object(hackerone, name, value))
+    stack.enter_context(
+        mock.patch.object(integration.zendesk, "zenpy_client", zendesk_api.zenpy())
+    )
+    stack.enter_context(
+        mock.patch.object(lambda_runtime, "boto3_client", lambda *args, **kwargs: s3)
+    )
+
+    def check():
+        unreferenced = [
+            x["id"]
+            for x in hackerone_api.reports.values()
+            if not x["attributes"]["issue_tracker_reference_id"]
+        ]
+        if unreferenced:
+            raise AssertionError(f"{len(unreferenced)} reports not synced")
+
+    return integration, reports, check
+
+
+def hackerone_webhook(stack, metrics, size: int):
+    integration, reports, check = hackerone_integration(stack, metrics, size)
+    events = []
+    for report in reports:
+        body = json.dumps({"data": {"report": report}})
+        digest = hmac.new(b"benchmark", body.encode(), hashlib.sha256).hexdigest()
+        events.append({"headers": {"X-H1-Signature": f"sha256={digest}"}, "body": body})
+
+    def run():
+        for event in events:
+            integration.lambda_handler(event, None)
+
+    return run, check
+
+
+def hackerone_reconcile(stack, metrics, size: int):
+    integration, _, check = hackerone_integration(stack, metrics, size)
+    # catching up from before every report's last activity
+    s3 = integration.lambda_runtime.boto3_client("s3")
+    s3.add(
+        "state",
+        "reconcile/cursor.json",
+        json.dumps({"cursor": "2024-01-01T00:00:00Z"}).encode("utf-8"),
+    )
+
+    def run():
+        integration.lambda_handler({"reconcile": True}, None)
+
+    return run, check
+
+
+def email_forwarder(stack, metrics, size: int):
+    """
+    Emails arrive through SQS, ten to a batch; one in five is to a single
+    address that isn't routed and some go to two teams.
+    """
+    forwarder = load(
+        "email-forwarder",
+        {
+            "AWS_DEFAULT_REGION": "eu-west-2",
+            "Region": "eu-west-2",
+            "MailS3Bucket": "mailbox",
+            "MailSenderDomain": "gc3.security.gov.uk",
+            "SESMaxSendRate": "1000000",
+            "allowed_send_as_emails": "sender0@example.gov.uk",
+        },
+    )
+    rnd = random.Random(1)
+    s3 = fakes.FakeS3(metrics)
+    records = []
+    for n in range(size):
+        recipients = fakes.email_recipients[n % len(fakes.email_recipients)]
+        s3.add("mailbox", f"message-{n}", fakes.raw_email(rnd, n, recipients))
+        records.append(fakes.ses_sqs_record(n, recipients))
+    batches = [records[i : i + 10] for i in range(0, len(records), 10)]
+
+    stack.enter_context(mock.patch.object(forwarder, "client_s3", s3))
+    stack.enter_context(
+        mock.patch.object(forwarder, "client_ses", fakes.FakeSES(metrics))
+    )
+    failures = []
+
+    def run():
+        for batch in batches:
+            resp = forwarder.lambda_handler({"Records": batch}, None)
+            failures.extend(resp["batchItemFailures"])
+
+    def check():
+        if failures:
+            raise AssertionError(f"{len(failures)} records failed")
+
+    return run, check
+
+
+def athena_partitions(stack, metrics, size: int):
+    maintenance = load(
+        "maintenance-load-athena-partitions",
+        {"AWS_REGION": "eu-west-2", "ATHENA_OUTPUT_S3_URI": "s3://athena-results/"},
+    )
+    athena = fakes.FakeAthena(metrics, tables=size)
+    stack.enter_context(
+        mock.patch.object(maintenance.boto3, "client", lambda *args, **kwargs: athena)
+    )
+
+    def run():
+        maintenance.lambda_handler({}, None)
+
+    def check():
+        expected = len([i for i in range(size) if i % 4])
+        if metrics.calls["athena.StartQueryExecution"] != expected:
+            raise AssertionError("not every partitioned table was repaired")
+
+    return run, check
+
+
+scenarios = {
+    "crawler-organisations": crawler_organisations,
+    "crawler-services": crawler_services,
+    "zendesk-backup-support": zendesk_backup_support,
+    # every section lists every article, so this grows with sections x articles
+    "zendesk-backup-helpcentre": zendesk_backup_helpcentre,
+    "hackerone-webhook": hackerone_webhook,
+    "hackerone-reconcile": hackerone_reconcile,
+    "email-forwarder": email_forwarder,
+    "athena-partitions": athena_partitions,
+}
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_one(name: str, size: int) -> dict:
+    metrics = fakes.Metrics()
+    sink = LogSink()
+    with contextlib.ExitStack() as stack:
+        run, check = scenarios[name](stack, metrics, size)
+        gc.collect()
+        with contextlib.redirect_stdout(sink):
+            start = time.perf_counter()
+            run()
+            wall = time.perf_counter() - start
+        check()
+
+    return {
+        "scenario": name,
+        "size": size,
+        "wall_s": round(wall, 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "log_bytes": sink.written,
+        **metrics.as_dict(),
+    }
+
+
+def run_isolated(name: str, size: int) -> dict:
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.bench_end_to_end",
+            "--run-one",
+            f"{name}:{size}",
+        ],
+        cwd=repo_path,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode:
+        sys.stderr.write(proc.stderr)
+        raise RuntimeError(f"{name} at {size} failed")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def best_of(name: str, size: int, repeat: int) -> dict:
+    """
+    The fastest of several runs, with the lowest peak RSS seen; the counts
+    are the same every time.
+    """
+    results = [run_isolated(name, size) for _ in range(max(1, repeat))]
+    best = min(results, key=lambda x: x["wall_s"])
+    best["peak_rss_mb"] = min(x["peak_rss_mb"] for x in results)
+    return best
+
+
+# metric -> which tolerance applies to it
+compared = {
+    "wall_s": "time",
+    "peak_rss_mb": "memory",
+    "api_calls": "count",
+    "bytes_written": "count",
+    "log_bytes": "count",
+}
+
+
+# scenarios that take milliseconds vary by more than any sensible tolerance
+min_time_regression = 0.1
+
+
+def regressions(result: dict, baseline: dict, tolerances: dict) -> list:
+    res = []
+    for metric, tolerance in compared.items():
+        before = baseline.get(metric, None)
+        if not before:
+            continue
+        change = result[metric] / before - 1
+        if tolerance == "time" and result[metric] - before < min_time_regression:
+            continue
+        if change > tolerances[tolerance]:
+            res.append(f"{metric} {before} -> {result[metric]} (+{change:.0%})")
+    return res
+
+
+def change(result: dict, baseline: dict, metric: str) -> str:
+    before = (baseline or {}).get(metric, None)
+    if not before:
+        return ""
+    return f"{result[metric] / before - 1:+.0%}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default=",".join(scenarios))
+    parser.add_argument("--sizes", default="1000")
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--time-tolerance", type=float, default=0.5)
+    parser.add_argument("--memory-tolerance", type=float, default=0.25)
+    parser.add_argument("--count-tolerance", type=float, default=0.02)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        name, size = args.run_one.rsplit(":", 1)
+        print(json.dumps(run_one(name, int(size))))
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    tolerances = {
+        "time": args.time_tolerance,
+        "memory": args.memory_tolerance,
+        "count": args.count_tolerance,
+    }
+
+    print(
+        f"{'scenario':>26} {'size':>7} {'wall':>9} {'':>5} {'calls':>8} {'':>5}"
+        f" {'written':>10} {'logs':>10} {'peak rss':>9} {'':>5}"
+    )
+    results = {}
+    failed = {}
+    for name in args.scenarios.split(","):
+        for size in [int(x) for x in args.sizes.split(",")]:
+            key = f"{name}@{size}"
+            result = best_of(name, size, args.repeat)
+            results[key] = {k: result[k] for k in list(compared) + ["calls"]}
+            before = baseline.get(key, None)
+            print(
+                f"{name:>26} {size:>7} {result['wall_s']:>8.2f}s"
+                f" {change(result, before, 'wall_s'):>5}"
+                f" {result['api_calls']:>8} {change(result, before, 'api_calls'):>5}"
+                f" {result['bytes_written']:>10} {result['log_bytes']:>10}"
+                f" {result['peak_rss_mb']:>7.1f}MB {change(result, before, 'peak_rss_mb'):>5}"
+            )
+            if args.verbose:
+                for operation, count in result["calls"].items():
+                    print(f"{'':>36}{operation:<40} {count:>8}")
+            if before and not args.update_baseline:
+                failed[key] = regressions(result, before, tolerances)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(dict(sorted(baseline.items())), f, indent=2)
+            f.write("\n")
+        print(f"baseline updated: {args.baseline}")
+        return
+
+    failed = {k: v for k, v in failed.items() if v}
+    for key, problems in failed.items():
+        print(f"REGRESSION {key}: {'; '.join(problems)}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Per-event latency of the HackerOne -> Zendesk sync, sequential (main.sync_report)
+against overlapped (async_sync.run), with HackerOne served by a local stub HTTP
+server and Zendesk by a stub client, each adding a fixed latency per call.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_hackerone_sync --events 20 --latency-ms 50
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+for name in ["HACKERONE_API_USER", "HACKERONE_API_PASS", "ZENDESK_API_KEY"]:
+    os.environ.setdefault(name, "benchmark")
+os.environ.setdefault("ZENDESK_API_EMAIL", "api@example.gov.uk")
+os.environ.setdefault("ZENDESK_SUBDOMAIN", "example")
+os.environ.setdefault("ZENDESK_EMAIL", "vm@example.gov.uk")
+
+from tests import load_lambda_module  # noqa: E402
+
+integration = load_lambda_module("hackerone-zendesk-integration")
+hackerone = integration.hackerone
+zendesk = integration.zendesk
+async_sync = integration.async_sync
+
+
+def report_json(report_id: str) -> bytes:
+    return json.dumps(
+        {
+            "data": {
+                "id": report_id,
+                "attributes": {
+                    "title": "Stored XSS",
+                    "vulnerability_information": "Details",
+                    "state": "triaged",
+                    "main_state": "open",
+                    "created_at": "2024-05-01T10:00:00.000Z",
+                    "triaged_at": "2024-05-02T10:00:00.000Z",
+                    "last_activity_at": "2024-05-03T10:00:00.000Z",
+                },
+                "relationships": {
+                    "program": {"data": {"attributes": {"handle": "gc3"}}},
+                    "severity": {"data": {"attributes": {"rating": "medium"}}},
+                },
+            }
+        }
+    ).encode("utf-8")
+
+
+def start_hackerone_stub(latency: float) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # otherwise headers and body go in separate packets and the client's
+        # delayed ACK adds ~40ms to every response
+        disable_nagle_algorithm = True
+
+        def reply(self, body: bytes):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.reply(report_json(self.path.rstrip("/").split("/")[-1]))
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.reply(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def zendesk_stub(latency: float):
+    """
+    A Zenpy stand-in where every report already has a ticket (found by its
+    mapping) whose fields are out of date.
+    """
+
+    def call(result):
+        def func(*args, **kwargs):
+            time.sleep(latency)
+            return result(*args, **kwargs)
+
+        return func
+
+    client = mock.Mock()
+    client.tickets.side_effect = call(
+        lambda id: zendesk.Ticket(id=int(id), custom_fields=[])
+    )
+    client.tickets.update.side_effect = call(lambda ticket: None)
+    client.search_export.side_effect = call(lambda **kwargs: [])
+    return client
+
+
+def run(sync, events: int) -> list:
+    latencies = []
+    for i in range(events):
+        report_id = str(1000 + i)
+        zendesk.get_ticket_map().put(report_id, 5000 + i)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            sync(report_id)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    args = parser.parse_args()
+    latency = args.latency_ms / 1000
+
+    server = start_hackerone_stub(latency)
+    url = f"http://127.0.0.1:{server.server_port}/v1"
+    with mock.patch.object(hackerone, "hackerone_api_url", url), mock.patch.object(
+        hackerone, "client", None
+    ), mock.patch.object(hackerone, "async_client", None), mock.patch.object(
+        zendesk, "zenpy_client", zendesk_stub(latency)
+    ), mock.patch.object(
+        zendesk, "ticket_map", zendesk.TicketMap()
+    ):
+        # warm up both clients' connections
+        run(integration.sync_report, 1)
+        run(async_sync.run, 1)
+
+        results = {
+            "sequential": run(integration.sync_report, args.events),
+            "async": run(async_sync.run, args.events),
+        }
+    server.shutdown()
+
+    print(f"{args.events} events, {args.latency_ms:.0f}ms per HackerOne/Zendesk call")
+    print(f"{'path':>10}  {'mean':>9}  {'p50':>9}  {'max':>9}")
+    for name, latencies in results.items():
+        print(
+            f"{name:>10}  {statistics.mean(latencies) * 1000:>7.1f}ms"
+            f"  {statistics.median(latencies) * 1000:>7.1f}ms"
+            f"  {max(latencies) * 1000:>7.1f}ms"
+        )
+    speed_up = statistics.mean(results["sequential"]) / statistics.mean(results["async"])
+    print(f"speed-up: {speed_up:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
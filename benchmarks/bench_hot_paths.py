@@ -0,0 +1,287 @@
+"""
+Micro-benchmarks of the per-record functions that run thousands of times an
+invocation, over generated inputs shaped like the real records.
+
+Timings are reported per call, and relative to a fixed pure-Python
+calibration workload timed in the same process, which takes most of the
+machine's speed out of them. The relative costs are what's stored in the
+baseline and what tests/test_hot_path_timings.py checks, failing when a
+function gets slower than its baseline by more than the tolerance.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_hot_paths
+    python -m benchmarks.bench_hot_paths --update-baseline
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+from unittest import mock
+
+from benchmarks import fakes
+
+baseline_path = os.path.join(os.path.dirname(__file__), "baseline_hot_paths.json")
+
+# the same configuration the tests load the lambdas with, as they share the
+# loaded modules with them
+lambda_env = {
+    "crawler-govuk-reference-content": {
+        "S3_PROCESSED_BUCKET": "test",
+        "AWS_DEFAULT_REGION": "eu-west-2",
+    },
+    "email-forwarder": {
+        "AWS_DEFAULT_REGION": "eu-west-1",
+        "Region": "eu-west-1",
+        "MailS3Bucket": "mailbox.test",
+        "MailSenderDomain": "gc3.security.gov.uk",
+    },
+    "hackerone-zendesk-integration": {
+        "HACKERONE_API_USER": "test",
+        "HACKERONE_API_PASS": "test",
+        "ZENDESK_API_EMAIL": "test@example.gov.uk",
+        "ZENDESK_API_KEY": "test",
+        "ZENDESK_SUBDOMAIN": "test",
+        "ZENDESK_EMAIL": "vm@example.gov.uk",
+    },
+    "zendesk_backup": {"S3_BUCKET": "test"},
+}
+
+
+def load(lambda_name: str, module_name: str = "main"):
+    from tests import load_lambda_module
+
+    with mock.patch.dict(os.environ, values=lambda_env[lambda_name]):
+        return load_lambda_module(lambda_name, module_name)
+
+
+def timestamps(rnd: random.Random, count: int) -> list:
+    formats = [
+        "2024-{m:02d}-{d:02d}T10:{s:02d}:00.000+00:00",
+        "2024-{m:02d}-{d:02d}T09:{s:02d}:00Z",
+        "2024-{m:02d}-{d:02d}",
+    ]
+    res = []
+    for _ in range(count):
+        value = rnd.choice(formats).format(
+            m=rnd.randint(1, 12), d=rnd.randint(1, 28), s=rnd.randint(0, 59)
+        )
+        res.append(rnd.choice([value, value, value, None, "", 1714557600]))
+    return res
+
+
+def help_centre_objects() -> list:
+    categories, sections, articles = fakes.help_centre(400)
+    objects = categories + sections + articles
+    return objects + [{"id": 1}, {"html_url": "no-slashes"}, None]
+
+
+def organisations(rnd: random.Random, count: int) -> list:
+    res = []
+    for n in range(count):
+        organisation = fakes.govuk_organisation(rnd, n, count)
+        organisation["content"] = fakes.govuk_organisation_content(n)
+        res.append(organisation)
+    return res
+
+
+def domain_texts(rnd: random.Random, count: int) -> list:
+    texts = [
+        "https://www.{d}.gov.uk/contact",
+        "https://apply-{d}.service.gov.uk/start?ref=1",
+        "Email enquiries@{d}.gov.uk or write to us",
+        "https://twitter.com/{d}",
+        "Call 0300 123 4567 between 9am and 5pm",
+    ]
+    return [
+        rnd.choice(texts).format(d=f"organisation-{rnd.randrange(500)}")
+        for _ in range(count)
+    ]
+
+
+def address_headers(rnd: random.Random, count: int) -> list:
+    def address():
+        n = rnd.randrange(1000)
+        return rnd.choice(
+            [f"person{n}@example.gov.uk", f"Person {n} <Person{n}@Example.gov.uk>"]
+        )
+
+    return [
+        ", ".join(address() for _ in range(rnd.choice([1, 1, 2, 4]))) + " "
+        for _ in range(count)
+    ]
+
+
+def recipient_texts(rnd: random.Random, count: int) -> list:
+    def addresses():
+        return ", ".join(
+            f"Person {n} <person{n}@example.gov.uk>"
+            for n in rnd.sample(range(1000), rnd.randint(1, 5))
+        )
+
+    res = []
+    for _ in range(count):
+        lines = [f"To: {addresses()}", f"  {addresses()}", f"CC: {addresses()}"]
+        if rnd.random() < 0.5:
+            lines.append(f"BCC: {addresses()}")
+        lines += ["", "---", "Sent from the GC3 send-as form", "Reply to: x@y.gov.uk"]
+        text = "\r\n".join(lines)
+        res.append(text.encode("utf-8") if rnd.random() < 0.5 else text)
+    return res
+
+
+def hackerone_reports(rnd: random.Random, count: int) -> list:
+    return [fakes.hackerone_report(rnd, n, rnd.choice([None, n])) for n in range(count)]
+
+
+def cases() -> dict:
+    """
+    name -> (function of one input, inputs)
+    """
+    rnd = random.Random(1)
+    backup = load("zendesk_backup")
+    crawler = load("crawler-govuk-reference-content")
+    forwarder = load("email-forwarder")
+    hackerone = load("hackerone-zendesk-integration", "hackerone")
+
+    tickets = [fakes.zendesk_ticket(rnd, 1 + n) for n in range(200)]
+    return {
+        "zendesk_backup.add_athena_datetimes": (
+            backup.add_athena_datetimes,
+            tickets + fakes.help_centre(100)[2],
+        ),
+        "zendesk_backup.get_key": (backup.get_key, help_centre_objects()),
+        "crawler.athena_datetime": (crawler.athena_datetime, timestamps(rnd, 1000)),
+        "crawler.extract_emails": (crawler.extract_emails, organisations(rnd, 50)),
+        "crawler.extract_domain": (crawler.extract_domain, domain_texts(rnd, 500)),
+        "email_forwarder.extract_email_addresses": (
+            forwarder.extract_email_addresses,
+            address_headers(rnd, 500),
+        ),
+        "email_forwarder.get_send_as_destinations_from_plain_text": (
+            forwarder.get_send_as_destinations_from_plain_text,
+            recipient_texts(rnd, 100),
+        ),
+        "hackerone.normalise_report": (
+            lambda report: hackerone.normalise_report(report["id"], report),
+            hackerone_reports(rnd, 200),
+        ),
+    }
+
+
+calibration_inputs = [
+    {
+        "id": n,
+        "name": f"Record {n}",
+        "updated_at": f"2024-01-{1 + n % 28:02d}T10:00:00Z",
+    }
+    for n in range(100)
+]
+
+
+def calibration(record: dict) -> dict:
+    res = {}
+    for key, value in record.items():
+        if type(value) is str:
+            res[key] = value.lower().replace("t", " ").split(".")[0]
+        else:
+            res[key] = value
+    return res
+
+
+def timer(func, inputs: list):
+    def loop(number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            for x in inputs:
+                func(x)
+        return time.perf_counter() - start
+
+    return loop
+
+
+def loops_for(loop, min_time: float) -> int:
+    number = 1
+    while (elapsed := loop(number)) < min_time:
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)) + 1)
+    return number
+
+
+def measure_case(func, inputs: list, min_time: float, rounds: int) -> dict:
+    """
+    Time func over every input and the calibration workload alternately, so
+    that a slow patch of machine time hits both. The case's cost relative to
+    the calibration is the median over the rounds; the time per call is the
+    best round's.
+    """
+    case = timer(func, inputs)
+    reference = timer(calibration, calibration_inputs)
+    case_number = loops_for(case, min_time)
+    reference_number = loops_for(reference, min_time)
+
+    ratios = []
+    best = None
+    for _ in range(rounds):
+        case_ns = case(case_number) / (case_number * len(inputs)) * 1e9
+        reference_ns = (
+            reference(reference_number)
+            / (reference_number * len(calibration_inputs))
+            * 1e9
+        )
+        ratios.append(case_ns / reference_ns)
+        best = case_ns if best is None else min(best, case_ns)
+    return {
+        "ns_per_call": round(best, 1),
+        "relative": round(statistics.median(ratios), 3),
+    }
+
+
+def measure(names: list = None, min_time: float = 0.05, rounds: int = 9) -> dict:
+    """
+    name -> {"ns_per_call": ..., "relative": ns per call / calibration's}
+    """
+    return {
+        name: measure_case(func, inputs, min_time, rounds)
+        for name, (func, inputs) in cases().items()
+        if not names or name in names
+    }
+
+
+def load_baseline() -> dict:
+    if not os.path.exists(baseline_path):
+        return {}
+    with open(baseline_path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--min-time", type=float, default=0.05)
+    parser.add_argument("--rounds", type=int, default=21)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    baseline = load_baseline()
+    results = measure(min_time=args.min_time, rounds=args.rounds)
+
+    print(f"{'function':>58}  {'per call':>10}  {'relative':>8}  {'baseline':>8}")
+    for name, result in results.items():
+        before = baseline.get(name, {}).get("relative", None)
+        change = f"{result['relative'] / before - 1:+.0%}" if before else ""
+        print(
+            f"{name:>58}  {result['ns_per_call'] / 1000:>8.2f}us"
+            f"  {result['relative']:>8.2f}  {change:>8}"
+        )
+
+    if args.update_baseline:
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"baseline updated: {baseline_path}")
+
+
+if __name__ == "__main__":
+    main()
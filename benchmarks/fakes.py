@@ -0,0 +1,812 @@
+"""
+In-process stand-ins for the services the lambdas talk to, for benchmarking
+them end to end without a network:
+
+- S3, SES and Athena, as objects with the boto3 client (and, for S3,
+  resource) methods the lambdas call
+- gov.uk and HackerOne, as httpx.MockTransport handlers
+- Zendesk, as a requests transport adapter mounted on a real Zenpy client's
+  session, so Zenpy's own request building and deserialisation are measured
+
+All of them record what they're asked to do in a shared Metrics: calls per
+operation and the bytes the lambda sent (objects written, emails sent,
+request bodies). The synthetic datasets they serve are generated from a seed,
+so a given size always produces the same data.
+"""
+
+import base64
+import collections
+import hashlib
+import io
+import itertools
+import json
+import random
+import threading
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import httpx
+import requests
+from botocore.exceptions import ClientError
+from requests.adapters import BaseAdapter
+
+
+class Metrics:
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+
+    def record(self, operation: str, written: int = 0):
+        with self.lock:
+            self.calls[operation] += 1
+            self.bytes_written += written
+
+    def as_dict(self) -> dict:
+        return {
+            "api_calls": sum(self.calls.values()),
+            "bytes_written": self.bytes_written,
+            "calls": dict(sorted(self.calls.items())),
+        }
+
+
+def client_error(code: str, operation: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+def body_bytes(body) -> bytes:
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    if hasattr(body, "read"):
+        return body.read()
+    return bytes(body)
+
+
+class FakeS3:
+    """
+    An S3 client (and resource, through Object()) backed by a dict, with the
+    conditional writes the claim, lease and ticket map stores rely on.
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def add(self, bucket: str, key: str, body: bytes):
+        self.objects[(bucket, key)] = (body, f'"{hashlib.md5(body).hexdigest()}"')
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, IfMatch=None, **kwargs):
+        body = body_bytes(Body)
+        self.metrics.record("s3.PutObject", len(body))
+        with self.lock:
+            existing = self.objects.get((Bucket, Key), None)
+            if IfNoneMatch == "*" and existing is not None:
+                raise client_error("PreconditionFailed", "PutObject")
+            if IfMatch is not None and (existing is None or existing[1] != IfMatch):
+                raise client_error("PreconditionFailed", "PutObject")
+            self.add(Bucket, Key, body)
+            return {"ETag": self.objects[(Bucket, Key)][1]}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.metrics.record("s3.GetObject")
+        with self.lock:
+            existing = self.objects.get((Bucket, Key), None)
+        if existing is None:
+            raise client_error("NoSuchKey", "GetObject")
+        body, etag = existing
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), "ETag": etag}
+
+    def delete_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        self.metrics.record("s3.DeleteObject")
+        with self.lock:
+            existing = self.objects.get((Bucket, Key), None)
+            if IfMatch is not None and existing is not None and existing[1] != IfMatch:
+                raise client_error("PreconditionFailed", "DeleteObject")
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def put_object_tagging(self, Bucket, Key, Tagging, **kwargs):
+        self.metrics.record("s3.PutObjectTagging")
+        return {}
+
+    def Object(self, bucket: str, key: str):
+        return FakeS3Object(self, bucket, key)
+
+
+class FakeS3Object:
+    def __init__(self, s3: FakeS3, bucket: str, key: str):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+
+    def put(self, Body, **kwargs):
+        return self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=Body, **kwargs)
+
+    def get(self, **kwargs):
+        return self.s3.get_object(Bucket=self.bucket, Key=self.key)
+
+
+class FakeSES:
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.ids = itertools.count(1)
+
+    def send_raw_email(self, Source, Destinations, RawMessage, **kwargs):
+        self.metrics.record("ses.SendRawEmail", len(RawMessage["Data"]))
+        return {"MessageId": f"ses-{next(self.ids)}"}
+
+
+class FakeAthenaPaginator:
+    def __init__(self, athena, operation: str):
+        self.athena = athena
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        return getattr(self.athena, self.operation)(**kwargs)
+
+
+class FakeAthena:
+    """
+    A Glue catalog of databases and tables, where every query succeeds as soon
+    as it's started.
+    """
+
+    page_size = 50
+
+    def __init__(self, metrics: Metrics, tables: int, tables_per_database: int = 100):
+        self.metrics = metrics
+        self.databases = {}
+        for i in range(tables):
+            database = f"database_{i // tables_per_database}"
+            self.databases.setdefault(database, []).append(
+                {
+                    "Name": f"table_{i}",
+                    "TableType": "EXTERNAL_TABLE",
+                    "Columns": [{"Name": "id", "Type": "string"}],
+                    # one in four tables isn't partitioned
+                    "PartitionKeys": (
+                        [{"Name": "dt", "Type": "string"}] if i % 4 else []
+                    ),
+                }
+            )
+        self.query_ids = itertools.count(1)
+
+    def get_paginator(self, operation: str):
+        return FakeAthenaPaginator(self, operation)
+
+    def pages(self, operation: str, key: str, items: list):
+        for start in range(0, max(len(items), 1), self.page_size):
+            self.metrics.record(f"athena.{operation}")
+            yield {key: items[start : start + self.page_size]}
+
+    def list_databases(self, CatalogName, **kwargs):
+        return self.pages(
+            "ListDatabases", "DatabaseList", [{"Name": x} for x in self.databases]
+        )
+
+    def list_table_metadata(self, CatalogName, DatabaseName, **kwargs):
+        return self.pages(
+            "ListTableMetadata", "TableMetadataList", self.databases[DatabaseName]
+        )
+
+    def start_query_execution(self, QueryString, **kwargs):
+        self.metrics.record("athena.StartQueryExecution", len(QueryString))
+        return {"QueryExecutionId": f"query-{next(self.query_ids)}"}
+
+    def get_query_execution(self, QueryExecutionId):
+        self.metrics.record("athena.GetQueryExecution")
+        return {
+            "QueryExecution": {
+                "QueryExecutionId": QueryExecutionId,
+                "Status": {"State": "SUCCEEDED"},
+            }
+        }
+
+    def get_query_results(self, QueryExecutionId, **kwargs):
+        self.metrics.record("athena.GetQueryResults")
+        return {"ResultSet": {"Rows": []}}
+
+
+def page_of(items: list, after, size: int) -> tuple:
+    """
+    A page of items with a cursor (the offset) to the next page, or None.
+    """
+    start = int(after or 0)
+    end = start + size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+# gov.uk
+
+
+def govuk_organisation(rnd: random.Random, n: int, count: int) -> dict:
+    slug = f"organisation-{n}"
+    domain = f"{slug}.gov.uk"
+    parents = []
+    if n >= 10:
+        parents.append(
+            {"id": f"https://www.gov.uk/api/organisations/organisation-{n // 10}"}
+        )
+    superseding = []
+    if n % 50 == 49 and n + 1 < count:
+        superseding.append(
+            {"id": f"https://www.gov.uk/api/organisations/organisation-{n + 1}"}
+        )
+    return {
+        "id": f"https://www.gov.uk/api/organisations/{slug}",
+        "title": f"Organisation {n}",
+        "format": rnd.choice(["Ministerial department", "Executive agency", "Other"]),
+        "updated_at": f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T10:00:00.000+00:00",
+        "web_url": f"https://www.gov.uk/government/organisations/{slug}",
+        "analytics_identifier": f"OT{n}",
+        "details": {
+            "slug": slug,
+            "content_id": f"org-{n:08d}",
+            "abbreviation": f"O{n}",
+            "govuk_status": "live",
+            "govuk_closed_status": None,
+        },
+        "parent_organisations": parents,
+        "child_organisations": [
+            {"id": f"https://www.gov.uk/api/organisations/organisation-{c}"}
+            for c in range(n * 10, min(n * 10 + 10, count))
+            if c >= 10
+        ],
+        "superseded_organisations": [],
+        "superseding_organisations": superseding,
+        "contact": f"Email enquiries@{domain} or foi@{domain}",
+    }
+
+
+def govuk_organisation_content(n: int) -> dict:
+    domain = f"organisation-{n}.gov.uk"
+    return {
+        "content_id": f"org-{n:08d}",
+        "details": {
+            "ordered_corporate_information_pages": [
+                {"title": "Contact", "href": f"mailto:Enquiries@www.{domain}"},
+                {"title": "Complaints", "href": f"https://www.{domain}/complaints"},
+            ],
+            "social_media_links": [
+                {"service_type": "twitter", "href": f"https://twitter.com/org{n}"},
+                {"service_type": "other", "href": f"https://www.{domain}/"},
+            ],
+            "organisation_govuk_status": {"url": f"https://www.{domain}/about"},
+            "body": (
+                f"<p>Press office: press@{domain}. "
+                f"Data protection: dpo@{domain}.</p>" * 3
+            ),
+        },
+    }
+
+
+def govuk_service(rnd: random.Random, n: int) -> dict:
+    return {
+        "content_id": f"svc-{n:08d}",
+        "title": f"Apply for service {n}",
+        "description": f"Use this service to apply for thing {n}.",
+        "link": f"/apply-service-{n}",
+        "organisation_content_ids": [f"org-{rnd.randrange(100):08d}"],
+        "public_timestamp": f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T09:00:00Z",
+        "phase": rnd.choice(["live", "beta"]),
+        "first_published_at": "2020-01-01T00:00:00.000+00:00",
+        "public_updated_at": "2024-01-01T00:00:00.000+00:00",
+        "transaction_start_link": f"https://apply-service-{n}.service.gov.uk/start",
+    }
+
+
+class GovukAPI:
+    """
+    The gov.uk organisations, content and search APIs.
+    """
+
+    organisations_per_page = 20
+
+    def __init__(
+        self, metrics: Metrics, organisations: int = 0, services: int = 0, seed: int = 1
+    ):
+        rnd = random.Random(seed)
+        self.metrics = metrics
+        self.organisations = [
+            govuk_organisation(rnd, n, organisations) for n in range(organisations)
+        ]
+        self.services = [govuk_service(rnd, n) for n in range(services)]
+        self.services.sort(key=lambda x: x["public_timestamp"], reverse=True)
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        params = request.url.params
+        if path == "/api/organisations":
+            self.metrics.record("govuk.organisations")
+            page = int(params.get("page", "1"))
+            size = self.organisations_per_page
+            return httpx.Response(
+                200,
+                json={
+                    "results": self.organisations[(page - 1) * size : page * size],
+                    "pages": max(1, -(-len(self.organisations) // size)),
+                },
+            )
+        if path.startswith("/api/content/government/organisations/"):
+            self.metrics.record("govuk.content")
+            n = int(path.rsplit("-", 1)[1])
+            return httpx.Response(200, json=govuk_organisation_content(n))
+        if path == "/api/search.json":
+            self.metrics.record("govuk.search")
+            start = int(params.get("start", "0"))
+            count = int(params.get("count", "20"))
+            fields = params.get_list("fields")
+            results = self.services[start : start + count]
+            if fields:
+                results = [{k: v for k, v in x.items() if k in fields} for x in results]
+            return httpx.Response(
+                200, json={"results": results, "total": len(self.services)}
+            )
+        if path.startswith("/api/content/"):
+            self.metrics.record("govuk.content")
+            return httpx.Response(200, json={"details": {}})
+        self.metrics.record("govuk.not_found")
+        return httpx.Response(404, json={})
+
+
+# HackerOne
+
+
+def hackerone_report(rnd: random.Random, n: int, zendesk_id=None) -> dict:
+    report_id = str(100000 + n)
+    return {
+        "id": report_id,
+        "type": "report",
+        "attributes": {
+            "title": f"Stored XSS in search on service {n}",
+            "vulnerability_information": "## Summary\n" + "Steps to reproduce. " * 40,
+            "state": rnd.choice(["triaged", "resolved", "needs-more-info"]),
+            "main_state": rnd.choice(["open", "closed"]),
+            "created_at": "2024-05-01T10:00:00.000Z",
+            "triaged_at": "2024-05-02T10:00:00.000Z",
+            "closed_at": None,
+            "last_activity_at": f"2024-06-{1 + n % 28:02d}T10:{n % 60:02d}:00.000Z",
+            "last_public_activity_at": "2024-05-03T10:00:00.000Z",
+            "issue_tracker_reference_id": str(zendesk_id) if zendesk_id else None,
+            "issue_tracker_reference_url": None,
+            "cve_ids": [f"CVE-2024-{n:05d}"] if n % 3 == 0 else [],
+        },
+        "relationships": {
+            "program": {"data": {"attributes": {"handle": "gc3"}}},
+            "reporter": {"data": {"attributes": {"username": f"researcher{n % 97}"}}},
+            "assignee": {"data": {"attributes": {"name": "Vulnerability Management"}}},
+            "weakness": {
+                "data": {
+                    "attributes": {
+                        "name": "Cross-site Scripting (XSS) - Stored",
+                        "external_id": "cwe-79",
+                        "description": "Stored XSS",
+                    }
+                }
+            },
+            "severity": {
+                "data": {
+                    "attributes": {
+                        "rating": rnd.choice(["low", "medium", "high", "critical"]),
+                        "score": round(rnd.uniform(1, 10), 1),
+                        "attack_vector": "network",
+                    }
+                }
+            },
+        },
+    }
+
+
+class HackerOneAPI:
+    """
+    The HackerOne reports API: listing (100 a page), fetching and setting the
+    issue tracker reference.
+    """
+
+    def __init__(self, metrics: Metrics, reports: list):
+        self.metrics = metrics
+        self.reports = {x["id"]: x for x in reports}
+        self.listing = [
+            {
+                "id": x["id"],
+                "type": "report",
+                "attributes": {"last_activity_at": x["attributes"]["last_activity_at"]},
+            }
+            for x in reports
+        ]
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/v1")
+        if request.method == "POST" and path.endswith("/issue_tracker_reference_id"):
+            self.metrics.record("hackerone.set_reference", len(request.content))
+            report = self.reports[path.split("/")[2]]
+            reference = json.loads(request.content)["data"]["attributes"]["reference"]
+            report["attributes"]["issue_tracker_reference_id"] = reference
+            return httpx.Response(200, json={"data": {"type": "activity"}})
+        if path == "/reports":
+            self.metrics.record("hackerone.list_reports")
+            params = request.url.params
+            after = params.get("filter[last_activity_at__gt]", None)
+            listing = self.listing
+            if after:
+                listing = [
+                    x for x in listing if x["attributes"]["last_activity_at"] > after
+                ]
+            size = int(params.get("page[size]", "100"))
+            page = int(params.get("page[number]", "1"))
+            data = listing[(page - 1) * size : page * size]
+            links = {}
+            if page * size < len(listing):
+                query = {k: v for k, v in params.multi_items()}
+                query["page[number]"] = str(page + 1)
+                links["next"] = (
+                    f"https://api.hackerone.com/v1/reports?{urlencode(query)}"
+                )
+            return httpx.Response(200, json={"data": data, "links": links})
+        if path.startswith("/reports/"):
+            self.metrics.record("hackerone.get_report")
+            report = self.reports.get(path.split("/")[2], None)
+            if report is None:
+                return httpx.Response(404, json={"errors": []})
+            return httpx.Response(200, json={"data": report})
+        self.metrics.record("hackerone.not_found")
+        return httpx.Response(404, json={})
+
+
+# Zendesk
+
+hackerone_id_field = 13630395133585
+
+
+def zendesk_ticket(
+    rnd: random.Random, ticket_id: int, hackerone_id: str = None
+) -> dict:
+    ticket = {
+        "id": ticket_id,
+        "url": f"https://example.zendesk.com/api/v2/tickets/{ticket_id}.json",
+        "subject": f"Ticket {ticket_id}",
+        "raw_subject": f"Ticket {ticket_id}",
+        "description": "Please help. " * rnd.randint(5, 40),
+        "status": rnd.choice(["new", "open", "pending", "solved", "closed"]),
+        "priority": rnd.choice([None, "low", "normal", "high"]),
+        "requester_id": 1000 + ticket_id % 500,
+        "submitter_id": 1000 + ticket_id % 500,
+        "assignee_id": 2000 + ticket_id % 20,
+        "group_id": 10980471236113,
+        "tags": rnd.sample(["vm", "im", "gccc", "phishing", "dns", "urgent"], 2),
+        "created_at": f"2024-{1 + ticket_id % 12:02d}-01T09:00:00Z",
+        "updated_at": f"2024-{1 + ticket_id % 12:02d}-02T09:30:00Z",
+        "custom_fields": [],
+        "fields": [],
+    }
+    if hackerone_id:
+        ticket["custom_fields"] = [
+            {"id": hackerone_id_field, "value": hackerone_id},
+            {"id": 13630456602001, "value": "New (Open)"},
+        ]
+    return ticket
+
+
+def zendesk_comments(ticket_id: int, count: int) -> list:
+    return [
+        {
+            "id": ticket_id * 100 + i,
+            "type": "Comment",
+            "author_id": 1000 + i,
+            "body": f"Comment {i} on ticket {ticket_id}. " * 10,
+            "html_body": f"<p>Comment {i} on ticket {ticket_id}.</p>",
+            "public": i % 2 == 0,
+            "created_at": "2024-01-02T09:30:00Z",
+        }
+        for i in range(count)
+    ]
+
+
+def help_centre(articles: int) -> tuple:
+    """
+    (categories, sections, articles): 20 articles to a section and 10
+    sections to a category.
+    """
+    section_count = max(1, -(-articles // 20))
+    category_count = max(1, -(-section_count // 10))
+    url = "https://example.zendesk.com/hc/en-gb"
+    categories = [
+        {
+            "id": 1 + i,
+            "name": f"Category {i}",
+            "html_url": f"{url}/categories/{1 + i}-category-{i}",
+            "updated_at": "2024-01-01T00:00:00Z",
+        }
+        for i in range(category_count)
+    ]
+    sections = [
+        {
+            "id": 1000 + i,
+            "name": f"Section {i}",
+            "category_id": 1 + i // 10,
+            "html_url": f"{url}/sections/{1000 + i}-section-{i}",
+            "updated_at": "2024-01-01T00:00:00Z",
+        }
+        for i in range(section_count)
+    ]
+    articles = [
+        {
+            "id": 100000 + i,
+            "title": f"Article {i}",
+            "section_id": 1000 + i // 20,
+            "html_url": f"{url}/articles/{100000 + i}-article-{i}",
+            "body": f"<h2>Article {i}</h2>" + "<p>Guidance on reporting.</p>" * 20,
+            "created_at": "2023-01-01T00:00:00Z",
+            "updated_at": "2024-01-01T00:00:00Z",
+        }
+        for i in range(articles)
+    ]
+    return categories, sections, articles
+
+
+class ZendeskAPI(BaseAdapter):
+    """
+    The Zendesk support and help centre APIs, as a requests transport adapter.
+    List endpoints use cursor pagination, and the bulk endpoints complete
+    their jobs immediately.
+    """
+
+    page_size = 100
+
+    def __init__(
+        self,
+        metrics: Metrics,
+        tickets: list = None,
+        comments_per_ticket: int = 0,
+        articles: int = 0,
+    ):
+        super().__init__()
+        self.metrics = metrics
+        self.tickets = {x["id"]: x for x in tickets or []}
+        self.by_hackerone_id = {}
+        for ticket in self.tickets.values():
+            for field in ticket["custom_fields"]:
+                if field["id"] == hackerone_id_field:
+                    self.by_hackerone_id[field["value"]] = ticket["id"]
+        self.comments_per_ticket = comments_per_ticket
+        self.categories, self.sections, self.articles = help_centre(articles)
+        self.ids = itertools.count(max(self.tickets, default=0) + 1)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def session(self) -> requests.Session:
+        session = requests.Session()
+        session.mount("https://", self)
+        return session
+
+    def zenpy(self):
+        from zenpy import Zenpy
+
+        return Zenpy(
+            subdomain="example",
+            email="api@example.gov.uk",
+            token="benchmark",
+            session=self.session(),
+        )
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path.removeprefix("/api/v2/").removesuffix(".json")
+        body = body_bytes(request.body or b"")
+        status, operation, payload = self.route(request.method, path, params, body, url)
+        self.metrics.record(f"zendesk.{operation}", len(body))
+
+        resp = requests.Response()
+        resp.status_code = status
+        resp.headers["Content-Type"] = "application/json"
+        resp._content = json.dumps(payload).encode("utf-8")
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def listing(self, key: str, items: list, params: dict, url) -> dict:
+        size = int(params.get("page[size]", self.page_size))
+        page, after = page_of(items, params.get("page[after]", None), size)
+        next_params = dict(params, **{"page[after]": after}) if after else None
+        return {
+            key: page,
+            "meta": {"has_more": after is not None, "after_cursor": after},
+            "links": {
+                "next": (
+                    f"{url.scheme}://{url.netloc}{url.path}?{urlencode(next_params)}"
+                    if next_params
+                    else None
+                )
+            },
+        }
+
+    def job(self, results: list) -> dict:
+        job = {
+            "id": f"job-{len(self.jobs) + 1}",
+            "status": "completed",
+            "total": len(results),
+            "progress": len(results),
+            "results": results,
+        }
+        self.jobs[job["id"]] = job
+        return {"job_status": job}
+
+    def create(self, ticket: dict) -> dict:
+        ticket = dict(ticket, id=next(self.ids))
+        ticket.pop("comment", None)
+        ticket.setdefault("custom_fields", [])
+        self.tickets[ticket["id"]] = ticket
+        return ticket
+
+    def update(self, ticket: dict) -> dict:
+        current = self.tickets[ticket["id"]]
+        fields = {x["id"]: x for x in current.get("custom_fields", [])}
+        for field in ticket.get("custom_fields", None) or []:
+            fields[field["id"]] = field
+        current["custom_fields"] = list(fields.values())
+        for field in current["custom_fields"]:
+            if field["id"] == hackerone_id_field and field["value"]:
+                self.by_hackerone_id[field["value"]] = current["id"]
+        return current
+
+    def route(self, method: str, path: str, params: dict, body: bytes, url) -> tuple:
+        parts = path.split("/")
+        with self.lock:
+            if path == "search/export":
+                # terms on the same field are ORed
+                terms = [
+                    x.split(":", 1) for x in params.get("query", "").split() if ":" in x
+                ]
+                hackerone_ids = [
+                    value.strip('"')
+                    for key, value in terms
+                    if key == f"custom_field_{hackerone_id_field}"
+                ]
+                if hackerone_ids:
+                    ticket_ids = [
+                        self.by_hackerone_id.get(x, None) for x in hackerone_ids
+                    ]
+                    results = [self.tickets[x] for x in ticket_ids if x]
+                else:
+                    results = list(self.tickets.values())
+                results = [dict(x, result_type="ticket") for x in results]
+                return (
+                    200,
+                    "search_export",
+                    self.listing("results", results, params, url),
+                )
+            if path == "tickets/show_many":
+                ids = [int(x) for x in params.get("ids", "").split(",") if x]
+                tickets = [self.tickets[x] for x in ids if x in self.tickets]
+                return 200, "show_many", {"tickets": tickets, "next_page": None}
+            if path == "tickets/create_many":
+                results = [
+                    {
+                        "index": i,
+                        "id": self.create(x)["id"],
+                        "action": "create",
+                        "success": True,
+                        "status": "Created",
+                    }
+                    for i, x in enumerate(json.loads(body)["tickets"])
+                ]
+                return 200, "create_many", self.job(results)
+            if path == "tickets/update_many":
+                results = [
+                    {
+                        "id": self.update(x)["id"],
+                        "action": "update",
+                        "success": True,
+                        "status": "Updated",
+                    }
+                    for x in json.loads(body)["tickets"]
+                ]
+                return 200, "update_many", self.job(results)
+            if parts[0] == "job_statuses":
+                return 200, "job_status", {"job_status": self.jobs[parts[1]]}
+            if path == "tickets" and method == "POST":
+                ticket = self.create(json.loads(body)["ticket"])
+                return (
+                    201,
+                    "create_ticket",
+                    {"ticket": ticket, "audit": {"id": ticket["id"], "events": []}},
+                )
+            if parts[0] == "tickets" and len(parts) == 3 and parts[2] == "comments":
+                comments = zendesk_comments(int(parts[1]), self.comments_per_ticket)
+                return 200, "comments", self.listing("comments", comments, params, url)
+            if parts[0] == "tickets" and len(parts) == 2:
+                ticket_id = int(parts[1])
+                if ticket_id not in self.tickets:
+                    return (
+                        404,
+                        "show_ticket",
+                        {"error": "RecordNotFound", "description": "Not found"},
+                    )
+                if method == "PUT":
+                    ticket = self.update(json.loads(body)["ticket"])
+                    return (
+                        200,
+                        "update_ticket",
+                        {"ticket": ticket, "audit": {"id": ticket_id, "events": []}},
+                    )
+                return 200, "show_ticket", {"ticket": self.tickets[ticket_id]}
+            if path == "help_center/categories":
+                return (
+                    200,
+                    "categories",
+                    self.listing("categories", self.categories, params, url),
+                )
+            if path == "help_center/sections":
+                return (
+                    200,
+                    "sections",
+                    self.listing("sections", self.sections, params, url),
+                )
+            if path == "help_center/articles":
+                return (
+                    200,
+                    "articles",
+                    self.listing("articles", self.articles, params, url),
+                )
+        return 404, "not_found", {"error": "InvalidEndpoint"}
+
+
+# email
+
+
+def raw_email(rnd: random.Random, n: int, recipients: list) -> bytes:
+    attachment = base64.encodebytes(rnd.randbytes(rnd.randint(2000, 12000)))
+    return (
+        b"Received-SPF: pass (spfCheck: domain of example.gov.uk)\r\n"
+        b"Authentication-Results: amazonses.com; spf=pass; dkim=pass\r\n"
+        b"DKIM-Signature: v=1; a=rsa-sha256; d=example.gov.uk; h=From:To; bh=abc=\r\n"
+        + f"From: Sender {n} <sender{n % 50}@example.gov.uk>\r\n".encode()
+        + f"To: {', '.join(recipients)}\r\n".encode()
+        + f"Subject: Report {n}\r\n".encode()
+        + f"Message-ID: <message-{n}@example.gov.uk>\r\n".encode()
+        + b"MIME-Version: 1.0\r\n"
+        b'Content-Type: multipart/mixed; boundary="b1"\r\n'
+        b"\r\n"
+        b"--b1\r\n"
+        b"Content-Type: text/plain; charset=utf-8\r\n"
+        b"\r\n"
+        b"Please see the attached logs.\r\n"
+        b"--b1\r\n"
+        b'Content-Type: application/octet-stream; name="logs.txt"\r\n'
+        b"Content-Transfer-Encoding: base64\r\n"
+        b"\r\n" + attachment + b"--b1--\r\n"
+    )
+
+
+email_recipients = [
+    ["contact@gc3.security.gov.uk"],
+    ["report@gc3.security.gov.uk"],
+    ["vm@gc3.security.gov.uk", "security@gc3.security.gov.uk"],
+    ["contact@gc3.security.gov.uk", "im@gc3.security.gov.uk"],
+    ["unknown@gc3.security.gov.uk"],
+]
+
+
+def ses_sqs_record(n: int, recipients: list) -> dict:
+    notification = {
+        "notificationType": "Received",
+        "mail": {"messageId": f"message-{n}"},
+        "receipt": {"recipients": recipients},
+    }
+    return {
+        "messageId": f"sqs-{n}",
+        "eventSource": "aws:sqs",
+        "body": json.dumps(
+            {"Type": "Notification", "Message": json.dumps(notification)}
+        ),
+    }
@@ -12,6 +12,7 @@ if test -f "dev-requirements.txt"; then
 fi
 
 cp ./*.py .target/
+cp ../shared/lambda_runtime.py .target/
 
 cd .target/ || exit 1
 
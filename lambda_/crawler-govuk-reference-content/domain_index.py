@@ -0,0 +1,163 @@
+"""
+Domain -> owning organisation/service inverted index.
+
+The index is a UTF-8 text file of tab-separated lines, sorted by key:
+
+    <key>\t<organisation ids, comma separated>\t<service ids, comma separated>
+
+Keys are either a discovered domain (e.g. "tax.service.gov.uk") or a parent
+suffix wildcard (e.g. "*.service.gov.uk") that collects the owners of every
+discovered domain below it, down to the registrable domain. Because the lines
+are sorted, a lookup is a binary search over the raw bytes of a single object.
+"""
+
+import boto3
+
+index_key = "domain-index/domain-index.tsv"
+
+# second-level public suffixes that we see in gov.uk data; anything else is
+# treated as a single-label TLD
+multi_label_suffixes = {
+    "ac.uk",
+    "co.uk",
+    "gov.uk",
+    "judiciary.uk",
+    "ltd.uk",
+    "me.uk",
+    "mod.uk",
+    "net.uk",
+    "nhs.uk",
+    "org.uk",
+    "parliament.uk",
+    "plc.uk",
+    "police.uk",
+    "sch.uk",
+}
+
+
+def registrable_domain(domain: str):
+    labels = domain.split(".")
+    if len(labels) >= 3 and ".".join(labels[-2:]) in multi_label_suffixes:
+        return ".".join(labels[-3:])
+    if len(labels) >= 2:
+        return ".".join(labels[-2:])
+    return None
+
+
+def parent_domains(domain: str) -> list:
+    """
+    Return the parents of a domain, nearest first, stopping at the registrable
+    domain:
+
+    >>> parent_domains("a.tax.service.gov.uk")
+    ['tax.service.gov.uk', 'service.gov.uk']
+    """
+    res = []
+    registrable = registrable_domain(domain)
+    if not registrable or domain == registrable:
+        return res
+
+    labels = domain.split(".")
+    for i in range(1, len(labels)):
+        parent = ".".join(labels[i:])
+        res.append(parent)
+        if parent == registrable:
+            break
+    return res
+
+
+def build_domain_index(objects: list) -> bytes:
+    """
+    Build the sorted index from the full organisation and service objects
+    produced by process_organisation() / process_service().
+    """
+    entries = {}
+
+    def add(key: str, obj_type: str, obj_id: str):
+        if key not in entries:
+            entries[key] = {"organisation": set(), "service": set()}
+        entries[key][obj_type].add(obj_id)
+
+    for obj in objects:
+        if not obj or obj.get("type") not in ["organisation", "service"]:
+            continue
+        for domain in obj.get("discovered_domains", []):
+            domain = domain.lower().strip(".")
+            if not domain:
+                continue
+            add(domain, obj["type"], obj["id"])
+            for parent in parent_domains(domain):
+                add(f"*.{parent}", obj["type"], obj["id"])
+
+    lines = []
+    for key in sorted(entries, key=lambda x: x.encode("UTF-8")):
+        lines.append(
+            "\t".join(
+                [
+                    key,
+                    ",".join(sorted(entries[key]["organisation"])),
+                    ",".join(sorted(entries[key]["service"])),
+                ]
+            ).encode("UTF-8")
+        )
+    return b"\n".join(lines)
+
+
+class DomainIndex:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    @classmethod
+    def from_s3(cls, bucket: str, key_prefix: str = "govuk/objects", s3_client=None):
+        if s3_client is None:
+            s3_client = boto3.client("s3")
+        resp = s3_client.get_object(Bucket=bucket, Key=f"{key_prefix}/{index_key}")
+        return cls(resp["Body"].read())
+
+    def get(self, key: str):
+        """
+        Binary search the raw index bytes for an exact key. Returns a dict of
+        {"organisations": [...], "services": [...]} or None.
+        """
+        data = self.data
+        needle = key.encode("UTF-8")
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b"\n", 0, mid) + 1
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = len(data)
+
+            tab = data.find(b"\t", start, end)
+            line_key = data[start:tab] if tab != -1 else data[start:end]
+            if line_key == needle:
+                _, orgs, services = data[start:end].decode("UTF-8").split("\t")
+                return {
+                    "organisations": orgs.split(",") if orgs else [],
+                    "services": services.split(",") if services else [],
+                }
+            if line_key < needle:
+                lo = end + 1
+            else:
+                hi = start
+        return None
+
+    def lookup(self, domain: str):
+        """
+        Find the owners of a domain: an exact match first, then the nearest
+        parent, either as a discovered domain or as a wildcard suffix.
+        Returns a dict with the matched key, or None.
+        """
+        domain = domain.lower().strip(".")
+        if domain.startswith("www."):
+            domain = domain[4:]
+
+        for key in [domain] + [
+            k for parent in parent_domains(domain) for k in (parent, f"*.{parent}")
+        ]:
+            res = self.get(key)
+            if res:
+                res["matched"] = key
+                return res
+        return None
@@ -0,0 +1,145 @@
+"""
+Polite, retrying JSON fetcher for the gov.uk APIs.
+
+Requests are spaced per host so that we stay under gov.uk's rate limits, and
+429/5xx responses and transport errors are retried with jittered exponential
+backoff, honouring Retry-After when the server sends one.
+"""
+
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+retry_status_codes = [429, 500, 502, 503, 504]
+
+
+class FetchError(Exception):
+    def __init__(self, url: str, reason: str):
+        super().__init__(f"{url}: {reason}")
+        self.url = url
+        self.reason = reason
+
+
+def parse_retry_after(value, now: float = None):
+    """
+    Retry-After is either a number of seconds or an HTTP date. Returns seconds
+    to wait, or None if the header is missing or unparseable.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, retry_at.timestamp() - now)
+
+
+class HostRateLimiter:
+    def __init__(
+        self, requests_per_second: float, clock=time.monotonic, sleep=time.sleep
+    ):
+        self.set_rate(requests_per_second)
+        self.clock = clock
+        self.sleep = sleep
+        self.next_allowed = {}
+        self.lock = threading.Lock()
+
+    def set_rate(self, requests_per_second: float):
+        self.requests_per_second = requests_per_second
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+
+    def wait(self, host: str):
+        if not self.interval:
+            return
+        with self.lock:
+            now = self.clock()
+            slot = max(now, self.next_allowed.get(host, now))
+            self.next_allowed[host] = slot + self.interval
+        if slot > now:
+            self.sleep(slot - now)
+
+    def defer(self, host: str, seconds: float):
+        """Push the host's next slot back, e.g. after a 429."""
+        with self.lock:
+            now = self.clock()
+            self.next_allowed[host] = max(
+                self.next_allowed.get(host, now), now + seconds
+            )
+
+
+class Fetcher:
+    def __init__(
+        self,
+        client: httpx.Client,
+        user_agent: str,
+        requests_per_second: float = 10,
+        max_retries: int = 4,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+        sleep=time.sleep,
+        clock=time.monotonic,
+    ):
+        self.client = client
+        self.user_agent = user_agent
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sleep = sleep
+        self.limiter = HostRateLimiter(requests_per_second, clock=clock, sleep=sleep)
+        self.stats = {"requests": 0, "retries": 0, "failures": 0}
+
+    def backoff(self, attempt: int, retry_after=None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def get_json(self, url: str) -> dict:
+        """
+        Returns the decoded JSON body of a 2xx JSON response, {} for any other
+        non-retryable response, and raises FetchError once the retries for a
+        retryable response or transport error are exhausted.
+        """
+        host = urlsplit(url).netloc
+        reason = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats["retries"] += 1
+
+            self.limiter.wait(host)
+            self.stats["requests"] += 1
+            retry_after = None
+            try:
+                resp = self.client.get(url, headers={"user-agent": self.user_agent})
+            except httpx.TransportError as e:
+                reason = f"{type(e).__name__}: {e}"
+            else:
+                if resp.status_code in retry_status_codes:
+                    reason = f"HTTP {resp.status_code}"
+                    retry_after = parse_retry_after(
+                        resp.headers.get("retry-after", None)
+                    )
+                elif str(resp.status_code).startswith("2") and resp.headers.get(
+                    "content-type", ""
+                ).startswith("application/json"):
+                    return resp.json()
+                else:
+                    return {}
+
+            if attempt < self.max_retries:
+                wait = self.backoff(attempt, retry_after)
+                if retry_after is not None:
+                    self.limiter.defer(host, wait)
+                self.sleep(wait)
+
+        self.stats["failures"] += 1
+        raise FetchError(url, reason)
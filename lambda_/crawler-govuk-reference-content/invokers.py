@@ -0,0 +1,58 @@
+"""
+How the fan-out coordinator runs its workers.
+
+LambdaInvoker calls this function again through the Lambda API, so each shard
+gets its own container. InProcessInvoker calls a handler directly, so that the
+whole map/reduce flow runs in a single process for tests and local runs.
+"""
+
+import json
+import os
+
+import lambda_runtime
+
+
+class InvocationError(Exception):
+    pass
+
+
+class LambdaInvoker:
+    # each worker gets its own container, and so its own per-host rate limit
+    separate_containers = True
+
+    def __init__(self, function_name: str = None, lambda_client=None):
+        self.function_name = function_name or os.environ["AWS_LAMBDA_FUNCTION_NAME"]
+        if lambda_client is None:
+            # workers can run for the full Lambda timeout, and a retried
+            # invocation would crawl the shard twice
+            lambda_client = lambda_runtime.boto3_client(
+                "lambda",
+                read_timeout=910,
+                connect_timeout=10,
+                retries={"max_attempts": 0},
+            )
+        self.lambda_client = lambda_client
+
+    def invoke(self, payload: dict) -> dict:
+        resp = self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="RequestResponse",
+            Payload=json.dumps(payload, default=str).encode("UTF-8"),
+        )
+        body = resp["Payload"].read()
+        if "FunctionError" in resp:
+            raise InvocationError(f"{resp['FunctionError']}: {body[:500]}")
+        return json.loads(body) if body else {}
+
+
+class InProcessInvoker:
+    # workers share this process's fetcher and its rate limit
+    separate_containers = False
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def invoke(self, payload: dict) -> dict:
+        # round trip through JSON, as the Lambda API would
+        payload = json.loads(json.dumps(payload, default=str))
+        return json.loads(json.dumps(self.handler(payload, None), default=str))
@@ -3,6 +3,7 @@ locals {
   iam_role            = "lambda-role-crawler-govuk-reference-content-${terraform.workspace}"
   iam_policy          = "lambda-policy-crawler-govuk-reference-content-${terraform.workspace}"
   cron_trigger        = "0 5 ? * MON *"
+  incremental_trigger = "rate(15 minutes)"
   s3_processed_bucket = terraform.workspace == "production" ? "gc3-processed-a1205b9b-1e39-4d70" : "gccc-processed-a1205b9b-1e39-4d70"
 }
 
@@ -69,11 +70,26 @@ resource "aws_iam_policy" "lambda_policy" {
       },
       {
         Action = [
+          "s3:GetObject",
           "s3:PutObject"
         ]
         Effect   = "Allow"
         Resource = "arn:aws:s3:::${local.s3_processed_bucket}/govuk/objects/*"
       },
+      {
+        # so that reading a missing object (e.g. on the first run) gets
+        # NoSuchKey rather than AccessDenied
+        Action = [
+          "s3:ListBucket"
+        ]
+        Effect    = "Allow"
+        Resource  = "arn:aws:s3:::${local.s3_processed_bucket}"
+        Condition = {
+          StringLike = {
+            "s3:prefix" = ["govuk/objects/*"]
+          }
+        }
+      },
       {
         Action = [
           "lambda:InvokeFunction"
@@ -136,6 +152,18 @@ resource "aws_lambda_function" "lambda" {
     variables = {
       ENVIRONMENT         = terraform.workspace
       S3_PROCESSED_BUCKET = local.s3_processed_bucket
+
+      GOVUK_REQUESTS_PER_SECOND = "10"
+      GOVUK_MAX_RETRIES         = "4"
+
+      # comma separated: json, ndjson-gz, parquet (parquet needs pyarrow)
+      OUTPUT_FORMATS = "json,ndjson-gz"
+
+      FAN_OUT_SHARD_SIZE  = "100"
+      FAN_OUT_CONCURRENCY = "10"
+      # seconds of the coordinator's timeout kept back for merging the
+      # workers' output; workers stop before then
+      FAN_OUT_REDUCE_SECONDS = "120"
     }
   }
 }
@@ -159,3 +187,24 @@ resource "aws_lambda_permission" "allow_cloudwatch_to_call_lambda" {
   principal     = "events.amazonaws.com"
   source_arn    = aws_cloudwatch_event_rule.time_trigger.arn
 }
+
+resource "aws_cloudwatch_event_rule" "incremental_trigger" {
+  is_enabled          = terraform.workspace == "production"
+  name                = "${local.lambda_name}-incremental-trigger"
+  schedule_expression = local.incremental_trigger
+}
+
+resource "aws_cloudwatch_event_target" "incremental_lambda" {
+  rule      = aws_cloudwatch_event_rule.incremental_trigger.name
+  target_id = "${local.lambda_name}-incremental_lambda"
+  arn       = aws_lambda_function.lambda.arn
+  input     = jsonencode({ "incremental" : true })
+}
+
+resource "aws_lambda_permission" "allow_cloudwatch_to_call_lambda_incremental" {
+  statement_id  = "AllowIncrementalExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.incremental_trigger.arn
+}
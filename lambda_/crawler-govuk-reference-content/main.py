@@ -1,112 +1,546 @@
+import lambda_runtime
 import json
-import boto3
+import datetime
 import time
+import uuid
 import httpx
 import re
 import os
 
-s3 = boto3.resource("s3")
+from botocore.exceptions import ClientError
+from domain_index import build_domain_index, index_key
+from concurrent.futures import ThreadPoolExecutor
+from fetcher import Fetcher, FetchError
+from invokers import LambdaInvoker
+from org_graph import build_organisation_graph, graph_key, hierarchy_fields
+import output_formats
+from lambda_runtime import jprint
+
+s3 = lambda_runtime.boto3_resource("s3")
 processed_bucket = os.environ["S3_PROCESSED_BUCKET"]
 httpx_version = httpx.__version__
-httpx_client = httpx.Client(http2=True, follow_redirects=True)
+httpx_client = lambda_runtime.lazy(
+    lambda: httpx.Client(http2=True, follow_redirects=True), "httpx.Client"
+)
+# per host, and per container: a fan-out's workers share it between them
+govuk_requests_per_second = float(os.getenv("GOVUK_REQUESTS_PER_SECOND", "10"))
+fetcher = Fetcher(
+    httpx_client,
+    user_agent=f"httpx/{httpx_version} (Government Cyber Coordination Centre) github.com/co-cddo/gccc-infrastructure",
+    requests_per_second=govuk_requests_per_second,
+    max_retries=int(os.getenv("GOVUK_MAX_RETRIES", "4")),
+)
 key_prefix = "govuk/objects"
-
-
-def jprint(obj):
-    new_obj = {}
-    if type(obj) != dict:
-        obj = {"message": str(obj)}
-    if "_time" not in obj:
-        new_obj["_time"] = time.time()
-    for k in sorted(obj):
-        new_obj[k] = obj[k]
-    print(json.dumps(new_obj, default=str))
+# fields requested from the search API so that process_service() doesn't need
+# a content API request per service
+service_search_fields = [
+    "content_id",
+    "title",
+    "description",
+    "link",
+    "organisation_content_ids",
+    "public_timestamp",
+    "phase",
+    "first_published_at",
+    "public_updated_at",
+    "transaction_start_link",
+]
+# those of them process_service() needs; a search result missing any of them
+# (the search API leaves out fields without a value) is fetched from the
+# content API instead, rather than losing e.g. its start URL
+service_content_fields = [
+    "content_id",
+    "phase",
+    "first_published_at",
+    "transaction_start_link",
+]
+fan_out_shard_size = int(os.getenv("FAN_OUT_SHARD_SIZE", "100"))
+fan_out_concurrency = int(os.getenv("FAN_OUT_CONCURRENCY", "10"))
+# the coordinator waits for its workers within its own timeout, so workers
+# stop taking on entities (and unstarted shards are dropped) this long before
+# it, leaving time to reduce; whatever's left is failed and picked up again
+fan_out_reduce_seconds = float(os.getenv("FAN_OUT_REDUCE_SECONDS", "120"))
+# set to an InProcessInvoker to run the fan-out without the Lambda API
+invoker = None
+combined_formats = output_formats.parse_formats(os.getenv("OUTPUT_FORMATS", "json"))
+
+email_regex = re.compile(r"[\w\-\'\.]+@[\w\-\.]+\.\w+", re.IGNORECASE)
+domain_regex = re.compile(r"(@|://)(?P<domain>[\w\-\.]+\.\w+)", re.IGNORECASE)
 
 
 def get_url_dict(url: str) -> dict:
-    res = {}
-
-    ua = f"httpx/{httpx_version} (Government Cyber Coordination Centre) github.com/co-cddo/gccc-infrastructure"
-    resp = httpx_client.get(url, headers={"user-agent": ua})
-    if (
-        resp
-        and str(resp.status_code).startswith("2")
-        and resp.headers.get("content-type", "").startswith("application/json")
-    ):
-        res = resp.json()
-
-    return res
-
-
+    """
+    Returns {} for non-2xx or non-JSON responses, raises FetchError when a
+    retryable failure (429, 5xx, transport error) persists after retries.
+    """
+    return fetcher.get_json(url)
+
+
+def out_of_time(deadline) -> bool:
+    return deadline is not None and time.time() >= deadline
+
+
+def process_isolated(entities: list, func, label: str, deadline=None) -> tuple:
+    """
+    Run func over every entity so that one failure doesn't abort the crawl.
+    Entities that raise are retried once more at the end, once the transient
+    problem has had a chance to clear. Entities not reached by the deadline
+    (a time.time() value) count as failed. Returns (results, failed_entities).
+    """
+    results = []
+    failed = []
+    for i, entity in enumerate(entities):
+        if out_of_time(deadline):
+            jprint(f"{label}:out of time with {len(entities) - i} left")
+            return (results, failed + entities[i:])
+        try:
+            res = func(entity)
+        except Exception as e:
+            jprint(f"{label}:error:{e}")
+            failed.append(entity)
+            continue
+        if res:
+            results.append(res)
+
+    if failed:
+        jprint(f"{label}:retrying {len(failed)} failed")
+        retry = failed
+        failed = []
+        for i, entity in enumerate(retry):
+            if out_of_time(deadline):
+                return (results, failed + retry[i:])
+            try:
+                res = func(entity)
+            except Exception as e:
+                jprint(f"{label}:failed after retry:{e}")
+                failed.append(entity)
+                continue
+            if res:
+                results.append(res)
+
+    return (results, failed)
+
+
+@lambda_runtime.report_cold_start
 def lambda_handler(event, context):
-    if "detail-type" in event and event["detail-type"] == "Scheduled Event":
-        fetch_organisations()
-        fetch_services()
+    incremental = bool(event.get("incremental", False))
+
+    if "fan_out_worker" in event:
+        return run_fan_out_worker(event["fan_out_worker"])
+    elif "fan_out" in event and event["fan_out"]:
+        fan_out_crawl(context)
+    elif ("detail-type" in event and event["detail-type"] == "Scheduled Event") or (
+        incremental and "organisation" not in event and "service" not in event
+    ):
+        organisations = fetch_organisations(incremental=incremental)
+        services = fetch_services(incremental=incremental)
+        publish_domain_index(organisations + services)
     elif "organisation" in event:
-        fetch_organisations()
+        fetch_organisations(incremental=incremental)
     elif "service" in event:
-        fetch_services()
+        fetch_services(incremental=incremental)
     else:
         jprint("Don't know. Quitting.")
 
+    jprint({"message": "Fetch stats", "fetch_stats": fetcher.stats})
+
+
+def get_invoker():
+    global invoker
+    if invoker is None:
+        invoker = LambdaInvoker()
+    return invoker
+
+
+def fan_out_crawl(context=None) -> dict:
+    """
+    Map/reduce crawl: list everything here, hand shards of the listing to
+    worker invocations, then merge their partial outputs into the combined
+    files, hierarchy and domain index.
+    """
+    deadline = None
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000
+        deadline = time.time() + remaining - fan_out_reduce_seconds
+
+    run_id = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+    jprint(f"Fan-out run: {run_id}")
+
+    organisations_raw = list_organisations()
+    organisation_pairs, organisation_graph = build_hierarchy(organisations_raw)
+    organisations_mark = max_timestamp(
+        o.get("updated_at", None) for o in organisations_raw
+    )
+
+    services_raw, failed_pages = list_services()
+    services_mark = max_timestamp(x.get("public_timestamp", None) for x in services_raw)
+
+    tasks = []
+    for shard, start in enumerate(range(0, len(organisations_raw), fan_out_shard_size)):
+        entities = organisations_raw[start : start + fan_out_shard_size]
+        content_ids = [o.get("details", {}).get("content_id", None) for o in entities]
+        tasks.append(
+            {
+                "run_id": run_id,
+                "kind": "organisations",
+                "shard": shard,
+                "entities": entities,
+                "organisation_pairs": organisation_pairs,
+                "graph_nodes": {
+                    cid: organisation_graph["nodes"][cid]
+                    for cid in content_ids
+                    if cid in organisation_graph["nodes"]
+                },
+            }
+        )
+    for shard, start in enumerate(range(0, len(services_raw), fan_out_shard_size)):
+        tasks.append(
+            {
+                "run_id": run_id,
+                "kind": "services",
+                "shard": shard,
+                "entities": services_raw[start : start + fan_out_shard_size],
+            }
+        )
+
+    # the per-host rate limit applies in each worker's container, so split it
+    # between the workers running at once
+    requests_per_second = govuk_requests_per_second
+    if get_invoker().separate_containers and tasks:
+        requests_per_second /= min(fan_out_concurrency, len(tasks))
+    for task in tasks:
+        task["requests_per_second"] = requests_per_second
+        task["deadline"] = deadline
+
+    jprint(f"Fan-out: invoking {len(tasks)} workers")
+    with ThreadPoolExecutor(max_workers=fan_out_concurrency) as executor:
+        results = list(executor.map(invoke_fan_out_worker, tasks))
+
+    return reduce_fan_out(
+        tasks, results, organisations_mark, services_mark, len(failed_pages)
+    )
 
-def fetch_services():
+
+def invoke_fan_out_worker(task: dict) -> dict:
+    if out_of_time(task.get("deadline", None)):
+        jprint(f"fan_out:{task['kind']}:{task['shard']}:out of time, not invoked")
+        return {}
     try:
-        count = 20
-        api_url = f"https://www.gov.uk/api/search.json?filter_format=transaction&count={count}&start="
-        init_services = get_url_dict(f"{api_url}0")
+        return get_invoker().invoke({"fan_out_worker": task})
+    except Exception as e:
+        jprint(f"fan_out:{task['kind']}:{task['shard']}:invocation error:{e}")
+        return {}
 
-        services_raw = init_services["results"]
-        entries = init_services["total"]
-        jprint(f"Found {entries} entries")
-        jprint("Processing from: 0")
 
-        while len(services_raw) < entries:
-            start = len(services_raw)
-            jprint(f"Processing from: {start}")
-            for_orgs = get_url_dict(f"{api_url}{start}")
-            services_raw.extend(for_orgs["results"])
-
-        simple_objects = []
-        full_objects = []
-
-        for service in services_raw:
-            link = service.get("link", None)
-            if link:
-                try:
-                    service["content"] = get_url_dict(
-                        f"https://www.gov.uk/api/content/{link.strip('/')}"
-                    )
-                except Exception as e:
-                    jprint(f"fetch_organisations:content API error:{e}")
-
-                so, fo = process_service(service)
-                simple_objects.append(so)
-                full_objects.append(fo)
-
-        if simple_objects:
-            simple_key = f"{key_prefix}/simple-combined/services-simple.json"
-
-            jprint(f"Writing s3://{processed_bucket}/{simple_key}")
-            s3object = s3.Object(processed_bucket, simple_key)
-            s3object.put(
-                Body=(
-                    b"\n".join([json.dumps(x).encode("UTF-8") for x in simple_objects])
-                )
+def fan_out_partial_key(run_id: str, kind: str, shard: int) -> str:
+    return f"{key_prefix}/fan-out/{run_id}/{kind}-{shard:05d}.json"
+
+
+def run_fan_out_worker(task: dict) -> dict:
+    kind = task["kind"]
+    label = f"fan_out:{kind}:{task['shard']}"
+    deadline = task.get("deadline", None)
+
+    fetcher.limiter.set_rate(
+        task.get("requests_per_second", None) or govuk_requests_per_second
+    )
+    try:
+        if kind == "organisations":
+            organisation_graph = {"nodes": task["graph_nodes"]}
+            full_objects, failed = process_isolated(
+                task["entities"],
+                lambda org: fetch_organisation(
+                    org, task["organisation_pairs"], organisation_graph
+                ),
+                label,
+                deadline,
             )
+            failed_ids = [o.get("details", {}).get("content_id", None) for o in failed]
+        else:
+            full_objects, failed = process_isolated(
+                task["entities"], fetch_service, label, deadline
+            )
+            failed_ids = [x.get("link", None) for x in failed]
+    finally:
+        # this container may run a whole crawl next
+        fetcher.limiter.set_rate(govuk_requests_per_second)
+
+    partial_key = fan_out_partial_key(task["run_id"], kind, task["shard"])
+    jprint(f"Writing s3://{processed_bucket}/{partial_key}")
+    s3object = s3.Object(processed_bucket, partial_key)
+    s3object.put(Body=output_formats.encode(full_objects, kind[:-1], "json"))
+
+    jprint({"message": "Fetch stats", "fetch_stats": fetcher.stats})
+    return {"key": partial_key, "processed": len(full_objects), "failed": failed_ids}
+
+
+def reduce_fan_out(
+    tasks: list,
+    results: list,
+    organisations_mark,
+    services_mark,
+    failed_service_pages: int,
+) -> dict:
+    full_objects = {"organisations": [], "services": []}
+    failed = {"organisations": [], "services": []}
+
+    for task, result in zip(tasks, results):
+        kind = task["kind"]
+        body = read_object(result["key"]) if result.get("key", None) else None
+        if body is None:
+            # the whole shard was lost
+            if kind == "organisations":
+                failed[kind].extend(
+                    o.get("details", {}).get("content_id", None)
+                    for o in task["entities"]
+                )
+            else:
+                failed[kind].extend(x.get("link", None) for x in task["entities"])
+            continue
+
+        full_objects[kind].extend(output_formats.decode(body, "json"))
+        failed[kind].extend(result.get("failed", []))
+
+    organisations = complete_organisations(
+        full_objects["organisations"],
+        failed_ids=failed["organisations"],
+        previous_objects={},
+        new_mark=organisations_mark,
+        changed=len(full_objects["organisations"]),
+    )
+    services = complete_services(
+        full_objects["services"],
+        failed=failed_service_pages + len(failed["services"]),
+        merge_previous=False,
+        new_mark=services_mark,
+        changed=len(full_objects["services"]),
+    )
+    publish_domain_index(organisations + services)
+
+    res = {
+        "organisations": len(organisations),
+        "services": len(services),
+        "failed_organisations": len(failed["organisations"]),
+        "failed_services": len(failed["services"]) + failed_service_pages,
+    }
+    jprint({"message": "Fan-out complete", **res})
+    return res
+
+
+def publish_domain_index(full_objects: list):
+    if not full_objects:
+        return
+
+    full_key = f"{key_prefix}/{index_key}"
+
+    jprint(f"Writing s3://{processed_bucket}/{full_key}")
+    s3object = s3.Object(processed_bucket, full_key)
+    s3object.put(Body=build_domain_index(full_objects))
+
+
+def list_services(high_water_mark=None) -> tuple:
+    """
+    Page through the search API listing of transactions. Returns
+    (services_raw, failed_pages); with a high water mark the listing is
+    ordered newest first and stops once it reaches the mark.
+    """
+    count = 20
+    search_url = "https://www.gov.uk/api/search.json?filter_format=transaction"
+    if high_water_mark:
+        # newest first, so the listing can stop at the high water mark
+        search_url = f"{search_url}&order=-public_timestamp"
+    fields = "".join([f"&fields={x}" for x in service_search_fields])
 
-        if full_objects:
-            full_key = f"{key_prefix}/services-combined/services-full.json"
+    api_url = f"{search_url}{fields}&count={count}&start="
+    init_services = get_url_dict(f"{api_url}0")
+    if "results" not in init_services:
+        jprint("fetch_services:search API rejected fields, not projecting")
+        api_url = f"{search_url}&count={count}&start="
+        init_services = get_url_dict(f"{api_url}0")
 
-            jprint(f"Writing s3://{processed_bucket}/{full_key}")
-            s3object = s3.Object(processed_bucket, full_key)
-            s3object.put(
-                Body=(b"\n".join([json.dumps(x).encode("UTF-8") for x in full_objects]))
+    services_raw = init_services["results"]
+    entries = init_services["total"]
+    jprint(f"Found {entries} entries")
+    jprint("Processing from: 0")
+
+    failed_pages = []
+    start = len(services_raw)
+    reached_mark = high_water_mark and is_before_mark(services_raw, high_water_mark)
+    while start < entries and not reached_mark:
+        jprint(f"Processing from: {start}")
+        try:
+            for_orgs = get_url_dict(f"{api_url}{start}")
+        except FetchError as e:
+            jprint(f"fetch_services:search API error:{e}")
+            failed_pages.append(start)
+            start += count
+            continue
+        if not for_orgs.get("results", []):
+            break
+        services_raw.extend(for_orgs["results"])
+        start += len(for_orgs["results"])
+        reached_mark = high_water_mark and is_before_mark(
+            for_orgs["results"], high_water_mark
+        )
+
+    results, failed_pages = process_isolated(
+        failed_pages,
+        lambda x: get_url_dict(f"{api_url}{x}").get("results", []),
+        "fetch_services:search API",
+    )
+    for results_page in results:
+        services_raw.extend(results_page)
+
+    return (services_raw, failed_pages)
+
+
+def list_service_ids():
+    """
+    The content ids of every transaction the search API lists, to tell which
+    previously crawled services gov.uk has since removed, or None if the
+    listing couldn't be completed.
+    """
+    count = 1000
+    api_url = (
+        "https://www.gov.uk/api/search.json?filter_format=transaction"
+        f"&fields=content_id&count={count}&start="
+    )
+    ids = set()
+    start = 0
+    while True:
+        try:
+            page = get_url_dict(f"{api_url}{start}")
+        except FetchError as e:
+            jprint(f"list_service_ids:search API error:{e}")
+            return None
+        results = page.get("results", [])
+        ids.update(x["content_id"] for x in results if x.get("content_id", None))
+        start += len(results)
+        if not results or start >= page.get("total", 0):
+            break
+    # an empty listing is more likely a search API problem than every
+    # service having gone
+    return ids or None
+
+
+def fetch_services(incremental: bool = False) -> list:
+    full_objects = []
+    try:
+        high_water_mark = None
+        if incremental:
+            high_water_mark = parse_timestamp(
+                load_crawl_state("services").get("high_water_mark", None)
             )
+            jprint(f"Services high water mark: {high_water_mark}")
+
+        services_raw, failed_pages = list_services(high_water_mark)
+
+        new_mark = max_timestamp(x.get("public_timestamp", None) for x in services_raw)
+
+        if high_water_mark:
+            services_raw = [
+                x
+                for x in services_raw
+                if is_after_mark(x.get("public_timestamp", None), high_water_mark)
+            ]
+            jprint(f"Found {len(services_raw)} changed services")
+
+        full_objects, failed = process_isolated(
+            services_raw, fetch_service, "fetch_services:content API"
+        )
+
+        full_objects = complete_services(
+            full_objects,
+            failed=len(failed_pages) + len(failed),
+            merge_previous=bool(high_water_mark),
+            new_mark=new_mark or (high_water_mark and high_water_mark.isoformat()),
+            changed=len(services_raw),
+        )
 
     except Exception as e:
         jprint(f"fetch_services:search API error:{e}")
 
+    return full_objects
+
+
+def complete_services(
+    full_objects: list, failed: int, merge_previous: bool, new_mark, changed: int
+) -> list:
+    """
+    Write the combined services files and, if nothing failed, move the high
+    water mark on.
+    """
+    if merge_previous or failed:
+        # the listing stopped early or something couldn't be fetched, so
+        # keep every previous service that wasn't re-fetched, unless gov.uk
+        # no longer lists it
+        full_objects = merge_objects(
+            read_combined(f"{key_prefix}/services-combined/services-full.json"),
+            full_objects,
+        )
+        listed_ids = list_service_ids()
+        if listed_ids is not None:
+            removed = [x["id"] for x in full_objects if x["id"] not in listed_ids]
+            if removed:
+                jprint(f"fetch_services:dropping {len(removed)} removed services")
+            full_objects = [x for x in full_objects if x["id"] in listed_ids]
+
+    write_combined(
+        full_objects,
+        f"{key_prefix}/simple-combined/services-simple.json",
+        f"{key_prefix}/services-combined/services-full.json",
+        "service",
+    )
+
+    if failed:
+        # leave the high water mark where it was so the next incremental
+        # run picks the failures up again
+        jprint(f"fetch_services:{failed} pages or services failed")
+    else:
+        save_crawl_state("services", {"high_water_mark": new_mark, "changed": changed})
+
+    return full_objects
+
+
+def projected_content(service: dict) -> dict:
+    """
+    Build the parts of the content API response that process_service() uses
+    from the fields projected onto the search result, or {} when the search
+    result doesn't carry all of them.
+    """
+    updated_at = service.get("public_updated_at", None) or service.get(
+        "public_timestamp", None
+    )
+    if updated_at is None or any(
+        service.get(x, None) is None for x in service_content_fields
+    ):
+        return {}
+
+    return {
+        "content_id": service["content_id"],
+        "phase": service["phase"],
+        "first_published_at": service["first_published_at"],
+        "public_updated_at": updated_at,
+        "details": {
+            "transaction_start_link": service["transaction_start_link"],
+        },
+    }
+
+
+def fetch_service(service: dict):
+    link = service.get("link", None)
+    if not link:
+        return None
+
+    service["content"] = projected_content(service)
+    if not service["content"]:
+        service["content"] = get_url_dict(
+            f"https://www.gov.uk/api/content/{link.strip('/')}"
+        )
+
+    res = process_service(service)
+    return res[1] if res else None
+
 
 def process_service(service: dict):
     content_id = service.get("content", {}).get("content_id", None)
@@ -160,66 +594,301 @@ def process_service(service: dict):
         return (simple_object, obj)
 
 
-def fetch_organisations():
-    try:
-        api_url = "https://www.gov.uk/api/organisations"
-        init_orgs = get_url_dict(api_url)
+def list_organisations() -> list:
+    """
+    Page through the organisations API. Raises FetchError if any page can't
+    be fetched: without the whole listing the hierarchy would be wrong and
+    missing organisations would be dropped from the combined files.
+    """
+    api_url = "https://www.gov.uk/api/organisations"
+    init_orgs = get_url_dict(api_url)
 
-        organisations_raw = init_orgs["results"]
-        jprint(f"Found {init_orgs['pages']} pages")
-        jprint(f"Processing page: {1}")
+    organisations_raw = init_orgs["results"]
+    jprint(f"Found {init_orgs['pages']} pages")
+    jprint(f"Processing page: {1}")
 
-        for page in range(2, init_orgs["pages"] + 1):
-            jprint(f"Processing page: {page}")
+    failed_pages = []
+    for page in range(2, init_orgs["pages"] + 1):
+        jprint(f"Processing page: {page}")
+        try:
             for_orgs = get_url_dict(f"{api_url}?page={page}")
-            organisations_raw.extend(for_orgs["results"])
+        except FetchError as e:
+            jprint(f"fetch_organisations:organisations API error:{e}")
+            failed_pages.append(page)
+            continue
+        organisations_raw.extend(for_orgs.get("results", []))
+
+    results, failed_pages = process_isolated(
+        failed_pages,
+        lambda x: get_url_dict(f"{api_url}?page={x}").get("results", []),
+        "fetch_organisations:organisations API",
+    )
+    if failed_pages:
+        raise FetchError(api_url, f"pages {failed_pages} failed")
+    for results_page in results:
+        organisations_raw.extend(results_page)
+
+    return organisations_raw
+
+
+def build_hierarchy(organisations_raw: list) -> tuple:
+    """
+    Resolve gov.uk API ids to content ids, build the organisation graph and
+    write it out. Returns (organisation_pairs, organisation_graph).
+    """
+    organisation_pairs = {
+        o["id"]: o["details"]["content_id"]
+        for o in organisations_raw
+        if o["id"] and o["details"] and "content_id" in o["details"]
+    }
+
+    organisation_graph = build_organisation_graph(organisations_raw, organisation_pairs)
+    if organisation_graph["cycles"]:
+        jprint(
+            {
+                "message": "Organisation cycles found",
+                "cycles": organisation_graph["cycles"],
+            }
+        )
 
-        organisation_pairs = {
-            o["id"]: o["details"]["content_id"]
-            for o in organisations_raw
-            if o["id"] and o["details"] and "content_id" in o["details"]
-        }
+    graph_full_key = f"{key_prefix}/{graph_key}"
+    jprint(f"Writing s3://{processed_bucket}/{graph_full_key}")
+    s3object = s3.Object(processed_bucket, graph_full_key)
+    s3object.put(Body=(bytes(json.dumps(organisation_graph).encode("UTF-8"))))
 
-        simple_objects = []
-        full_objects = []
+    return (organisation_pairs, organisation_graph)
 
-        for org in organisations_raw:
-            slug = org.get("details", {}).get("slug", None)
-            if slug:
-                try:
-                    org["content"] = get_url_dict(
-                        f"https://www.gov.uk/api/content/government/organisations/{slug}"
-                    )
-                except Exception as e:
-                    jprint(f"fetch_organisations:content API error:{e}")
-
-            so, fo = process_organisation(org, organisation_pairs)
-            simple_objects.append(so)
-            full_objects.append(fo)
-
-        if simple_objects:
-            simple_key = f"{key_prefix}/simple-combined/organisations-simple.json"
-
-            jprint(f"Writing s3://{processed_bucket}/{simple_key}")
-            s3object = s3.Object(processed_bucket, simple_key)
-            s3object.put(
-                Body=(
-                    b"\n".join([json.dumps(x).encode("UTF-8") for x in simple_objects])
-                )
+
+def fetch_organisations(incremental: bool = False) -> list:
+    full_objects = []
+    try:
+        high_water_mark = None
+        previous_objects = {}
+        if incremental:
+            high_water_mark = parse_timestamp(
+                load_crawl_state("organisations").get("high_water_mark", None)
             )
+            jprint(f"Organisations high water mark: {high_water_mark}")
+            if high_water_mark:
+                previous_objects = read_previous_organisations()
 
-        if full_objects:
-            full_key = f"{key_prefix}/organisations-combined/organisations-full.json"
+        organisations_raw = list_organisations()
+        organisation_pairs, organisation_graph = build_hierarchy(organisations_raw)
 
-            jprint(f"Writing s3://{processed_bucket}/{full_key}")
-            s3object = s3.Object(processed_bucket, full_key)
-            s3object.put(
-                Body=(b"\n".join([json.dumps(x).encode("UTF-8") for x in full_objects]))
-            )
+        new_mark = max_timestamp(o.get("updated_at", None) for o in organisations_raw)
+
+        to_process = []
+        for org in organisations_raw:
+            content_id = org.get("details", {}).get("content_id", None)
+            previous = previous_objects.get(content_id, None)
+            if (
+                high_water_mark
+                and previous
+                and not is_after_mark(org.get("updated_at", None), high_water_mark)
+                and not hierarchy_changed(previous, organisation_graph, content_id)
+            ):
+                full_objects.append(previous)
+            else:
+                to_process.append(org)
+
+        if high_water_mark:
+            jprint(f"Found {len(to_process)} changed organisations")
+
+        processed, failed = process_isolated(
+            to_process,
+            lambda org: fetch_organisation(org, organisation_pairs, organisation_graph),
+            "fetch_organisations:content API",
+        )
+        full_objects.extend(processed)
+
+        full_objects = complete_organisations(
+            full_objects,
+            failed_ids=[o.get("details", {}).get("content_id", None) for o in failed],
+            previous_objects=previous_objects,
+            new_mark=new_mark,
+            changed=len(to_process),
+        )
 
     except Exception as e:
         jprint(f"fetch_organisations:organisations API error:{e}")
 
+    return full_objects
+
+
+def complete_organisations(
+    full_objects: list, failed_ids: list, previous_objects: dict, new_mark, changed: int
+) -> list:
+    """
+    Keep the last good version of anything that couldn't be fetched, write
+    the combined organisations files and, if nothing failed, move the high
+    water mark on.
+    """
+    if failed_ids:
+        if not previous_objects:
+            previous_objects = read_previous_organisations()
+        for content_id in failed_ids:
+            if content_id in previous_objects:
+                full_objects.append(previous_objects[content_id])
+
+    write_combined(
+        full_objects,
+        f"{key_prefix}/simple-combined/organisations-simple.json",
+        f"{key_prefix}/organisations-combined/organisations-full.json",
+        "organisation",
+    )
+
+    if failed_ids:
+        jprint(f"fetch_organisations:{len(failed_ids)} organisations failed")
+    else:
+        save_crawl_state(
+            "organisations", {"high_water_mark": new_mark, "changed": changed}
+        )
+
+    return full_objects
+
+
+def fetch_organisation(
+    organisation: dict, organisation_pairs: dict, organisation_graph: dict
+):
+    slug = organisation.get("details", {}).get("slug", None)
+    if slug:
+        organisation["content"] = get_url_dict(
+            f"https://www.gov.uk/api/content/government/organisations/{slug}"
+        )
+
+    res = process_organisation(organisation, organisation_pairs, organisation_graph)
+    return res[1] if res else None
+
+
+def read_previous_organisations() -> dict:
+    return {
+        x["id"]: x
+        for x in read_combined(
+            f"{key_prefix}/organisations-combined/organisations-full.json"
+        )
+    }
+
+
+def hierarchy_changed(previous: dict, organisation_graph: dict, content_id: str):
+    """
+    An organisation needs re-processing when its position in the graph moved,
+    even if its own updated_at didn't (e.g. a new parent was added above it).
+    """
+    for k, v in hierarchy_fields(organisation_graph, content_id).items():
+        if previous.get(k, None) != v:
+            return True
+    return False
+
+
+def parse_timestamp(d):
+    """
+    A UTC datetime from an ISO 8601 timestamp, taking one without an offset
+    to be UTC, so that any two can be compared.
+    """
+    if d and type(d) == str:
+        try:
+            ts = datetime.datetime.fromisoformat(d.strip())
+        except ValueError:
+            return None
+        if ts.tzinfo is None:
+            return ts.replace(tzinfo=datetime.timezone.utc)
+        return ts.astimezone(datetime.timezone.utc)
+    return None
+
+
+def is_after_mark(d, high_water_mark) -> bool:
+    ts = parse_timestamp(d)
+    # entities without a timestamp are always treated as changed
+    return ts is None or ts > high_water_mark
+
+
+def is_before_mark(results: list, high_water_mark) -> bool:
+    ts = parse_timestamp(results[-1].get("public_timestamp", None)) if results else None
+    return ts is not None and ts <= high_water_mark
+
+
+def max_timestamp(values):
+    res = None
+    for ts in (parse_timestamp(v) for v in values):
+        if ts and (res is None or ts > res):
+            res = ts
+    return res.isoformat() if res else None
+
+
+def crawl_state_key(kind: str) -> str:
+    return f"{key_prefix}/crawl-state/{kind}.json"
+
+
+def read_object(key: str):
+    # a missing key is only reported as such (rather than AccessDenied) with
+    # s3:ListBucket, which the lambda's policy grants; any other error is
+    # raised, so as not to carry on as if there were no previous output
+    try:
+        return s3.Object(processed_bucket, key).get()["Body"].read()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code", None) in ["NoSuchKey", "404"]:
+            return None
+        raise
+
+
+def load_crawl_state(kind: str) -> dict:
+    body = read_object(crawl_state_key(kind))
+    return json.loads(body) if body else {}
+
+
+def save_crawl_state(kind: str, state: dict):
+    state["crawled_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    key = crawl_state_key(kind)
+    jprint(f"Writing s3://{processed_bucket}/{key}")
+    s3object = s3.Object(processed_bucket, key)
+    s3object.put(Body=(bytes(json.dumps(state).encode("UTF-8"))))
+
+
+def read_combined(key: str) -> list:
+    """
+    Read back a combined dataset in whichever configured format is cheapest
+    to decode, falling back to the others if it hasn't been written (e.g.
+    just after the format was added to OUTPUT_FORMATS).
+    """
+    for output_format in ["json", "ndjson-gz", "parquet"]:
+        if output_format in combined_formats:
+            body = read_object(output_formats.format_key(key, output_format))
+            if body:
+                return output_formats.decode(body, output_format)
+    return []
+
+
+def merge_objects(previous: list, changed: list) -> list:
+    merged = {x["id"]: x for x in previous}
+    for x in changed:
+        merged[x["id"]] = x
+    return list(merged.values())
+
+
+def write_combined(
+    full_objects: list, simple_key: str, full_key: str, record_type: str
+):
+    if not full_objects:
+        return
+
+    simple_objects = [{"id": x["id"], "type": x["type"]} for x in full_objects]
+
+    jprint(f"Writing s3://{processed_bucket}/{simple_key}")
+    s3object = s3.Object(processed_bucket, simple_key)
+    s3object.put(
+        Body=(b"\n".join([json.dumps(x).encode("UTF-8") for x in simple_objects]))
+    )
+
+    for output_format in combined_formats:
+        format_key = output_formats.format_key(full_key, output_format)
+
+        jprint(f"Writing s3://{processed_bucket}/{format_key}")
+        s3object = s3.Object(processed_bucket, format_key)
+        s3object.put(
+            Body=output_formats.encode(full_objects, record_type, output_format)
+        )
+
 
 def athena_datetime(d):
     if d:
@@ -232,42 +901,56 @@ def athena_datetime(d):
     return None
 
 
-def extract_emails(obj: dict):
-    res = []
-    for item in obj.values():
+def extract_entities(obj) -> tuple:
+    """
+    Walk an arbitrarily nested JSON value (dicts, lists and strings) once and
+    return a tuple of (emails, domains), both sorted and de-duplicated.
+    Domains are the normalised domain parts of the discovered emails.
+    """
+    emails = set()
+    stack = [obj]
+    while stack:
+        item = stack.pop()
         if type(item) == dict:
-            res.extend(extract_emails(item))
-        if type(item) == str:
-            if "@" in item:
-                email_search = re.finditer(
-                    r"[\w\-\'\.]+@[\w\-\.]+\.\w+",
-                    item,
-                    re.IGNORECASE | re.MULTILINE,
-                )
-                for email_result in email_search:
-                    email = email_result.group(0).lower()
-                    if email not in res:
-                        res.append(email)
-    return list(set(res))
+            stack.extend(item.values())
+        elif type(item) == list:
+            stack.extend(item)
+        elif type(item) == str and "@" in item:
+            # emails never contain whitespace, so only run the pattern over
+            # the tokens containing an "@" rather than the whole string
+            for token in item.split():
+                if "@" in token:
+                    for email_result in email_regex.finditer(token):
+                        emails.add(email_result.group(0).lower())
+
+    domains = {normalise_domain(email.rsplit("@", 1)[1]) for email in emails}
+    return (sorted(emails), sorted(domains))
+
+
+def extract_emails(obj: dict):
+    emails, _ = extract_entities(obj)
+    return emails
+
+
+def normalise_domain(domain: str) -> str:
+    domain = domain.lower().strip(".")
+    if domain.startswith("www."):
+        return domain[4:]
+    return domain
 
 
 def extract_domain(text: str):
     res = []
-    domain_search = re.finditer(
-        r"(@|://)(?P<domain>[\w\-\.]+\.\w+)", text, re.IGNORECASE | re.MULTILINE
-    )
-    for domain_result in domain_search:
-        domain = domain_result.groupdict().get("domain", None)
+    for domain_result in domain_regex.finditer(text):
+        domain = domain_result.group("domain")
         if domain:
-            domain = domain.lower()
-            if domain.startswith("www."):
-                res.append(domain[4:])
-            else:
-                res.append(domain)
+            res.append(normalise_domain(domain))
     return res
 
 
-def process_organisation(organisation: dict, organisation_pairs: dict):
+def process_organisation(
+    organisation: dict, organisation_pairs: dict, organisation_graph: dict = None
+):
     content_id = organisation.get("details", {}).get("content_id", None)
     if content_id:
         raw_key = f"{key_prefix}/organisation-raw/{content_id}.json"
@@ -280,7 +963,7 @@ def process_organisation(organisation: dict, organisation_pairs: dict):
         title = organisation.get("title", None)
         slug = organisation.get("details", {}).get("slug", None)
 
-        discovered_emails = extract_emails(organisation)
+        discovered_emails, discovered_domains = extract_entities(organisation)
 
         obj = {
             "id": content_id,
@@ -302,7 +985,7 @@ def process_organisation(organisation: dict, organisation_pairs: dict):
                 ),
             },
             "discovered_emails": discovered_emails,
-            "discovered_domains": [],
+            "discovered_domains": discovered_domains,
             "urls": [],
             "updated_at": athena_datetime(organisation.get("updated_at", None)),
         }
@@ -311,9 +994,6 @@ def process_organisation(organisation: dict, organisation_pairs: dict):
         if web_url:
             obj["urls"].append(web_url)
 
-        for email in discovered_emails:
-            obj["discovered_domains"].extend(extract_domain(email))
-
         for link in (
             organisation.get("content", {})
             .get("details", {})
@@ -372,6 +1052,8 @@ def process_organisation(organisation: dict, organisation_pairs: dict):
             if "id" in suping_org and suping_org["id"] in organisation_pairs:
                 obj["superseding"].append(organisation_pairs[suping_org["id"]])
 
+        obj.update(hierarchy_fields(organisation_graph or {}, content_id))
+
         # jprint(obj)
 
         simple_key = f"{key_prefix}/simple-individual/{content_id}.json"
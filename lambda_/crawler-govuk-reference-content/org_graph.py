@@ -0,0 +1,138 @@
+"""
+In-memory gov.uk organisation graph.
+
+Built once per crawl from the organisations listing so that each organisation
+can carry its full hierarchy (ancestors, descendants, root organisations and
+supersession chain) instead of only its direct relationships.
+"""
+
+from collections import deque
+
+graph_key = "organisations-graph/organisations-graph.json"
+
+
+def _resolve(refs: list, organisation_pairs: dict) -> list:
+    res = []
+    for ref in refs or []:
+        if "id" in ref and ref["id"] in organisation_pairs:
+            res.append(organisation_pairs[ref["id"]])
+    return res
+
+
+def _reachable(start: str, edges: dict) -> tuple:
+    """
+    Breadth-first walk from start, returning (nodes in discovery order,
+    whether start is reachable from itself).
+    """
+    seen = set()
+    order = []
+    cyclic = False
+    queue = deque(edges.get(start, []))
+    while queue:
+        node = queue.popleft()
+        if node == start:
+            cyclic = True
+            continue
+        if node in seen:
+            continue
+        seen.add(node)
+        order.append(node)
+        queue.extend(edges.get(node, []))
+    return (order, cyclic)
+
+
+def build_organisation_graph(organisations_raw: list, organisation_pairs: dict) -> dict:
+    """
+    Return {"nodes": {content_id: {...}}, "cycles": [[content_id, ...], ...]}.
+
+    Relationships are taken from both sides (a parent listing a child counts
+    the same as the child listing the parent) and each node gets:
+    parents, children, ancestors, descendants, root_organisations,
+    supersession_chain, hierarchy_cycle (it's its own ancestor) and
+    supersession_cycle (it supersedes itself, through the chain).
+    """
+    parents = {}
+    children = {}
+    superseding = {}
+
+    for cid in organisation_pairs.values():
+        parents[cid] = set()
+        children[cid] = set()
+        superseding[cid] = set()
+
+    for org in organisations_raw:
+        cid = organisation_pairs.get(org.get("id", None), None)
+        if not cid:
+            continue
+        for pid in _resolve(org.get("parent_organisations", []), organisation_pairs):
+            parents[cid].add(pid)
+            children[pid].add(cid)
+        for chid in _resolve(org.get("child_organisations", []), organisation_pairs):
+            children[cid].add(chid)
+            parents[chid].add(cid)
+        for sid in _resolve(
+            org.get("superseding_organisations", []), organisation_pairs
+        ):
+            superseding[cid].add(sid)
+        for sid in _resolve(
+            org.get("superseded_organisations", []), organisation_pairs
+        ):
+            superseding[sid].add(cid)
+
+    parent_edges = {k: sorted(v) for k, v in parents.items()}
+    child_edges = {k: sorted(v) for k, v in children.items()}
+    superseding_edges = {k: sorted(v) for k, v in superseding.items()}
+
+    nodes = {}
+    for cid in sorted(parent_edges):
+        ancestors, ancestor_cycle = _reachable(cid, parent_edges)
+        descendants, _ = _reachable(cid, child_edges)
+        supersession_chain, supersession_cycle = _reachable(cid, superseding_edges)
+
+        if parent_edges[cid]:
+            roots = [a for a in ancestors if not parent_edges.get(a)]
+        else:
+            roots = [cid]
+
+        nodes[cid] = {
+            "parents": parent_edges[cid],
+            "children": child_edges[cid],
+            "ancestors": ancestors,
+            "descendants": descendants,
+            "root_organisations": sorted(roots),
+            "supersession_chain": supersession_chain,
+            "hierarchy_cycle": ancestor_cycle,
+            "supersession_cycle": supersession_cycle,
+        }
+
+    # a node is in a cycle when it is its own ancestor; the cycle it belongs to
+    # is every node that is both its ancestor and its descendant
+    cycles = set()
+    for cid, node in nodes.items():
+        if node["hierarchy_cycle"]:
+            members = set(node["ancestors"]) & set(node["descendants"])
+            members.add(cid)
+            cycles.add(tuple(sorted(members)))
+
+    return {"nodes": nodes, "cycles": [list(c) for c in sorted(cycles)]}
+
+
+def hierarchy_fields(graph: dict, content_id: str) -> dict:
+    node = graph.get("nodes", {}).get(content_id, None)
+    if not node:
+        return {
+            "ancestors": [],
+            "descendants": [],
+            "root_organisations": [],
+            "supersession_chain": [],
+            "hierarchy_cycle": False,
+            "supersession_cycle": False,
+        }
+    return {
+        "ancestors": node["ancestors"],
+        "descendants": node["descendants"],
+        "root_organisations": node["root_organisations"],
+        "supersession_chain": node["supersession_chain"],
+        "hierarchy_cycle": node["hierarchy_cycle"],
+        "supersession_cycle": node["supersession_cycle"],
+    }
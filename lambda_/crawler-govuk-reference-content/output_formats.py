@@ -0,0 +1,140 @@
+"""
+Output formats for the combined crawler datasets.
+
+"json" is the original uncompressed NDJSON, "ndjson-gz" is the same records
+gzipped, and "parquet" uses the explicit schemas below. Each format is written
+under its own prefix so that each can back its own Athena table. Parquet needs
+pyarrow, which is only imported when that format is configured.
+"""
+
+import gzip
+import io
+import json
+
+default_formats = ["json"]
+
+organisation_schema = [
+    ("id", "string"),
+    ("type", "string"),
+    ("name", "string"),
+    ("description", "string"),
+    (
+        "also_known_as",
+        {"govuk_title": "string", "govuk_abbreviation": "string"},
+    ),
+    (
+        "other_identifiers",
+        {
+            "govuk_content_id": "string",
+            "govuk_slug": "string",
+            "govuk_analytics_identifier": "string",
+        },
+    ),
+    ("parents", ["string"]),
+    ("children", ["string"]),
+    ("superseded", ["string"]),
+    ("superseding", ["string"]),
+    ("statuses", {"govuk_status": "string", "govuk_closed_status": "string"}),
+    ("discovered_emails", ["string"]),
+    ("discovered_domains", ["string"]),
+    ("urls", ["string"]),
+    ("updated_at", "string"),
+    ("ancestors", ["string"]),
+    ("descendants", ["string"]),
+    ("root_organisations", ["string"]),
+    ("supersession_chain", ["string"]),
+    ("hierarchy_cycle", "boolean"),
+    ("supersession_cycle", "boolean"),
+]
+
+service_schema = [
+    ("id", "string"),
+    ("type", "string"),
+    ("name", "string"),
+    ("description", "string"),
+    ("owning_organisations", ["string"]),
+    ("urls", ["string"]),
+    ("discovered_domains", ["string"]),
+    ("statuses", {"phase": "string"}),
+    ("created_at", "string"),
+    ("updated_at", "string"),
+]
+
+schemas = {"organisation": organisation_schema, "service": service_schema}
+
+
+def parse_formats(value: str) -> list:
+    res = [x.strip().lower() for x in (value or "").split(",") if x.strip()]
+    for x in res:
+        if x not in encoders:
+            raise ValueError(f"Unknown output format: {x}")
+    return res or default_formats
+
+
+def format_key(full_key: str, output_format: str) -> str:
+    """
+    >>> format_key("govuk/objects/services-combined/services-full.json", "parquet")
+    'govuk/objects/services-combined-parquet/services-full.parquet'
+    """
+    if output_format == "json":
+        return full_key
+
+    folder, filename = full_key.rsplit("/", 1)
+    stem = filename.rsplit(".", 1)[0]
+    extension = {"ndjson-gz": "json.gz", "parquet": "parquet"}[output_format]
+    return f"{folder}-{output_format}/{stem}.{extension}"
+
+
+def encode_json(objects: list, record_type: str) -> bytes:
+    return b"\n".join([json.dumps(x).encode("UTF-8") for x in objects])
+
+
+def encode_ndjson_gz(objects: list, record_type: str) -> bytes:
+    # mtime=0 keeps the output deterministic for identical inputs
+    return gzip.compress(encode_json(objects, record_type), mtime=0)
+
+
+def arrow_type(pa, t):
+    if type(t) == dict:
+        return pa.struct([(k, arrow_type(pa, v)) for k, v in t.items()])
+    if type(t) == list:
+        return pa.list_(arrow_type(pa, t[0]))
+    return {"string": pa.string(), "boolean": pa.bool_()}[t]
+
+
+def arrow_schema(record_type: str):
+    import pyarrow as pa
+
+    return pa.schema([(k, arrow_type(pa, v)) for k, v in schemas[record_type]])
+
+
+def encode_parquet(objects: list, record_type: str) -> bytes:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pylist(objects, schema=arrow_schema(record_type))
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="snappy")
+    return buffer.getvalue()
+
+
+encoders = {
+    "json": encode_json,
+    "ndjson-gz": encode_ndjson_gz,
+    "parquet": encode_parquet,
+}
+
+
+def encode(objects: list, record_type: str, output_format: str) -> bytes:
+    return encoders[output_format](objects, record_type)
+
+
+def decode(body: bytes, output_format: str) -> list:
+    if output_format == "parquet":
+        import pyarrow.parquet as pq
+
+        return pq.read_table(io.BytesIO(body)).to_pylist()
+
+    if output_format == "ndjson-gz":
+        body = gzip.decompress(body)
+    return [json.loads(line) for line in body.split(b"\n") if line.strip()]
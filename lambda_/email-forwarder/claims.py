@@ -0,0 +1,156 @@
+"""
+Idempotency claims for incoming emails, keyed by SES message id.
+
+A claim is taken with an atomic conditional write before an email is
+forwarded. A claim is "processing" until the forward completes, when it
+becomes "done", and retried invocations for a done message skip it. One that
+finds the message still processing raises ClaimInProgress instead, so that it
+fails and is retried later rather than dropping the email if the invocation
+holding the claim never finishes. A processing claim that has outlived its
+TTL (e.g. the invocation that took it timed out) can be taken over, so the
+TTL should be no longer than the function's timeout. Claims are released on
+failure so that SES retries can try again.
+
+Reading a claim that doesn't exist only gets NoSuchKey (rather than a 403
+AccessDenied) with s3:ListBucket on the bucket, which the lambda's policy
+grants through s3:List*.
+"""
+
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+conflict_codes = ["PreconditionFailed", "ConditionalRequestConflict", "412", "409"]
+
+# the first botocore whose PutObject takes IfNoneMatch and IfMatch; older ones
+# (as bundled with some Lambda runtimes) reject them before sending anything,
+# so requirements.txt pins a newer one to package with the lambda
+min_botocore_version = (1, 35, 16)
+
+
+def version_tuple(version: str) -> tuple:
+    return tuple(int(x) for x in version.split(".")[:3] if x.isdigit())
+
+
+class ClaimInProgress(Exception):
+    pass
+
+
+class InMemoryClaimStore:
+    def __init__(self, ttl: int = 120, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.claims = {}
+        self.lock = threading.Lock()
+
+    def claim(self, message_id: str) -> bool:
+        with self.lock:
+            existing = self.claims.get(message_id, None)
+            if existing and existing["status"] == "done":
+                return False
+            if existing and existing["expires_at"] > self.clock():
+                raise ClaimInProgress(message_id)
+            self.claims[message_id] = {
+                "status": "processing",
+                "expires_at": self.clock() + self.ttl,
+            }
+            return True
+
+    def complete(self, message_id: str):
+        with self.lock:
+            self.claims[message_id] = {"status": "done", "expires_at": None}
+
+    def release(self, message_id: str):
+        with self.lock:
+            self.claims.pop(message_id, None)
+
+
+class S3ClaimStore:
+    """
+    Claims stored as small objects next to the emails, using S3 conditional
+    writes (If-None-Match to create, If-Match to take over an expired claim).
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        prefix: str = "claims/",
+        ttl: int = 120,
+        clock=time.time,
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl = ttl
+        self.clock = clock
+
+    def key(self, message_id: str) -> str:
+        return f"{self.prefix}{message_id}"
+
+    def body(self, status: str) -> bytes:
+        return json.dumps(
+            {
+                "status": status,
+                "expires_at": (
+                    self.clock() + self.ttl if status == "processing" else None
+                ),
+            }
+        ).encode("utf-8")
+
+    def claim(self, message_id: str) -> bool:
+        """
+        True if claimed, False if the message is done, raising ClaimInProgress
+        if another invocation holds it.
+        """
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.key(message_id),
+                Body=self.body("processing"),
+                IfNoneMatch="*",
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in conflict_codes:
+                raise
+
+        try:
+            existing = self.s3_client.get_object(
+                Bucket=self.bucket, Key=self.key(message_id)
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                # released between our write and read; let the next retry have it
+                raise ClaimInProgress(message_id) from e
+            raise
+
+        current = json.loads(existing["Body"].read() or b"{}")
+        if current.get("status", None) == "done":
+            return False
+        if (current.get("expires_at", None) or 0) > self.clock():
+            raise ClaimInProgress(message_id)
+
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.key(message_id),
+                Body=self.body("processing"),
+                IfMatch=existing["ETag"],
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in conflict_codes:
+                raise
+            # another invocation took it over first
+            raise ClaimInProgress(message_id) from e
+
+    def complete(self, message_id: str):
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.key(message_id), Body=self.body("done")
+        )
+
+    def release(self, message_id: str):
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.key(message_id))
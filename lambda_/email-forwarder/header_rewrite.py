@@ -0,0 +1,112 @@
+"""
+Byte-level header rewrite for forwarded emails.
+
+Instead of parsing the whole email into a Message and rendering it again,
+split the raw bytes at the blank line that ends the headers and rewrite only
+the header block. Header fields that are kept are copied byte for byte, and
+the body is passed through untouched.
+"""
+
+dropped_headers = [
+    "dkim-signature",
+    "from",
+    "reply-to",
+    "return-path",
+    "to",
+    "sender",
+    "x-original-sender",
+]
+renamed_headers = ["received-spf", "authentication-results"]
+sender_headers = ["from", "reply-to", "sender", "return-path", "x-original-sender"]
+
+
+def split_message(raw: bytes) -> tuple:
+    """
+    Return (header_block, body_offset, line_ending). The header block excludes
+    the blank separator line; the body starts at body_offset.
+    """
+    candidates = []
+    for separator in [b"\r\n\r\n", b"\n\n"]:
+        idx = raw.find(separator)
+        if idx != -1:
+            candidates.append((idx, separator))
+
+    if not candidates:
+        line_ending = b"\r\n" if b"\r\n" in raw else b"\n"
+        return (raw, len(raw), line_ending)
+
+    idx, separator = min(candidates)
+    line_ending = separator[: len(separator) // 2]
+    return (raw[: idx + len(line_ending)], idx + len(separator), line_ending)
+
+
+def split_fields(header_block: bytes) -> list:
+    """
+    Split a header block into raw fields, keeping folded continuation lines
+    and line endings with the field they belong to. Returns a list of
+    (lowercase name, raw field bytes).
+    """
+    fields = []
+    for line in header_block.splitlines(keepends=True):
+        if line[:1] in (b" ", b"\t") and fields:
+            fields[-1][1].append(line)
+        elif line.strip():
+            name = line.split(b":", 1)[0].strip().lower().decode("ascii", "replace")
+            fields.append((name, [line]))
+    return [(name, b"".join(lines)) for name, lines in fields]
+
+
+def field_value(raw_field: bytes) -> str:
+    """The unfolded value of a raw header field."""
+    value = raw_field.split(b":", 1)[1] if b":" in raw_field else b""
+    return " ".join(value.decode("utf-8", "surrogateescape").split())
+
+
+def get_sender_field(fields: list):
+    for header in sender_headers:
+        for name, raw_field in fields:
+            if name == header:
+                return raw_field
+    return None
+
+
+def rewrite_headers(raw: bytes, original_recipient: str, system_domain: str):
+    """
+    Apply the forwarding header changes to a raw email:
+
+    - Received-SPF and Authentication-Results become X-SES-*
+    - DKIM-Signature, From, Reply-To, Return-Path, To, Sender and
+      X-Original-Sender are dropped
+    - From, Reply-To and To are added
+
+    Returns the new raw email as bytes, or None if there is no sender.
+    """
+    header_block, body_offset, line_ending = split_message(raw)
+    fields = split_fields(header_block)
+
+    sender_field = get_sender_field(fields)
+    if sender_field is None:
+        return None
+    sender = field_value(sender_field)
+    sender_raw = sender_field.split(b":", 1)[1].strip()
+
+    new_headers = []
+    for name, raw_field in fields:
+        if name in renamed_headers:
+            new_headers.append(b"X-SES-" + raw_field)
+        elif name not in dropped_headers:
+            new_headers.append(raw_field)
+
+    recipient = original_recipient.encode("utf-8")
+    if system_domain and system_domain in sender:
+        new_headers.append(b"From: " + sender_raw + line_ending)
+    else:
+        new_headers.append(b"From: " + recipient + line_ending)
+    new_headers.append(b"Reply-To: " + sender_raw + line_ending)
+    new_headers.append(b"To: " + recipient + line_ending)
+    new_headers.append(line_ending)
+
+    # the body is sliced through a memoryview so it is only copied once, into
+    # the output
+    new_headers.append(memoryview(raw)[body_offset:])
+    return b"".join(new_headers)
@@ -1,14 +1,10 @@
-data "archive_file" "lambda_zip" {
-  type        = "zip"
-  source_file = "main.py"
-  output_path = "lambda.zip"
-}
-
+# built by build.sh, which packages a boto3 new enough for the claims' S3
+# conditional writes rather than relying on the runtime's bundled one
 resource "aws_lambda_function" "lambda" {
   provider = aws.eu_west_1
 
-  filename         = "lambda.zip"
-  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
+  filename         = "target.zip"
+  source_code_hash = filebase64sha256("target.zip")
 
   description   = "${terraform.workspace}: Email Forwarding"
   function_name = local.lambda_name
@@ -113,6 +109,15 @@ resource "aws_iam_policy" "lambda_policy" {
           "arn:aws:s3:::mailbox.${local.email_domain}",
         ],
       },
+      {
+        Action = [
+          "sqs:ReceiveMessage",
+          "sqs:DeleteMessage",
+          "sqs:GetQueueAttributes"
+        ]
+        Effect   = "Allow"
+        Resource = aws_sqs_queue.incoming.arn
+      },
       {
         Action = [
           "ses:SendRawEmail"
@@ -148,3 +153,108 @@ data "aws_iam_policy_document" "arpd" {
     }
   }
 }
+
+# SES notifications can also arrive in batches through SQS (SES -> SNS -> SQS),
+# so bursts are absorbed by the queue rather than one invocation per email.
+# To switch over, set the receipt rule's S3 action (in the inbound rule set,
+# which is managed outside this module) to notify this topic, and remove its
+# Lambda action.
+resource "aws_sns_topic" "incoming" {
+  provider = aws.eu_west_1
+  name     = "${local.lambda_name}-incoming"
+}
+
+resource "aws_sns_topic_policy" "incoming" {
+  provider = aws.eu_west_1
+  arn      = aws_sns_topic.incoming.arn
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action = [
+          "sns:Publish"
+        ]
+        Effect = "Allow"
+        Principal = {
+          Service = "ses.amazonaws.com"
+        }
+        Resource = aws_sns_topic.incoming.arn
+        Condition = {
+          StringEquals = {
+            "AWS:SourceAccount" = data.aws_caller_identity.current.account_id
+          }
+          ArnLike = {
+            "AWS:SourceArn" = "arn:aws:ses:eu-west-1:${data.aws_caller_identity.current.account_id}:receipt-rule-set/inbound-${terraform.workspace}:receipt-rule/*"
+          }
+        }
+      },
+    ]
+  })
+}
+
+resource "aws_sns_topic_subscription" "incoming" {
+  provider  = aws.eu_west_1
+  topic_arn = aws_sns_topic.incoming.arn
+  protocol  = "sqs"
+  endpoint  = aws_sqs_queue.incoming.arn
+}
+
+resource "aws_sqs_queue_policy" "incoming" {
+  provider  = aws.eu_west_1
+  queue_url = aws_sqs_queue.incoming.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action = [
+          "sqs:SendMessage"
+        ]
+        Effect = "Allow"
+        Principal = {
+          Service = "sns.amazonaws.com"
+        }
+        Resource = aws_sqs_queue.incoming.arn
+        Condition = {
+          ArnEquals = {
+            "aws:SourceArn" = aws_sns_topic.incoming.arn
+          }
+        }
+      },
+    ]
+  })
+}
+
+resource "aws_sqs_queue" "incoming_dlq" {
+  provider = aws.eu_west_1
+  name     = "${local.lambda_name}-incoming-dlq"
+
+  message_retention_seconds = 1209600
+}
+
+resource "aws_sqs_queue" "incoming" {
+  provider = aws.eu_west_1
+  name     = "${local.lambda_name}-incoming"
+
+  visibility_timeout_seconds = 720
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.incoming_dlq.arn
+    maxReceiveCount     = 5
+  })
+}
+
+resource "aws_lambda_event_source_mapping" "incoming" {
+  provider         = aws.eu_west_1
+  event_source_arn = aws_sqs_queue.incoming.arn
+  function_name    = aws_lambda_function.lambda.arn
+
+  batch_size                         = 10
+  maximum_batching_window_in_seconds = 5
+  function_response_types            = ["ReportBatchItemFailures"]
+
+  scaling_config {
+    maximum_concurrency = 5
+  }
+}
@@ -1,56 +1,74 @@
+import lambda_runtime
 import os
-import boto3
 import json
 import time
-import random
+import copy
 import email
+import email.message
+import email.parser
 
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
-from botocore.client import Config
+from claims import S3ClaimStore
+from header_rewrite import rewrite_headers, split_message
+from routing import RoutingConfigLoader
+from send_scheduler import SendError, SendScheduler
 
 region = os.getenv("Region", None)
 incoming_email_bucket = os.getenv("MailS3Bucket", None)
 system_domain = os.getenv("MailSenderDomain", None)
 
-client_s3 = boto3.client("s3", config=Config(signature_version="s3v4"))
+# built on first use and reused across warm invocations
+client_s3 = lambda_runtime.boto3_client("s3", signature_version="s3v4")
+# SendScheduler does all the retrying, throttles included, so botocore makes
+# one attempt per send
+client_ses = lambda_runtime.boto3_client(
+    "ses", region_name=region, retries={"total_max_attempts": 1, "mode": "standard"}
+)
+send_scheduler = None
+
+# SES account maximum send rate (per second) and attempts per send
+ses_max_send_rate = float(os.getenv("SESMaxSendRate", "14"))
+ses_send_max_attempts = int(os.getenv("SESSendMaxAttempts", "5"))
+
+# SES SendRawEmail rejects anything larger; these are forwarded as a notice
+# pointing at the stored email instead
+max_raw_message_bytes = int(os.getenv("MaxRawMessageBytes", str(10 * 1024 * 1024)))
+# how much of an oversized email is read to find its headers
+max_header_bytes = 256 * 1024
+
+# how many records from a batch are processed at once
+record_workers = int(os.getenv("RecordWorkers", "4"))
+
+# no longer than the function's timeout (lambda.tf), so that the claim of an
+# invocation that timed out has expired by the time SES retries it
+claim_ttl = int(os.getenv("ClaimTTLSeconds", "120"))
+# replaced with an InMemoryClaimStore in tests
+claim_store = None
+
+# SES writes the email to S3 before invoking us, but the object isn't always
+# readable straight away
+s3_read_delays = [0.1, 0.2, 0.4, 0.8, 1.6]
 
 forward_mapping = {
     "contact": {
         "system_email": "contact@gccc.zendesk.com",
         "reply_from": "contact@gc3.security.gov.uk",
     },
-    "security": {
-        "system_email": "contact@gccc.zendesk.com",
-        "reply_from": "contact@gc3.security.gov.uk",
-    },
+    "security": "contact",
     "im": {
         "system_email": "im@gccc.zendesk.com",
         "reply_from": "im@gc3.security.gov.uk",
     },
-    "report": {
-        "system_email": "im@gccc.zendesk.com",
-        "reply_from": "im@gc3.security.gov.uk",
-    },
-    "incident": {
-        "system_email": "im@gccc.zendesk.com",
-        "reply_from": "im@gc3.security.gov.uk",
-    },
-    "incidents": {
-        "system_email": "im@gccc.zendesk.com",
-        "reply_from": "im@gc3.security.gov.uk",
-    },
+    "report": "im",
+    "incident": "im",
+    "incidents": "im",
     "vm": {
         "system_email": "vm@gccc.zendesk.com",
         "reply_from": "vm@gc3.security.gov.uk",
     },
-    "vulnerability": {
-        "system_email": "vm@gccc.zendesk.com",
-        "reply_from": "vm@gc3.security.gov.uk",
-    },
-    "vulnerabilities": {
-        "system_email": "vm@gccc.zendesk.com",
-        "reply_from": "vm@gc3.security.gov.uk",
-    },
+    "vulnerability": "vm",
+    "vulnerabilities": "vm",
     "data": {
         "system_email": "data@gccc.zendesk.com",
         "reply_from": "data@gc3.security.gov.uk",
@@ -58,11 +76,8 @@ forward_mapping = {
     "threat": {
         "system_email": "threat@gccc.zendesk.com",
         "reply_from": "threat@gc3.security.gov.uk",
-    },  
-    "tm": {
-        "system_email": "threat@gccc.zendesk.com",
-        "reply_from": "threat@gc3.security.gov.uk",
     },
+    "tm": "threat",
     "tech": {
         "system_email": "tech@gccc.zendesk.com",
         "reply_from": "tech@gc3.security.gov.uk",
@@ -74,14 +89,48 @@ forward_mapping = {
 }
 
 _asam = os.getenv("allowed_send_as_emails", "")
-allowed_send_as_emails = [x.lower().strip() for x in _asam.split(",") if "@" in x]
+allowed_send_as_emails = {x.lower().strip() for x in _asam.split(",") if "@" in x}
+
+# RoutingConfigS3Uri (s3://bucket/key) or RoutingConfig (JSON) replace the
+# built-in routes above; see routing.py for the format
+routing = RoutingConfigLoader(
+    default_config={"routes": forward_mapping},
+    config_json=os.getenv("RoutingConfig", None),
+    s3_uri=os.getenv("RoutingConfigS3Uri", None),
+    s3_client=client_s3,
+    ttl=int(os.getenv("RoutingConfigTTLSeconds", "300")),
+)
 
 
 def get_forward_mappings(email: str) -> dict:
-    for fm in forward_mapping:
-        if email.startswith(f"{fm}@"):
-            return forward_mapping[fm]
-    return {}
+    return routing.get().lookup(email)
+
+
+def is_send_as_allowed(sender_email) -> bool:
+    if sender_email in allowed_send_as_emails:
+        return True
+    return routing.get().is_send_as_allowed(sender_email)
+
+
+def group_destinations(destinations: list) -> dict:
+    """
+    Resolve recipients to their forward mappings, keeping one entry per
+    system_email so that e.g. contact@ and security@ on the same email only
+    forward it once. Returns {system_email: reply_from}.
+    """
+    res = {}
+    for dest in destinations:
+        mapped_email = get_forward_mappings(dest)
+        if mapped_email and mapped_email["system_email"] not in res:
+            res[mapped_email["system_email"]] = mapped_email["reply_from"]
+    return res
+
+
+def get_claim_store():
+    global claim_store
+    if claim_store is None:
+        claim_store = S3ClaimStore(client_s3, incoming_email_bucket, ttl=claim_ttl)
+    return claim_store
 
 
 def get_message_from_s3(object_path):
@@ -89,17 +138,60 @@ def get_message_from_s3(object_path):
         f"https://s3.{region}.amazonaws.com/{incoming_email_bucket}/{object_path}"
     )
 
-    # Get the email object from the S3 bucket.
-    object_s3 = client_s3.get_object(Bucket=incoming_email_bucket, Key=object_path)
-    # Read the content of the message.
-    file = object_s3["Body"].read()
+    # Get the email object from the S3 bucket, with a short bounded backoff
+    # while the object isn't there yet.
+    object_s3 = None
+    for delay in s3_read_delays + [None]:
+        try:
+            object_s3 = client_s3.get_object(
+                Bucket=incoming_email_bucket, Key=object_path
+            )
+            break
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey" or delay is None:
+                raise
+            time.sleep(delay)
+
+    size = object_s3.get("ContentLength", None)
+    file_dict = {
+        "path": object_http_path,
+        "key": object_path,
+        "size": size,
+        "oversized": bool(size and size > max_raw_message_bytes),
+    }
+
+    # Read the content of the message, or only its headers if it's too big to
+    # forward anyway.
+    if file_dict["oversized"]:
+        file_dict["file"] = read_header_block(object_s3["Body"])
+        object_s3["Body"].close()
+    else:
+        file_dict["file"] = object_s3["Body"].read()
 
-    file_dict = {"file": file, "path": object_http_path}
-    print(json.dumps(file_dict, default=str))
+    # log metadata only, never the message itself
+    print(json.dumps({k: v for k, v in file_dict.items() if k != "file"}))
 
     return file_dict
 
 
+def read_header_block(body, chunk_size: int = 16 * 1024) -> bytes:
+    """
+    Read from a stream until the blank line that ends the headers, without
+    reading the rest of the message.
+    """
+    data = b""
+    while len(data) < max_header_bytes:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        data += chunk
+        for separator in [b"\r\n\r\n", b"\n\n"]:
+            end = data.find(separator)
+            if end != -1:
+                return data[: end + len(separator)]
+    return data
+
+
 def get_send_as_destinations_from_plain_text(text):
     res = {
         "to": [],
@@ -180,7 +272,7 @@ def process_send_as_email(mailobject, from_address: str = None, filename: str =
             )
         # get and add attachments here
 
-    print("recipient_attachment:", recipient_attachment)
+    print("recipient_attachment:", len(recipient_attachment or b""), "bytes")
 
     if recipient_attachment:
         res.update(get_send_as_destinations_from_plain_text(recipient_attachment))
@@ -221,22 +313,99 @@ def extract_email_addresses(raw_email):
     return res
 
 
-def create_message(file_dict, new_to_email, original_recipient):
-    message = {}
+def get_sender(mailobject):
+    for header in ["From", "Reply-To", "Sender", "Return-Path", "X-Original-Sender"]:
+        sender = mailobject.get(header)
+        if sender is not None:
+            return sender
+    return None
 
-    # Parse the email body.
-    mailobject = email.message_from_bytes(file_dict["file"])
 
-    sender = mailobject.get("From")
-    if sender is None:
-        sender = mailobject.get("Reply-To")
-    if sender is None:
-        sender = mailobject.get("Sender")
-    if sender is None:
-        sender = mailobject.get("Return-Path")
+def create_oversized_notice(file_dict, new_to_email, original_recipient):
+    """
+    An email too large for SES is not forwarded; the destination gets a short
+    notice with the original headers and where the email is stored instead.
+    Only the header block of the email is needed.
+    """
+    headers = email.parser.BytesHeaderParser().parsebytes(file_dict["file"])
+
+    sender = get_sender(headers)
     if sender is None:
-        sender = mailobject.get("X-Original-Sender")
+        return None
+
+    def clean(value) -> str:
+        return " ".join(str(value or "").split())
+
+    notice = email.message.EmailMessage()
+    notice["Subject"] = f"[Too large to forward] {clean(headers.get('Subject'))}"
+    notice["From"] = original_recipient
+    notice["Reply-To"] = clean(sender)
+    notice["To"] = original_recipient
+    notice.set_content(
+        "\n".join(
+            [
+                "An email was received that is too large to forward.",
+                "",
+                f"From: {clean(sender)}",
+                f"To: {clean(headers.get('To'))}",
+                f"Subject: {clean(headers.get('Subject'))}",
+                f"Date: {clean(headers.get('Date'))}",
+                f"Message-ID: {clean(headers.get('Message-ID'))}",
+                f"Size: {file_dict['size']} bytes",
+                "",
+                f"Stored at: s3://{incoming_email_bucket}/{file_dict['key']}",
+                file_dict["path"],
+            ]
+        )
+    )
 
+    return {
+        "Source": original_recipient,
+        "Destinations": [new_to_email],
+        "Data": notice.as_bytes(),
+    }
+
+
+def get_sender_email(raw: bytes):
+    """
+    The sender's address, from the header block only.
+    """
+    header_block, _, _ = split_message(raw)
+    sender = get_sender(email.parser.BytesHeaderParser().parsebytes(header_block))
+    _sender_emails = extract_email_addresses(sender)
+    if _sender_emails and len(_sender_emails) == 1:
+        return _sender_emails[0]
+    return None
+
+
+def create_forward_message(file_dict, new_to_email, original_recipient):
+    """
+    The same forward as create_message() for an email that isn't send-as, but
+    rewriting the header bytes directly so the body is never parsed or
+    re-encoded.
+    """
+    data = rewrite_headers(file_dict["file"], original_recipient, system_domain)
+    if data is None:
+        return None
+
+    return {
+        "Source": original_recipient,
+        "Destinations": [new_to_email],
+        "Data": data,
+    }
+
+
+def create_message(file_dict, new_to_email, original_recipient, mailobject=None):
+    message = {}
+
+    # Parse the email body, unless the caller already has. The headers are
+    # rewritten on a shallow copy so a parsed message can be shared between
+    # destinations.
+    if mailobject is None:
+        mailobject = email.message_from_bytes(file_dict["file"])
+    mailobject = copy.copy(mailobject)
+
+    sender = get_sender(mailobject)
     if sender is None:
         return None
 
@@ -248,18 +417,23 @@ def create_message(file_dict, new_to_email, original_recipient):
     print("sender_email:", sender_email)
 
     is_send_as = False
-    if sender_email and sender_email in allowed_send_as_emails:
+    if sender_email and is_send_as_allowed(sender_email):
         print("sender_email in allowed_send_as_emails!")
         psae = process_send_as_email(
             mailobject=mailobject, from_address=original_recipient, filename="send_as"
         )
-        print(psae)
+        print(
+            "send_as:",
+            psae["send_as"],
+            "destinations:",
+            psae["all_destinations"],
+        )
         if psae["send_as"]:
             is_send_as = True
             message = {
                 "Source": psae["from"],
                 "Destinations": psae["all_destinations"],
-                "Data": psae["new_mailobject"].as_string(),
+                "Data": psae["new_mailobject"].as_bytes(),
             }
 
     if not is_send_as:
@@ -297,79 +471,194 @@ def create_message(file_dict, new_to_email, original_recipient):
         message = {
             "Source": original_recipient,
             "Destinations": [new_to_email],
-            "Data": mailobject.as_string(),
+            "Data": mailobject.as_bytes(),
         }
 
     return message
 
 
-def send_email(message):
-    # Create a new SES client.
-    client_ses = boto3.client("ses", region)
+def get_ses_client():
+    return client_ses
 
-    # Send the email.
-    try:
-        # Provide the contents of the email.
-        response = client_ses.send_raw_email(
-            Source=message["Source"],
-            Destinations=message["Destinations"],
-            RawMessage={"Data": message["Data"]},
+
+def get_send_scheduler():
+    global send_scheduler
+    if send_scheduler is None:
+        send_scheduler = SendScheduler(
+            get_ses_client,
+            rate=ses_max_send_rate,
+            max_attempts=ses_send_max_attempts,
+            sleep=time.sleep,
         )
+    return send_scheduler
 
-    # Display an error if something goes wrong.
-    except ClientError as e:
-        output = e.response["Error"]["Message"]
-    else:
-        output = "Email sent! Message ID: " + response["MessageId"]
 
-    return output
+def send_email(message, claim_id: str = None) -> str:
+    """
+    Send a message through the scheduler. With a claim_id, the destination is
+    claimed first so that a retry of a partly forwarded email skips the
+    destinations that already succeeded.
+    """
+    store = get_claim_store()
+    if claim_id and not store.claim(claim_id):
+        return f"Already forwarded: {claim_id}"
 
+    try:
+        message_id = get_send_scheduler().send(message)
+    except Exception:
+        if claim_id:
+            store.release(claim_id)
+        raise
+
+    if claim_id:
+        store.complete(claim_id)
+    return "Email sent! Message ID: " + message_id
+
+
+def send_emails(messages: list, s3_key: str) -> list:
+    """
+    Send every message, raising SendError if any of them failed.
+    """
+    if len(messages) <= 1:
+        # nothing can have been partly sent, so no per-destination claims
+        return [send_email(message) for message in messages]
+
+    def send(message):
+        try:
+            return send_email(message, f"{s3_key}/{message['Destinations'][0]}")
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=min(len(messages), 4)) as executor:
+        results = list(executor.map(send, messages))
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    for result in results:
+        print(repr(result) if isinstance(result, Exception) else result)
+    if errors:
+        raise SendError(f"{len(errors)} of {len(messages)} sends failed") from errors[0]
+    return results
+
+
+def get_ses_record(record: dict) -> dict:
+    """
+    Return the SES "mail"/"receipt" notification from a record that was either
+    delivered by SES directly or through SQS (optionally via SNS).
+    """
+    if "ses" in record:
+        return record["ses"]
+
+    body = json.loads(record["body"])
+    if body.get("Type", None) == "Notification" and "Message" in body:
+        body = json.loads(body["Message"])
+    return body
+
+
+def process_record(ses_record: dict):
+    s3_key = ses_record["mail"]["messageId"]
+
+    store = get_claim_store()
+    if not store.claim(s3_key):
+        print("Email already processed:", s3_key)
+        return
 
-def lambda_handler(event, context):
-    print(json.dumps(event, default=str))
+    try:
+        file_dict = get_message_from_s3(s3_key)
+
+        destinations = [r.lower() for r in ses_record["receipt"]["recipients"]]
+        targets = group_destinations(destinations)
+
+        messages = []
+        if targets and file_dict["oversized"]:
+            print("Email too large to forward, sending notices:", file_dict["size"])
+            for system_email, reply_from in targets.items():
+                message = create_oversized_notice(file_dict, system_email, reply_from)
+                if message:
+                    messages.append(message)
+        elif targets:
+            # Only a send-as email needs the whole message parsed; everything
+            # else has its headers rewritten in place.
+            mailobject = None
+            if is_send_as_allowed(get_sender_email(file_dict["file"])):
+                mailobject = email.message_from_bytes(file_dict["file"])
+            for system_email, reply_from in targets.items():
+                # Create the message.
+                if mailobject is not None:
+                    message = create_message(
+                        file_dict, system_email, reply_from, mailobject=mailobject
+                    )
+                else:
+                    message = create_forward_message(
+                        file_dict, system_email, reply_from
+                    )
+                if message:
+                    messages.append(message)
+
+        for message in messages:
+            print(
+                json.dumps(
+                    {
+                        "Source": message["Source"],
+                        "Destinations": message["Destinations"],
+                        "Size": len(message["Data"]),
+                    }
+                )
+            )
+
+        # Send the emails and print the results.
+        for result in send_emails(messages, s3_key):
+            print(result)
+    except Exception:
+        # let a retry of this event claim it again
+        store.release(s3_key)
+        raise
+
+    store.complete(s3_key)
+
+    tag_proc_resp = client_s3.put_object_tagging(
+        Bucket=incoming_email_bucket,
+        Key=s3_key,
+        Tagging={
+            "TagSet": [
+                {"Key": "processed", "Value": "true"},
+            ]
+        },
+    )
 
-    # initial delay waiting for s3 and tagging
-    time.sleep(random.randrange(2, 10))
 
-    s3_key = event["Records"][0]["ses"]["mail"]["messageId"]
+def process_sqs_or_ses_record(record: dict):
+    return process_record(get_ses_record(record))
 
-    file_dict = get_message_from_s3(s3_key)
-    if not file_dict:
+
+@lambda_runtime.report_cold_start
+def lambda_handler(event, context):
+    print(json.dumps(event, default=str))
+
+    records = event.get("Records", [])
+    if not records:
         return
 
-    tag_resp = client_s3.get_object_tagging(Bucket=incoming_email_bucket, Key=s3_key)
-    email_processed = False
-    if "TagSet" in tag_resp:
-        for kv in tag_resp["TagSet"]:
-            if kv["Key"] == "processed":
-                email_processed = True
-                break
-
-    if not email_processed:
-        destinations = [
-            r.lower() for r in event["Records"][0]["ses"]["receipt"]["recipients"]
+    errors = []
+    with ThreadPoolExecutor(max_workers=min(len(records), record_workers)) as executor:
+        futures = [
+            executor.submit(process_sqs_or_ses_record, record) for record in records
         ]
-        for dest in destinations:
-            mapped_email = get_forward_mappings(dest)
-            if mapped_email:
-                # Create the message.
-                message = create_message(
-                    file_dict,
-                    mapped_email["system_email"],
-                    mapped_email["reply_from"],
-                )
-                if message:
-                    print(message)
-                    # Send the email and print the result.
-                    result = send_email(message)
-                    print(result)
-
-        tag_proc_resp = client_s3.put_object_tagging(
-            Bucket=incoming_email_bucket,
-            Key=s3_key,
-            Tagging={
-                "TagSet": [
-                    {"Key": "processed", "Value": "true"},
-                ]
-            },
-        )
+        for record, future in zip(records, futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("Record failed:", record.get("messageId", None), repr(e))
+                errors.append((record, e))
+    get_send_scheduler().emit_metrics()
+
+    if any(r.get("eventSource", None) == "aws:sqs" for r in records):
+        # partial batch response: only the failed messages go back on the queue
+        return {
+            "batchItemFailures": [
+                {"itemIdentifier": record["messageId"]} for record, _ in errors
+            ]
+        }
+
+    if errors:
+        # invoked by SES directly, so fail the invocation to get it retried
+        raise errors[0][1]
@@ -0,0 +1,183 @@
+"""
+Routing rules for incoming email, compiled into hash indexes.
+
+A routing config looks like:
+
+    {
+        "routes": {
+            "contact": {"system_email": "...", "reply_from": "..."},
+            "security": "contact",
+            "ollie@gc3.security.gov.uk": {"system_email": "...", "reply_from": "..."},
+            "*@gc3-staging.security.gov.uk": "contact",
+            "*": "contact"
+        },
+        "allowed_send_as_emails": ["someone@example.gov.uk"]
+    }
+
+Route keys are a local part on any domain ("contact"), an exact address
+("ollie@gc3.security.gov.uk"), a per-domain catch-all ("*@domain") or the
+global catch-all ("*"). A route's value is either a target or the key of
+another route (an alias). Lookups try the exact address, then the local part,
+then the domain catch-all, then the global catch-all: each a dict lookup.
+"""
+
+import json
+import time
+
+
+class RoutingConfigError(ValueError):
+    pass
+
+
+def validate_target(key: str, target) -> dict:
+    if type(target) != dict:
+        raise RoutingConfigError(f"{key}: target must be an object or alias")
+    for field in ["system_email", "reply_from"]:
+        value = target.get(field, None)
+        if not value or type(value) != str or "@" not in value:
+            raise RoutingConfigError(f"{key}: {field} must be an email address")
+    return {
+        "system_email": target["system_email"].lower().strip(),
+        "reply_from": target["reply_from"].lower().strip(),
+    }
+
+
+class RoutingTable:
+    def __init__(
+        self, exact: dict, local: dict, domain: dict, catch_all, send_as: frozenset
+    ):
+        self.exact = exact
+        self.local = local
+        self.domain = domain
+        self.catch_all = catch_all
+        self.send_as = send_as
+
+    @classmethod
+    def compile(cls, config: dict):
+        """
+        Validate a routing config and build its indexes. Raises
+        RoutingConfigError for anything invalid, so a bad config is caught at
+        load time rather than when an email arrives.
+        """
+        if type(config) != dict or type(config.get("routes", None)) != dict:
+            raise RoutingConfigError("config must have a routes object")
+
+        routes = {k.lower().strip(): v for k, v in config["routes"].items()}
+
+        def resolve(key: str, seen: tuple = ()) -> dict:
+            if key in seen:
+                raise RoutingConfigError(f"alias loop: {' -> '.join(seen + (key,))}")
+            if key not in routes:
+                raise RoutingConfigError(f"{seen[-1]}: unknown alias {key}")
+            value = routes[key]
+            if type(value) == str:
+                return resolve(value.lower().strip(), seen + (key,))
+            return validate_target(key, value)
+
+        exact = {}
+        local = {}
+        domain = {}
+        catch_all = None
+        for key in routes:
+            target = resolve(key)
+            if key == "*":
+                catch_all = target
+            elif key.startswith("*@"):
+                domain[key[2:]] = target
+            elif "@" in key:
+                local_part, _, dom = key.partition("@")
+                if not local_part or not dom or "*" in key:
+                    raise RoutingConfigError(f"{key}: invalid route")
+                exact[key] = target
+            elif "*" in key or not key:
+                raise RoutingConfigError(f"{key}: invalid route")
+            else:
+                local[key] = target
+
+        send_as = config.get("allowed_send_as_emails", [])
+        if type(send_as) != list:
+            raise RoutingConfigError("allowed_send_as_emails must be a list")
+        for i, value in enumerate(send_as):
+            if type(value) != str or "@" not in value:
+                raise RoutingConfigError(
+                    f"allowed_send_as_emails[{i}] must be an email address"
+                )
+
+        return cls(
+            exact,
+            local,
+            domain,
+            catch_all,
+            frozenset(x.lower().strip() for x in send_as),
+        )
+
+    def lookup(self, address: str) -> dict:
+        address = address.lower().strip()
+        local_part, _, dom = address.rpartition("@")
+
+        res = self.exact.get(address, None)
+        if res is None:
+            res = self.local.get(local_part, None)
+        if res is None:
+            res = self.domain.get(dom, None)
+        if res is None:
+            res = self.catch_all
+        return res or {}
+
+    def is_send_as_allowed(self, address) -> bool:
+        return bool(address) and address in self.send_as
+
+
+class RoutingConfigLoader:
+    """
+    Loads the routing config from (in order of preference) an S3 JSON
+    document, a JSON string, or the built-in default. The S3 document is
+    cached for ttl seconds, so warm invocations don't re-read it, and a
+    refresh that fails or doesn't validate keeps the last good table.
+    """
+
+    def __init__(
+        self,
+        default_config: dict,
+        config_json: str = None,
+        s3_uri: str = None,
+        s3_client=None,
+        ttl: int = 300,
+        clock=time.monotonic,
+    ):
+        self.default_config = default_config
+        self.config_json = config_json
+        self.s3_uri = s3_uri
+        self.s3_client = s3_client
+        self.ttl = ttl
+        self.clock = clock
+        self.table = None
+        self.loaded_at = None
+
+    def read_s3_config(self) -> dict:
+        bucket, _, key = self.s3_uri[len("s3://") :].partition("/")
+        resp = self.s3_client.get_object(Bucket=bucket, Key=key)
+        return json.loads(resp["Body"].read())
+
+    def load(self):
+        if self.s3_uri:
+            return RoutingTable.compile(self.read_s3_config())
+        if self.config_json:
+            return RoutingTable.compile(json.loads(self.config_json))
+        return RoutingTable.compile(self.default_config)
+
+    def get(self) -> RoutingTable:
+        now = self.clock()
+        if self.table is not None and (
+            not self.s3_uri or now - self.loaded_at < self.ttl
+        ):
+            return self.table
+
+        try:
+            self.table = self.load()
+        except Exception as e:
+            if self.table is None:
+                raise
+            print("Routing config refresh failed, keeping previous:", repr(e))
+        self.loaded_at = now
+        return self.table
@@ -0,0 +1,146 @@
+"""
+Rate limited, retrying SES sends.
+
+SES rejects sends above the account's maximum send rate with a Throttling
+error, which during a burst of reports would otherwise lose the email. Sends
+take a token from a bucket refilled at the configured rate, and throttled or
+transient failures are retried with jittered exponential backoff. Counts of
+sent, throttled and failed sends are emitted as CloudWatch embedded metrics.
+"""
+
+import json
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+retryable_codes = [
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "InternalFailure",
+]
+
+
+class SendError(Exception):
+    pass
+
+
+def is_retryable(error: ClientError) -> bool:
+    code = error.response.get("Error", {}).get("Code", "")
+    message = error.response.get("Error", {}).get("Message", "")
+    if "daily message quota" in message.lower():
+        # won't clear for hours, so leave it to the SQS/SES retry
+        return False
+    status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return code in retryable_codes or status >= 500
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token, returning how long to wait before using it.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class SendScheduler:
+    def __init__(
+        self,
+        get_client,
+        rate: float = 14,
+        max_attempts: int = 5,
+        base_delay: float = 0.2,
+        max_delay: float = 5,
+        sleep=time.sleep,
+    ):
+        self.get_client = get_client
+        self.bucket = TokenBucket(rate)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {"sent": 0, "throttled": 0, "failed": 0}
+
+    def count(self, name: str):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def send(self, message: dict) -> str:
+        """
+        Send a message, returning its SES MessageId. Raises SendError once
+        retries are exhausted or the error isn't retryable.
+        """
+        for attempt in range(self.max_attempts):
+            wait = self.bucket.reserve()
+            if wait:
+                self.sleep(wait)
+            try:
+                response = self.get_client().send_raw_email(
+                    Source=message["Source"],
+                    Destinations=message["Destinations"],
+                    RawMessage={"Data": message["Data"]},
+                )
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code", "") == "Throttling":
+                    self.count("throttled")
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    self.count("failed")
+                    raise SendError(
+                        f"{message['Destinations']}: {e.response['Error']['Message']}"
+                    ) from e
+                delay = min(self.max_delay, self.base_delay * 2**attempt)
+                self.sleep(random.uniform(0, delay))
+            else:
+                self.count("sent")
+                return response["MessageId"]
+
+    def emit_metrics(self, namespace: str = "EmailForwarder"):
+        with self.stats_lock:
+            stats = self.stats
+            self.stats = {"sent": 0, "throttled": 0, "failed": 0}
+        print(
+            json.dumps(
+                {
+                    "_aws": {
+                        "Timestamp": int(time.time() * 1000),
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": namespace,
+                                "Dimensions": [[]],
+                                "Metrics": [
+                                    {"Name": f"Emails{name.title()}", "Unit": "Count"}
+                                    for name in stats
+                                ],
+                            }
+                        ],
+                    },
+                    **{f"Emails{name.title()}": value for name, value in stats.items()},
+                }
+            )
+        )
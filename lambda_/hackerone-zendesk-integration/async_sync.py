@@ -0,0 +1,100 @@
+"""
+Syncing a report with independent I/O overlapped: the report fetch runs
+alongside the lookup of the ticket the report is mapped to, and setting the
+reference in HackerOne alongside the ticket update. Zenpy is synchronous, so
+its calls run in threads.
+"""
+
+import asyncio
+import json
+
+import hackerone
+import zendesk
+
+# one loop for the life of the execution environment, so that the async
+# HackerOne client's connections are reused between events
+loop = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global loop
+    if loop is None:
+        loop = asyncio.new_event_loop()
+    return loop
+
+
+def run(report_id, webhook: dict = None):
+    return get_loop().run_until_complete(sync_report_async(report_id, webhook))
+
+
+def get_mapped_ticket(report_id):
+    zendesk_id = zendesk.get_ticket_map().get(report_id)
+    if zendesk_id is None:
+        return None
+    try:
+        return zendesk.get_zendesk_ticket_by_id(zendesk_id)
+    except zendesk.RecordNotFoundException:
+        return None
+
+
+async def sync_report_async(report_id, webhook: dict = None):
+    mapped_ticket = asyncio.ensure_future(
+        asyncio.to_thread(get_mapped_ticket, report_id)
+    )
+
+    hackerone_report = None
+    if webhook is not None:
+        hackerone_report = hackerone.report_from_webhook(webhook)
+        if hackerone_report is None:
+            print("Webhook payload incomplete, fetching report:", report_id)
+    if hackerone_report is None:
+        hackerone_report = await hackerone.get_hackerone_report_async(report_id)
+
+    zticket = await mapped_ticket
+    if not hackerone_report:
+        return None
+    if hackerone_report.get("triaged_at", None) is None:
+        print("HackerOne report has not yet been triaged:", report_id)
+        return None
+
+    reference_id = hackerone_report["issue_tracker_reference_id"]
+    if reference_id and (not zticket or str(zticket.id) != str(reference_id)):
+        zticket = await asyncio.to_thread(
+            zendesk.get_zendesk_ticket_by_id, reference_id
+        )
+        if not zticket:
+            print("Reference ID exists, but ticket couldn't be found. Quitting.")
+            return None
+    elif not zticket:
+        # searches Zendesk
+        zticket = await asyncio.to_thread(zendesk.get_mapped_zendesk_ticket, report_id)
+
+    update = asyncio.to_thread(
+        zendesk.create_or_update_zendesk_ticket,
+        hackerone_report,
+        zticket,
+        lookup=False,
+    )
+    if zticket and not reference_id:
+        # the ticket id is already known, so HackerOne needn't wait for the update
+        print("Setting reference_id in HackerOne:", zticket.id)
+        zid, _ = await asyncio.gather(
+            update, hackerone.set_hackerone_reference_async(report_id, zticket.id)
+        )
+    else:
+        zid = await update
+        if zid and not reference_id:
+            print("Setting reference_id in HackerOne:", zid)
+            await hackerone.set_hackerone_reference_async(report_id, zid)
+
+    print(
+        json.dumps(
+            {"hackerone_report": hackerone_report, "zendesk_id": zid},
+            default=str,
+        )
+    )
+    if not zid:
+        print("Zendesk ticket not created or updated")
+    elif reference_id:
+        print("Found existing reference_id in HackerOne:", reference_id)
+    return zid
@@ -1,25 +1,199 @@
 import os
 import json
-import base64
+import asyncio
+import random
+import time
+import threading
 import httpx
 
 hackerone_api_user = os.environ["HACKERONE_API_USER"]
 hackerone_api_pass = os.environ["HACKERONE_API_PASS"]
 
+hackerone_api_url = "https://api.hackerone.com/v1"
+hackerone_timeout = float(os.getenv("HACKERONE_TIMEOUT", "10"))
+hackerone_max_retries = int(os.getenv("HACKERONE_MAX_RETRIES", "3"))
 
-def get_hackerone_auth():
-    return base64.b64encode(
-        f"{hackerone_api_user}:{hackerone_api_pass}".encode("utf-8")
-    ).decode("utf-8")
+retry_status_codes = [429, 500, 502, 503, 504]
+# the longest wait between retries, including one asked for by Retry-After
+retry_delay_max = 10.0
 
+# a time.monotonic() by which requests have to be done (the invocation's
+# remaining time, less a margin), so that a retry is given up rather than
+# having Lambda time the invocation out part way through; see set_deadline()
+deadline = None
+deadline_margin = float(os.getenv("HACKERONE_DEADLINE_MARGIN", "5"))
 
-def set_hackerone_reference(hackerone_id, zendesk_id):
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Authorization": f"Basic {get_hackerone_auth()}",
+# created on first use and reused across warm invocations, so connections
+# stay open between events; tests swap in ones built on an httpx.MockTransport
+client = None
+async_client = None
+
+# per endpoint: requests, errors, retries and latency in milliseconds
+endpoint_stats = {}
+endpoint_stats_lock = threading.Lock()
+
+
+def client_options() -> dict:
+    return {
+        "base_url": hackerone_api_url,
+        "auth": (hackerone_api_user, hackerone_api_pass),
+        "headers": {"Accept": "application/json"},
+        "http2": True,
+        "timeout": httpx.Timeout(hackerone_timeout, connect=5.0),
+        "limits": httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60),
     }
-    data = {
+
+
+def create_client(transport: httpx.BaseTransport = None) -> httpx.Client:
+    return httpx.Client(transport=transport, **client_options())
+
+
+def create_async_client(
+    transport: httpx.AsyncBaseTransport = None,
+) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=transport, **client_options())
+
+
+def get_client() -> httpx.Client:
+    global client
+    if client is None:
+        client = create_client()
+    return client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    # only use from async_sync's event loop, which the client's connections
+    # belong to
+    global async_client
+    if async_client is None:
+        async_client = create_async_client()
+    return async_client
+
+
+def record_request(endpoint: str, started: float, error: bool, retry: bool):
+    elapsed_ms = (time.monotonic() - started) * 1000
+    with endpoint_stats_lock:
+        stats = endpoint_stats.setdefault(
+            endpoint,
+            {"requests": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0},
+        )
+        stats["requests"] += 1
+        stats["errors"] += int(error)
+        stats["retries"] += int(retry)
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+
+def log_endpoint_stats():
+    with endpoint_stats_lock:
+        stats = {
+            endpoint: {
+                **x,
+                "avg_ms": round(x["total_ms"] / x["requests"], 1),
+                "total_ms": round(x["total_ms"], 1),
+                "max_ms": round(x["max_ms"], 1),
+            }
+            for endpoint, x in endpoint_stats.items()
+        }
+        endpoint_stats.clear()
+    if stats:
+        print(json.dumps({"hackerone_api_stats": stats}))
+
+
+def set_deadline(context):
+    """
+    Set the deadline from a Lambda context, or clear it without one.
+    """
+    global deadline
+    deadline = None
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000
+        deadline = time.monotonic() + remaining - deadline_margin
+
+
+def retry_delay(attempt: int, response: httpx.Response = None) -> float:
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(retry_delay_max, float(retry_after))
+    return random.uniform(0, min(retry_delay_max, 0.5 * 2**attempt))
+
+
+def time_for_retry(delay: float) -> bool:
+    # the wait and a retry that takes as long as it's allowed to
+    return deadline is None or time.monotonic() + delay + hackerone_timeout <= deadline
+
+
+def request(method: str, endpoint: str, path: str, **kwargs) -> httpx.Response:
+    """
+    Make a request to the HackerOne API, retrying transport errors and
+    429/5xx responses while there's time. endpoint is the path template used
+    for metrics.
+    """
+    for attempt in range(hackerone_max_retries + 1):
+        last_attempt = attempt == hackerone_max_retries
+        started = time.monotonic()
+        try:
+            resp = get_client().request(method, path, **kwargs)
+        except httpx.TransportError as e:
+            delay = retry_delay(attempt)
+            retry = not last_attempt and time_for_retry(delay)
+            record_request(endpoint, started, error=True, retry=retry)
+            if not retry:
+                raise
+            print(f"HackerOne {endpoint} failed, retrying:", repr(e))
+            time.sleep(delay)
+            continue
+
+        delay = retry_delay(attempt, resp)
+        retry = (
+            resp.status_code in retry_status_codes
+            and not last_attempt
+            and time_for_retry(delay)
+        )
+        record_request(endpoint, started, error=resp.is_error, retry=retry)
+        if not retry:
+            return resp
+        print(f"HackerOne {endpoint} returned {resp.status_code}, retrying")
+        time.sleep(delay)
+
+
+async def request_async(
+    method: str, endpoint: str, path: str, **kwargs
+) -> httpx.Response:
+    """
+    request() for the async client.
+    """
+    for attempt in range(hackerone_max_retries + 1):
+        last_attempt = attempt == hackerone_max_retries
+        started = time.monotonic()
+        try:
+            resp = await get_async_client().request(method, path, **kwargs)
+        except httpx.TransportError as e:
+            delay = retry_delay(attempt)
+            retry = not last_attempt and time_for_retry(delay)
+            record_request(endpoint, started, error=True, retry=retry)
+            if not retry:
+                raise
+            print(f"HackerOne {endpoint} failed, retrying:", repr(e))
+            await asyncio.sleep(delay)
+            continue
+
+        delay = retry_delay(attempt, resp)
+        retry = (
+            resp.status_code in retry_status_codes
+            and not last_attempt
+            and time_for_retry(delay)
+        )
+        record_request(endpoint, started, error=resp.is_error, retry=retry)
+        if not retry:
+            return resp
+        print(f"HackerOne {endpoint} returned {resp.status_code}, retrying")
+        await asyncio.sleep(delay)
+
+
+def reference_payload(zendesk_id) -> dict:
+    return {
         "data": {
             "type": "issue-tracker-reference-id",
             "attributes": {
@@ -29,38 +203,114 @@ def set_hackerone_reference(hackerone_id, zendesk_id):
         }
     }
 
-    hackerone_resp = None
-    with httpx.Client() as client:
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Basic {get_hackerone_auth()}",
-        }
-        hackerone_resp = client.post(
-            f"https://api.hackerone.com/v1/reports/{hackerone_id}/issue_tracker_reference_id",
-            headers=headers,
-            json=data,
-        )
+
+def set_hackerone_reference(hackerone_id, zendesk_id):
+    hackerone_resp = request(
+        "POST",
+        "/reports/{id}/issue_tracker_reference_id",
+        f"/reports/{hackerone_id}/issue_tracker_reference_id",
+        json=reference_payload(zendesk_id),
+    )
     print("set_hackerone_reference:", hackerone_resp)
 
 
-def get_hackerone_report(report_id):
-    httpxresp = None
-    with httpx.Client() as client:
-        headers = {
-            "Accept": "application/json",
-            "Authorization": f"Basic {get_hackerone_auth()}",
-        }
-        httpxresp = client.get(
-            f"https://api.hackerone.com/v1/reports/{report_id}",
-            headers=headers,
-        )
-    if not httpxresp:
+async def set_hackerone_reference_async(hackerone_id, zendesk_id):
+    hackerone_resp = await request_async(
+        "POST",
+        "/reports/{id}/issue_tracker_reference_id",
+        f"/reports/{hackerone_id}/issue_tracker_reference_id",
+        json=reference_payload(zendesk_id),
+    )
+    print("set_hackerone_reference:", hackerone_resp)
+
+
+def list_hackerone_reports(program: str, updated_after: str = None) -> list:
+    """
+    The program's reports (as returned by the reports API, without
+    normalisation), optionally only those with activity after updated_after.
+    Raises on an error response, as a partial listing would be mistaken for
+    the whole.
+    """
+    params = {"filter[program][]": program, "page[size]": 100}
+    if updated_after:
+        params["filter[last_activity_at__gt]"] = updated_after
+
+    reports = []
+    path = "/reports"
+    while path:
+        resp = request("GET", "/reports", path, params=params)
+        resp.raise_for_status()
+        page = resp.json()
+        reports.extend(page.get("data", []))
+        # the next link carries the query string
+        path = page.get("links", {}).get("next", None)
+        params = None
+    return reports
+
+
+# what a report from a webhook needs to be synced without fetching it again;
+# if any are missing (even as null) the report is fetched instead
+webhook_required_attributes = [
+    "issue_tracker_reference_id",
+    "title",
+    "vulnerability_information",
+    "main_state",
+    "state",
+    "created_at",
+    "triaged_at",
+    "last_activity_at",
+]
+webhook_required_relationships = ["program", "severity"]
+
+
+def get_hackerone_report(report_id, raise_errors: bool = False):
+    """
+    The normalised report, or None if it can't be fetched. With raise_errors,
+    only a 404 is None, and any other error response (e.g. a 503 that outlasted
+    the retries) raises httpx.HTTPStatusError, for callers that must tell a
+    report that's gone from one that wasn't synced.
+    """
+    httpxresp = request("GET", "/reports/{id}", f"/reports/{report_id}")
+    if raise_errors and httpxresp.status_code != 404:
+        httpxresp.raise_for_status()
+    if httpxresp.is_error:
+        print("get_hackerone_report:", httpxresp)
         return None
 
     h1_dict = httpxresp.json() or {}
-    h1_attrs = h1_dict.get("data", {}).get("attributes", {})
-    h1_rels = h1_dict.get("data", {}).get("relationships", {})
+    return normalise_report(report_id, h1_dict.get("data", {}))
+
+
+async def get_hackerone_report_async(report_id):
+    httpxresp = await request_async("GET", "/reports/{id}", f"/reports/{report_id}")
+    if httpxresp.is_error:
+        print("get_hackerone_report:", httpxresp)
+        return None
+
+    h1_dict = httpxresp.json() or {}
+    return normalise_report(report_id, h1_dict.get("data", {}))
+
+
+def report_from_webhook(payload: dict):
+    """
+    The normalised report from a HackerOne webhook payload, or None if the
+    payload doesn't carry everything a sync needs.
+    """
+    report = (payload.get("data", None) or {}).get("report", None) or {}
+    h1_attrs = report.get("attributes", None) or {}
+    h1_rels = report.get("relationships", None) or {}
+    if (
+        not report.get("id", None)
+        or any(x not in h1_attrs for x in webhook_required_attributes)
+        or any(x not in h1_rels for x in webhook_required_relationships)
+    ):
+        return None
+    return normalise_report(str(report["id"]), report)
+
+
+def normalise_report(report_id, h1_data: dict):
+    h1_attrs = h1_data.get("attributes", {})
+    h1_rels = h1_data.get("relationships", {})
 
     res = {
         "report_id": None,
@@ -1,7 +1,8 @@
 locals {
-  lambda_name = "hackerone-zendesk-integration"
-  iam_role    = "lambda-role-h1-zendesk-${terraform.workspace}"
-  iam_policy  = "lambda-policy-h1-zendesk-${terraform.workspace}"
+  lambda_name  = "hackerone-zendesk-integration"
+  iam_role     = "lambda-role-h1-zendesk-${terraform.workspace}"
+  iam_policy   = "lambda-policy-h1-zendesk-${terraform.workspace}"
+  state_bucket = "gccc-h1-zendesk-state-${terraform.workspace}"
 }
 
 terraform {
@@ -65,10 +66,50 @@ resource "aws_iam_policy" "lambda_policy" {
         Effect   = "Allow"
         Resource = "arn:aws:logs:*:*:*"
       },
+      {
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject",
+          "s3:DeleteObject",
+        ]
+        Effect   = "Allow"
+        Resource = "${aws_s3_bucket.state.arn}/*"
+      },
+      {
+        # so that reading a missing key (a report without a ticket yet, a
+        # free lock, the first reconcile run) gets NoSuchKey rather than
+        # AccessDenied
+        Action = [
+          "s3:ListBucket"
+        ]
+        Effect   = "Allow"
+        Resource = aws_s3_bucket.state.arn
+      },
+      {
+        Action   = ["secretsmanager:GetSecretValue"]
+        Effect   = "Allow"
+        Resource = aws_secretsmanager_secret.webhook_secret.arn
+      },
     ]
   })
 }
 
+# report -> ticket mapping, per-report locks and the reconcile cursor. The
+# function's environment is managed outside Terraform (see ignore_changes
+# below, it holds the API credentials), so after creating this bucket set
+# TICKET_MAP_BUCKET, REPORT_LOCK_BUCKET and RECONCILE_CURSOR_BUCKET to its name
+# by hand; the lambda refuses to sync or reconcile reports without them
+resource "aws_s3_bucket" "state" {
+  bucket = local.state_bucket
+}
+
+# the HackerOne webhook secret, to verify X-H1-Signature; set
+# HACKERONE_WEBHOOK_SECRET_ARN to this secret's ARN and its value to the secret
+# configured on the webhook in HackerOne
+resource "aws_secretsmanager_secret" "webhook_secret" {
+  name = "${local.lambda_name}-webhook-secret-${terraform.workspace}"
+}
+
 resource "aws_iam_role_policy_attachment" "lambda_pa" {
   role       = aws_iam_role.lambda_role.name
   policy_arn = aws_iam_policy.lambda_policy.arn
@@ -101,7 +142,8 @@ resource "aws_lambda_function" "lambda" {
   runtime       = "python3.9"
 
   memory_size = 256
-  timeout     = 30
+  # reconciliation runs poll Zendesk bulk jobs
+  timeout = 300
 
   lifecycle {
     ignore_changes = [
@@ -109,3 +151,26 @@ resource "aws_lambda_function" "lambda" {
     ]
   }
 }
+
+# catches up on missed webhooks; set HACKERONE_PROGRAM (and
+# RECONCILE_CURSOR_BUCKET to the state bucket's name)
+resource "aws_cloudwatch_event_rule" "reconcile_trigger" {
+  is_enabled          = terraform.workspace == "production"
+  name                = "${local.lambda_name}-reconcile-trigger"
+  schedule_expression = "rate(1 hour)"
+}
+
+resource "aws_cloudwatch_event_target" "reconcile_lambda" {
+  rule      = aws_cloudwatch_event_rule.reconcile_trigger.name
+  target_id = "${local.lambda_name}-reconcile_lambda"
+  arn       = aws_lambda_function.lambda.arn
+  input     = jsonencode({ "reconcile" : true })
+}
+
+resource "aws_lambda_permission" "allow_cloudwatch_to_call_lambda_reconcile" {
+  statement_id  = "AllowReconcileExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.reconcile_trigger.arn
+}
@@ -1,43 +1,209 @@
+import lambda_runtime
+import os
 import json
+from datetime import timedelta
+import base64
+import hashlib
+import hmac
 
 import zendesk
 import hackerone
+import reconcile
+import async_sync
+import report_lock
 
-from random import randint
-from time import sleep
+# leases serialise events for the same report; in S3 when REPORT_LOCK_BUCKET
+# is set, which it must be in Lambda, otherwise (in tests or locally) only
+# within this process
+report_lock_bucket = os.getenv("REPORT_LOCK_BUCKET", None)
+report_lock_ttl = int(os.getenv("REPORT_LOCK_TTL", "60"))
+report_lock_wait = int(os.getenv("REPORT_LOCK_WAIT", "20"))
+lock_store = None
 
+# overlap the HackerOne and Zendesk calls of a sync (see async_sync.py)
+async_sync_enabled = os.getenv("ASYNC_SYNC", "true").lower() == "true"
 
+# reconciliation: {"reconcile": true} syncs every report in the program with
+# activity since the cursor, or in the last RECONCILE_FIRST_RUN_DAYS days when
+# there's no cursor yet
+hackerone_program = os.getenv("HACKERONE_PROGRAM", None)
+reconcile_concurrency = int(os.getenv("RECONCILE_CONCURRENCY", "8"))
+reconcile_first_run_days = float(os.getenv("RECONCILE_FIRST_RUN_DAYS", "7"))
+# which must be set in Lambda; RECONCILE_CURSOR_PATH is for running locally
+reconcile_cursor_bucket = os.getenv("RECONCILE_CURSOR_BUCKET", None)
+reconcile_cursor_path = os.getenv(
+    "RECONCILE_CURSOR_PATH", "/tmp/hackerone-reconcile/cursor.json"
+)
+
+
+# the HackerOne webhook secret, to verify X-H1-Signature on webhook requests:
+# either the secret itself or the ARN of a Secrets Manager secret holding it.
+# Without one, a webhook's report id is used but the report is refetched
+webhook_secret = os.getenv("HACKERONE_WEBHOOK_SECRET", None)
+webhook_secret_arn = os.getenv("HACKERONE_WEBHOOK_SECRET_ARN", None)
+
+
+class WebhookSignatureError(Exception):
+    pass
+
+
+def get_lock_store():
+    global lock_store
+    if lock_store is None:
+        if report_lock_bucket:
+            lock_store = report_lock.S3LockStore(
+                lambda_runtime.boto3_client("s3"), report_lock_bucket
+            )
+        elif lambda_runtime.in_lambda():
+            # concurrent environments would each hold their own lease
+            raise ValueError("REPORT_LOCK_BUCKET must be set in Lambda")
+        else:
+            lock_store = report_lock.InMemoryLockStore()
+    return lock_store
+
+
+def get_cursor_store():
+    if reconcile_cursor_bucket:
+        return reconcile.S3CursorStore(
+            lambda_runtime.boto3_client("s3"), reconcile_cursor_bucket
+        )
+    if lambda_runtime.in_lambda():
+        # /tmp is lost on every cold start, and with it the cursor
+        raise ValueError("RECONCILE_CURSOR_BUCKET must be set in Lambda")
+    return reconcile.LocalCursorStore(reconcile_cursor_path)
+
+
+def get_webhook_secret():
+    global webhook_secret
+    if webhook_secret is None and webhook_secret_arn:
+        webhook_secret = lambda_runtime.boto3_client("secretsmanager").get_secret_value(
+            SecretId=webhook_secret_arn
+        )["SecretString"]
+    return webhook_secret
+
+
+def get_header(event: dict, name: str):
+    # API Gateway keeps the sender's case, function URLs lower-case them
+    for key, value in (event.get("headers", None) or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def signature_valid(body: bytes, signature: str, secret: str) -> bool:
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return signature is not None and hmac.compare_digest(
+        f"sha256={expected}", signature
+    )
+
+
+def get_webhook_payload(event: dict):
+    """
+    The HackerOne webhook payload, if the event is one, and whether its
+    contents can be trusted: either the payload itself (invoked directly,
+    which IAM restricts) or an HTTP request (API Gateway / function URL)
+    carrying it, trusted only once its X-H1-Signature is verified.
+
+    Raises WebhookSignatureError if a secret is configured and the request's
+    signature is missing or doesn't match.
+    """
+    verified = True
+    if "body" in event:
+        body = event["body"] or "{}"
+        if event.get("isBase64Encoded", False):
+            body = base64.b64decode(body)
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+
+        secret = get_webhook_secret()
+        verified = secret is not None
+        if verified and not signature_valid(
+            body, get_header(event, "X-H1-Signature"), secret
+        ):
+            raise WebhookSignatureError("X-H1-Signature missing or invalid")
+        event = json.loads(body)
+    if "report" in (event.get("data", None) or {}):
+        return event, verified
+    return None, verified
+
+
+@lambda_runtime.report_cold_start
 def lambda_handler(event, context):
-    if "report_id" in event:
-        # sleep to reduce likelihood of duplicate tickets being created:
-        sleep(3)
+    hackerone.set_deadline(context)
+    try:
+        webhook, verified = get_webhook_payload(event)
+    except WebhookSignatureError as e:
+        print("Rejecting webhook:", e)
+        return {"statusCode": 401}
+    if webhook is not None:
+        # a report id alone is enough to fall back to fetching it
+        event = {"report_id": str(webhook["data"]["report"].get("id", ""))}
+        if not verified:
+            print(
+                "Webhook signature not verified, fetching report:", event["report_id"]
+            )
+            webhook = None
 
-        hackerone_report = hackerone.get_hackerone_report(report_id=event["report_id"])
-        if hackerone_report:
-            if hackerone_report.get("triaged_at", None) is None:
-                print(
-                    "HackerOne report has not yet been triaged:",
-                    event["report_id"],
-                )
+    if event.get("reconcile", False):
+        if not hackerone_program:
+            raise ValueError("HACKERONE_PROGRAM must be set to reconcile")
+        reconcile.reconcile(
+            get_cursor_store(),
+            hackerone_program,
+            concurrency=reconcile_concurrency,
+            lock_store=get_lock_store(),
+            first_run_lookback=timedelta(days=reconcile_first_run_days),
+        )
+    elif event.get("report_id", None):
+        with report_lock.hold(
+            get_lock_store(),
+            report_lock.report_key(event["report_id"]),
+            ttl=report_lock_ttl,
+            wait=report_lock_wait,
+        ):
+            if async_sync_enabled:
+                async_sync.run(event["report_id"], webhook)
             else:
-                zid = zendesk.create_or_update_zendesk_ticket(hackerone_report)
+                sync_report(event["report_id"], webhook)
 
-                print(
-                    json.dumps(
-                        {"hackerone_report": hackerone_report, "zendesk_id": zid},
-                        default=str,
-                    )
+    hackerone.log_endpoint_stats()
+    zendesk.log_update_stats()
+
+
+def sync_report(report_id, webhook: dict = None):
+    hackerone_report = None
+    if webhook is not None:
+        hackerone_report = hackerone.report_from_webhook(webhook)
+        if hackerone_report is None:
+            print("Webhook payload incomplete, fetching report:", report_id)
+    if hackerone_report is None:
+        hackerone_report = hackerone.get_hackerone_report(report_id=report_id)
+
+    if hackerone_report:
+        if hackerone_report.get("triaged_at", None) is None:
+            print(
+                "HackerOne report has not yet been triaged:",
+                report_id,
+            )
+        else:
+            zid = zendesk.create_or_update_zendesk_ticket(hackerone_report)
+
+            print(
+                json.dumps(
+                    {"hackerone_report": hackerone_report, "zendesk_id": zid},
+                    default=str,
                 )
+            )
 
-                if not zid:
-                    print("Zendesk ticket not created or updated")
-                elif hackerone_report["issue_tracker_reference_id"]:
-                    print(
-                        "Found existing reference_id in HackerOne:",
-                        hackerone_report["issue_tracker_reference_id"],
-                    )
-                else:
-                    print("Setting reference_id in HackerOne:", zid)
-                    hackerone.set_hackerone_reference(
-                        hackerone_id=event["report_id"], zendesk_id=zid
-                    )
+            if not zid:
+                print("Zendesk ticket not created or updated")
+            elif hackerone_report["issue_tracker_reference_id"]:
+                print(
+                    "Found existing reference_id in HackerOne:",
+                    hackerone_report["issue_tracker_reference_id"],
+                )
+            else:
+                print("Setting reference_id in HackerOne:", zid)
+                hackerone.set_hackerone_reference(
+                    hackerone_id=report_id, zendesk_id=zid
+                )
@@ -0,0 +1,438 @@
+"""
+Scheduled reconciliation of HackerOne reports with their Zendesk tickets.
+
+Webhook events can be missed, leaving tickets stale. A reconciliation run
+lists the program's reports with activity since the stored cursor (or, on the
+first run, within the lookback), then works through them oldest first, 100 at
+a time: it fetches them concurrently, looks up their tickets in batches, and
+applies creates and updates through Zendesk's bulk job endpoints. Each report
+is leased (see report_lock.py) while its ticket is created or updated, so a
+run can't race a webhook for the same report, and the cursor is moved on
+after every batch, so a run that times out carries on from there next time.
+
+Reports that fail to sync don't hold the cursor back: their ids are stored
+with the cursor and retried by the next runs, up to max_report_retries times,
+so that one report that always fails can't keep every run re-listing an ever
+longer window.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+from zenpy.lib.api_objects import Ticket
+
+import hackerone
+import report_lock
+import zendesk
+
+batch_size = 100
+# report ids per Zendesk search, keeping the query string a sensible length
+search_batch_size = 50
+job_poll_interval = 2
+job_timeout = 120
+# long enough to cover a bulk job and setting the references that follow it
+lease_ttl = job_timeout + 60
+# how many later runs retry a report that failed to sync before giving up
+max_report_retries = 5
+
+
+class ReconcileError(Exception):
+    pass
+
+
+class S3CursorStore:
+    """
+    The cursor, and the report id -> failed run count of reports to retry.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        key: str = "reconcile/cursor.json",
+        retries_key: str = "reconcile/retries.json",
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.retries_key = retries_key
+
+    def read(self, key: str, name: str):
+        try:
+            resp = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        return json.loads(resp["Body"].read())[name]
+
+    def write(self, key: str, name: str, value):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=json.dumps({name: value}).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+    def get(self):
+        return self.read(self.key, "cursor")
+
+    def put(self, cursor: str):
+        self.write(self.key, "cursor", cursor)
+
+    def get_retries(self) -> dict:
+        return self.read(self.retries_key, "retries") or {}
+
+    def put_retries(self, retries: dict):
+        self.write(self.retries_key, "retries", retries)
+
+
+class LocalCursorStore:
+    def __init__(self, path: str, retries_path: str = None):
+        self.path = path
+        self.retries_path = retries_path or os.path.join(
+            os.path.dirname(path), "retries.json"
+        )
+
+    def read(self, path: str, name: str):
+        try:
+            with open(path) as f:
+                return json.load(f)[name]
+        except FileNotFoundError:
+            return None
+
+    def write(self, path: str, name: str, value):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({name: value}, f)
+
+    def get(self):
+        return self.read(self.path, "cursor")
+
+    def put(self, cursor: str):
+        self.write(self.path, "cursor", cursor)
+
+    def get_retries(self) -> dict:
+        return self.read(self.retries_path, "retries") or {}
+
+    def put_retries(self, retries: dict):
+        self.write(self.retries_path, "retries", retries)
+
+
+def chunks(items: list, size: int = None):
+    size = size or batch_size
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def result_field(result, name: str):
+    # job results are JobStatusResult objects, or dicts when zenpy can't map them
+    if isinstance(result, dict):
+        return result.get(name, None)
+    return getattr(result, name, None)
+
+
+def wait_for_job(job_status, sleep=time.sleep) -> list:
+    """
+    Poll a Zendesk job until it finishes, returning its results.
+    """
+    deadline = time.monotonic() + job_timeout
+    while job_status.status in ["queued", "working"]:
+        if time.monotonic() >= deadline:
+            raise ReconcileError(f"Zendesk job {job_status.id} timed out")
+        sleep(job_poll_interval)
+        job_status = zendesk.zenpy_client.job_status(id=job_status.id)
+    if job_status.status != "completed":
+        raise ReconcileError(f"Zendesk job {job_status.id} {job_status.status}")
+    return job_status.results or []
+
+
+def fetch_reports(report_ids: list, concurrency: int):
+    """
+    Fetch and normalise reports concurrently. Returns (reports, failed_ids),
+    failed including reports HackerOne answered with an error other than 404,
+    so that the cursor isn't moved past them.
+    """
+
+    def fetch(report_id):
+        try:
+            return hackerone.get_hackerone_report(report_id, raise_errors=True)
+        except Exception as e:
+            print("Failed to fetch HackerOne report:", report_id, repr(e))
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(fetch, report_ids))
+
+    reports = []
+    failed = []
+    for report_id, result in zip(report_ids, results):
+        if isinstance(result, Exception):
+            failed.append(report_id)
+        elif result is not None:
+            reports.append(result)
+    return reports, failed
+
+
+def resolve_tickets(reports: list) -> dict:
+    """
+    Map report ids to their tickets. Referenced and mapped tickets are fetched
+    100 at a time; Zendesk is only searched for reports that are neither, 50
+    at a time.
+    """
+    ticket_ids = {}
+    for report in reports:
+        zendesk_id = report["issue_tracker_reference_id"]
+        if not zendesk_id:
+            zendesk_id = zendesk.get_ticket_map().get(report["report_id"])
+        if zendesk_id and str(zendesk_id).isdigit():
+            ticket_ids[report["report_id"]] = int(zendesk_id)
+
+    tickets_by_id = {}
+    for batch in chunks(sorted(set(ticket_ids.values()))):
+        for ticket in zendesk.zenpy_client.tickets(ids=batch):
+            tickets_by_id[ticket.id] = ticket
+
+    res = {}
+    unmapped = []
+    for report in reports:
+        report_id = report["report_id"]
+        res[report_id] = tickets_by_id.get(ticket_ids.get(report_id, None), None)
+        if res[report_id] is None and not report["issue_tracker_reference_id"]:
+            unmapped.append(report_id)
+
+    for batch in chunks(unmapped, search_batch_size):
+        found = zendesk.get_zendesk_tickets_by_hackerone_ids(batch)
+        for report_id, ticket in found.items():
+            zendesk.get_ticket_map().put(report_id, ticket.id)
+            res[report_id] = ticket
+    return res
+
+
+def lease_reports(stack: ExitStack, lock_store, report_ids: list, sleep) -> list:
+    """
+    Take the leases on as many of the reports as are free, held until the
+    stack is closed, returning the ids of those that weren't.
+    """
+    busy = []
+    for report_id in report_ids:
+        try:
+            stack.enter_context(
+                report_lock.hold(
+                    lock_store,
+                    report_lock.report_key(report_id),
+                    ttl=lease_ttl,
+                    wait=0,
+                    sleep=sleep,
+                )
+            )
+        except report_lock.LockTimeout:
+            # being synced by a webhook; left for the next run
+            print("HackerOne report is locked, skipping:", report_id)
+            busy.append(report_id)
+    return busy
+
+
+def create_tickets(reports: list, lock_store, summary: dict, sleep) -> tuple:
+    """
+    Create tickets for reports in one bulk job. Returns (updates, failed_ids),
+    the updates being the comments to add to the new tickets.
+    """
+    updates = []
+    failed = []
+    with ExitStack() as stack:
+        busy = lease_reports(
+            stack, lock_store, [r["report_id"] for r in reports], sleep
+        )
+        failed.extend(busy)
+        batch = []
+        new_tickets = []
+        for report in reports:
+            if report["report_id"] in busy:
+                continue
+            # created since the tickets were looked up
+            if zendesk.get_ticket_map().get(report["report_id"]) is not None:
+                summary["unchanged"] += 1
+                continue
+            ticket = zendesk.new_zendesk_ticket(report)
+            ticket.custom_fields = zendesk.build_custom_fields(report)
+            batch.append(report)
+            new_tickets.append(ticket)
+        if not new_tickets:
+            return updates, failed
+
+        results = wait_for_job(zendesk.zenpy_client.tickets.create(new_tickets), sleep)
+        for result in results:
+            report = batch[result_field(result, "index")]
+            zendesk_id = result_field(result, "id")
+            if not zendesk_id:
+                print("Zendesk ticket not created:", report["report_id"], result)
+                failed.append(report["report_id"])
+                continue
+            summary["created"] += 1
+            zendesk.get_ticket_map().put(report["report_id"], zendesk_id)
+            hackerone.set_hackerone_reference(
+                hackerone_id=report["report_id"], zendesk_id=zendesk_id
+            )
+            updates.append(
+                (
+                    report["report_id"],
+                    Ticket(id=zendesk_id, comment=zendesk.created_comment(report)),
+                )
+            )
+    return updates, failed
+
+
+def update_tickets(updates: list, lock_store, summary: dict, sleep) -> list:
+    """
+    Apply (report id, ticket) updates in one bulk job, returning the ids of
+    the reports whose tickets weren't updated.
+    """
+    failed = []
+    with ExitStack() as stack:
+        busy = lease_reports(stack, lock_store, [x[0] for x in updates], sleep)
+        failed.extend(busy)
+        batch = [ticket for report_id, ticket in updates if report_id not in busy]
+        if not batch:
+            return failed
+
+        report_ids = {ticket.id: report_id for report_id, ticket in updates}
+        results = wait_for_job(zendesk.zenpy_client.tickets.update(batch), sleep)
+        for result in results:
+            if result_field(result, "error"):
+                print("Zendesk ticket not updated:", result_field(result, "id"), result)
+                failed.append(report_ids.get(result_field(result, "id"), None))
+        summary["updated"] += len([t for t in batch if t.custom_fields])
+    return failed
+
+
+def sync_batch(listed: list, lock_store, summary: dict, concurrency: int, sleep):
+    """
+    Sync a batch of listed reports, returning the ids of those that failed.
+    """
+    reports, failed = fetch_reports([x["id"] for x in listed], concurrency)
+    reports = [r for r in reports if r.get("triaged_at", None) is not None]
+    tickets = resolve_tickets(reports)
+
+    updates = []
+    to_create = []
+    for report in reports:
+        ticket = tickets[report["report_id"]]
+        if ticket is None and report["issue_tracker_reference_id"]:
+            print(
+                "Reference ID exists, but ticket couldn't be found:",
+                report["report_id"],
+            )
+            summary["missing"] += 1
+        elif ticket is None:
+            to_create.append(report)
+        else:
+            changed = zendesk.changed_custom_fields(
+                ticket, zendesk.build_custom_fields(report)
+            )
+            if changed:
+                updates.append(
+                    (report["report_id"], Ticket(id=ticket.id, custom_fields=changed))
+                )
+            else:
+                summary["unchanged"] += 1
+
+    if to_create:
+        created, create_failed = create_tickets(to_create, lock_store, summary, sleep)
+        updates.extend(created)
+        failed.extend(create_failed)
+    for batch in chunks(updates):
+        failed.extend(update_tickets(batch, lock_store, summary, sleep))
+    return failed
+
+
+def last_activity(listed_report: dict):
+    return listed_report.get("attributes", {}).get("last_activity_at", None)
+
+
+def next_retries(retries: dict, failed: list, synced: set) -> dict:
+    """
+    The retries to store: those not yet tried again this run as they were,
+    and this run's failures with their count of failed runs, leaving out the
+    ones that have used up max_report_retries.
+    """
+    res = {x: n for x, n in retries.items() if x not in synced}
+    for report_id in failed:
+        if report_id is not None and retries.get(report_id, 0) < max_report_retries:
+            res[report_id] = retries.get(report_id, 0) + 1
+    return res
+
+
+def reconcile(
+    cursor_store,
+    program: str,
+    concurrency: int = 8,
+    lock_store=None,
+    first_run_lookback: timedelta = timedelta(days=7),
+    sleep=time.sleep,
+):
+    cursor = cursor_store.get()
+    if cursor is None:
+        # rather than every report the program has ever had
+        since = datetime.now(timezone.utc) - first_run_lookback
+        cursor = since.strftime("%Y-%m-%dT%H:%M:%SZ")
+    if lock_store is None:
+        lock_store = report_lock.InMemoryLockStore()
+
+    retries = cursor_store.get_retries()
+    listed = hackerone.list_hackerone_reports(program, updated_after=cursor)
+    print("HackerOne reports with activity since", cursor, ":", len(listed))
+    summary = {
+        "listed": len(listed),
+        "retried": len(retries),
+        "created": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "missing": 0,
+    }
+    # earlier failures the cursor has moved past, first as they have no
+    # activity time
+    listed_ids = {x["id"] for x in listed}
+    listed += [{"id": x, "attributes": {}} for x in retries if x not in listed_ids]
+    listed.sort(key=lambda x: last_activity(x) or "")
+
+    failed = []
+    synced = set()
+    stored = retries
+    moved = False
+    batches = list(chunks(listed))
+    for i, batch in enumerate(batches):
+        failed.extend(sync_batch(batch, lock_store, summary, concurrency, sleep))
+        synced.update(x["id"] for x in batch)
+
+        # failures are stored to be retried before the cursor moves past
+        # them, and the cursor isn't moved into the middle of reports with
+        # the same activity time, as the listing is of those after it
+        activity = [x for x in map(last_activity, batch) if x]
+        following = last_activity(batches[i + 1][0]) if i + 1 < len(batches) else None
+        if activity and (following is None or following > max(activity)):
+            if next_retries(retries, failed, synced) != stored:
+                stored = next_retries(retries, failed, synced)
+                cursor_store.put_retries(stored)
+            cursor_store.put(max(activity))
+            moved = True
+
+    remaining = next_retries(retries, failed, synced)
+    if remaining != stored:
+        cursor_store.put_retries(remaining)
+    gave_up = [x for x in failed if x is not None and x not in remaining]
+    for report_id in gave_up:
+        print("Giving up retrying HackerOne report:", report_id)
+    if summary["listed"] and not moved:
+        print("Reconcile cursor not moved from", cursor)
+
+    summary["failed"] = len(failed)
+    summary["gave_up"] = len(gave_up)
+    summary["cursor_moved"] = moved
+    print(json.dumps({"reconcile": summary}))
+    return summary
@@ -0,0 +1,132 @@
+"""
+Per-report leases, so that concurrent events for the same HackerOne report
+are handled one at a time (and can't both create a ticket) while events for
+different reports run in parallel.
+
+A lease is taken with an atomic conditional write and has an expiry, so a
+lease left behind by a crashed invocation is taken over once it expires.
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
+
+conflict_codes = ["PreconditionFailed", "ConditionalRequestConflict", "412", "409"]
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class InMemoryLockStore:
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        with self.lock:
+            existing = self.leases.get(key, None)
+            if existing and existing["expires_at"] > self.clock():
+                return False
+            self.leases[key] = {"owner": owner, "expires_at": self.clock() + ttl}
+            return True
+
+    def release(self, key: str, owner: str):
+        with self.lock:
+            if self.leases.get(key, {}).get("owner", None) == owner:
+                del self.leases[key]
+
+
+class S3LockStore:
+    def __init__(self, s3_client, bucket: str, prefix: str = "locks/", clock=time.time):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.clock = clock
+        # ETags of the leases we hold, so release only deletes our own
+        self.etags = {}
+
+    def put(self, key: str, owner: str, ttl: float, **conditions):
+        resp = self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{key}",
+            Body=json.dumps({"owner": owner, "expires_at": self.clock() + ttl}).encode(
+                "utf-8"
+            ),
+            **conditions,
+        )
+        self.etags[(key, owner)] = resp["ETag"]
+
+    def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        try:
+            self.put(key, owner, ttl, IfNoneMatch="*")
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in conflict_codes:
+                raise
+
+        try:
+            existing = self.s3_client.get_object(
+                Bucket=self.bucket, Key=f"{self.prefix}{key}"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                # released in the meantime; try again on the next poll
+                return False
+            raise
+
+        current = json.loads(existing["Body"].read() or b"{}")
+        if (current.get("expires_at", None) or 0) > self.clock():
+            return False
+
+        try:
+            self.put(key, owner, ttl, IfMatch=existing["ETag"])
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in conflict_codes:
+                raise
+            return False
+
+    def release(self, key: str, owner: str):
+        etag = self.etags.pop((key, owner), None)
+        if etag is None:
+            return
+        try:
+            self.s3_client.delete_object(
+                Bucket=self.bucket, Key=f"{self.prefix}{key}", IfMatch=etag
+            )
+        except ClientError as e:
+            # taken over after our lease expired; it's theirs now
+            if e.response["Error"]["Code"] not in conflict_codes:
+                raise
+
+
+def report_key(report_id) -> str:
+    return f"report-{report_id}"
+
+
+@contextmanager
+def hold(store, key: str, ttl: float = 60, wait: float = 20, sleep=time.sleep):
+    """
+    Hold the lease on key for the duration of the block, polling for up to
+    wait seconds if someone else holds it. Raises LockTimeout if it can't be
+    taken, so that the event is retried later.
+    """
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + wait
+    delay = 0.1
+    while not store.acquire(key, owner, ttl):
+        if time.monotonic() >= deadline:
+            raise LockTimeout(f"{key} is locked")
+        sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, 2.0)
+    try:
+        yield
+    finally:
+        store.release(key, owner)
@@ -0,0 +1,90 @@
+"""
+HackerOne report id -> Zendesk ticket id mapping.
+
+Zendesk search is slow, rate limited and eventually consistent, so a ticket
+created moments ago may not be found by the next event for the same report.
+The mapping is written as soon as a ticket is created and checked before
+searching. Lookups hit an in-memory layer first, kept across warm invocations,
+then a durable store: S3, or a directory standing in for it locally.
+"""
+
+import json
+import os
+import threading
+
+from botocore.exceptions import ClientError
+
+
+class S3TicketMap:
+    def __init__(self, s3_client, bucket: str, prefix: str = "ticket-map/"):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, report_id: str):
+        # a missing key is only NoSuchKey with s3:ListBucket on the bucket,
+        # without it it's AccessDenied, which is raised like any other error
+        try:
+            resp = self.s3_client.get_object(
+                Bucket=self.bucket, Key=f"{self.prefix}{report_id}.json"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        return json.loads(resp["Body"].read())["zendesk_id"]
+
+    def put(self, report_id: str, zendesk_id):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{report_id}.json",
+            Body=json.dumps({"zendesk_id": zendesk_id}).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+
+class LocalTicketMap:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, report_id: str) -> str:
+        return os.path.join(self.directory, f"{report_id}.json")
+
+    def get(self, report_id: str):
+        try:
+            with open(self.path(report_id)) as f:
+                return json.load(f)["zendesk_id"]
+        except FileNotFoundError:
+            return None
+
+    def put(self, report_id: str, zendesk_id):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path(report_id)}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"zendesk_id": zendesk_id}, f)
+        os.replace(tmp_path, self.path(report_id))
+
+
+class TicketMap:
+    def __init__(self, durable=None):
+        self.durable = durable
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    def get(self, report_id):
+        report_id = str(report_id)
+        with self.lock:
+            zendesk_id = self.memory.get(report_id, None)
+        if zendesk_id is None and self.durable is not None:
+            zendesk_id = self.durable.get(report_id)
+            if zendesk_id is not None:
+                with self.lock:
+                    self.memory[report_id] = zendesk_id
+        return zendesk_id
+
+    def put(self, report_id, zendesk_id):
+        report_id = str(report_id)
+        with self.lock:
+            self.memory[report_id] = zendesk_id
+        if self.durable is not None:
+            self.durable.put(report_id, zendesk_id)
@@ -1,29 +1,67 @@
+import lambda_runtime
 import os
 import json
 import httpx
 import time
 
-from zenpy import Zenpy
 from zenpy.lib.api_objects import Ticket, User, Comment, CustomField
+from zenpy.lib.exception import RecordNotFoundException
+from ticket_map import LocalTicketMap, S3TicketMap, TicketMap
 
-zendesk_creds = {
-    "email": os.environ["ZENDESK_API_EMAIL"],
-    "token": os.environ["ZENDESK_API_KEY"],
-    "subdomain": os.environ["ZENDESK_SUBDOMAIN"],
-}
-
-zenpy_client = Zenpy(**zendesk_creds)
+# built on first use, from the ZENDESK_API_* credentials
+zenpy_client = lambda_runtime.zenpy_client()
 
 zendesk_email = os.environ["ZENDESK_EMAIL"]  # what the "from" email is
 zendesk_requester = 13633022984593  # HackerOne Automation user
 # zendesk_group = 10980471236113  # Vulnerability Management Team; use Zendesk Triggers to assign!
 zendesk_ticket_form = 12219491114257  # Vulnerability Report
 
+# report id -> ticket id, in S3 when TICKET_MAP_BUCKET is set, which it must
+# be in Lambda, otherwise (in tests or locally) in a local directory
+ticket_map_bucket = os.getenv("TICKET_MAP_BUCKET", None)
+ticket_map_dir = os.getenv("TICKET_MAP_DIR", "/tmp/hackerone-ticket-map")
+ticket_map = None
+
+
+def get_ticket_map():
+    global ticket_map
+    if ticket_map is None:
+        if ticket_map_bucket:
+            durable = S3TicketMap(lambda_runtime.boto3_client("s3"), ticket_map_bucket)
+        elif lambda_runtime.in_lambda():
+            # /tmp only lasts as long as the execution environment
+            raise ValueError("TICKET_MAP_BUCKET must be set in Lambda")
+        else:
+            durable = LocalTicketMap(ticket_map_dir)
+        ticket_map = TicketMap(durable)
+    return ticket_map
+
 
 def get_zendesk_ticket_by_id(zendesk_id):
     return zenpy_client.tickets(id=str(zendesk_id))
 
 
+def get_mapped_zendesk_ticket(hackerone_id):
+    """
+    Find the ticket for a report through the mapping, searching Zendesk only
+    when the report isn't mapped (or its ticket has gone).
+    """
+    zendesk_id = get_ticket_map().get(hackerone_id)
+    if zendesk_id is not None:
+        try:
+            zticket = get_zendesk_ticket_by_id(zendesk_id)
+        except RecordNotFoundException:
+            zticket = None
+        if zticket:
+            return zticket
+        print("Mapped Zendesk ticket not found, searching:", zendesk_id)
+
+    zticket = get_zendesk_ticket_by_hackerone_id(hackerone_id)
+    if zticket:
+        get_ticket_map().put(hackerone_id, zticket.id)
+    return zticket
+
+
 def get_zendesk_ticket_by_hackerone_id(hackerone_id):
     resp = None
     se = zenpy_client.search_export(
@@ -36,52 +74,121 @@ def get_zendesk_ticket_by_hackerone_id(hackerone_id):
     return resp
 
 
-def create_or_update_zendesk_ticket(h1obj: dict):
-    zticket = None
+def get_zendesk_tickets_by_hackerone_ids(hackerone_ids: list) -> dict:
+    """
+    Report id -> its ticket, for those of the reports that have one, from a
+    single search (Zendesk ORs terms on the same field).
+    """
+    hackerone_ids = sorted({str(x) for x in hackerone_ids})
+    res = {}
+    if not hackerone_ids:
+        return res
+    se = zenpy_client.search_export(
+        type="ticket", custom_field_13630395133585=hackerone_ids
+    )
+    for ticket in se:
+        report_id = current_custom_fields(ticket).get(13630395133585, None)
+        if ticket and report_id in hackerone_ids and report_id not in res:
+            res[report_id] = ticket
+    return res
 
-    if h1obj["issue_tracker_reference_id"]:
-        zticket = get_zendesk_ticket_by_id(h1obj["issue_tracker_reference_id"])
-        if not zticket:
-            print("Reference ID exists, but ticket couldn't be found. Quitting.")
-            return None
-    else:
-        zticket = get_zendesk_ticket_by_hackerone_id(h1obj["report_id"])
 
-    if not zticket:
-        print("Zendesk ticket doesn't exist, creating...")
-        current_datetime = time.strftime("%Y-%m-%d %H:%M", time.localtime())
-        tc_resp = zenpy_client.tickets.create(
-            Ticket(
-                description="HackerOne report",
-                subject=h1obj["title"],
-                comment=Comment(
-                    body=f"HackerOne vulnerability information at {current_datetime}: {h1obj['vulnerability_information']}",
-                    public=False,
-                    author_id=zendesk_requester,
-                ),
-                recipient=zendesk_email,
-                submitter_id=zendesk_requester,
-                requester_id=zendesk_requester,
-                # group_id=zendesk_group, # use Zendesk Triggers to assign!
-                ticket_form_id=zendesk_ticket_form,
-            )
+# tickets updated and updates skipped (or fields left out) because nothing
+# had changed, since the last log_update_stats()
+update_stats = {"TicketsUpdated": 0, "TicketUpdatesSkipped": 0, "FieldsUnchanged": 0}
+
+
+def custom_field_value(value):
+    # Zendesk returns text fields as strings and empty fields as None
+    if value is None or value == "":
+        return None
+    return str(value)
+
+
+def current_custom_fields(zticket) -> dict:
+    current = {}
+    for field in zticket.custom_fields or []:
+        if isinstance(field, dict):
+            current[field.get("id", None)] = custom_field_value(field.get("value"))
+        else:
+            current[field.id] = custom_field_value(field.value)
+    return current
+
+
+def changed_custom_fields(zticket, custom_fields: list) -> list:
+    """
+    The custom_fields whose values differ from the ticket's current ones.
+    """
+    current = current_custom_fields(zticket)
+    return [
+        field
+        for field in custom_fields
+        if field.id not in current
+        or current[field.id] != custom_field_value(field.value)
+    ]
+
+
+def log_update_stats():
+    if not any(update_stats.values()):
+        return
+    # CloudWatch embedded metric format
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": "HackerOneZendesk",
+                            "Dimensions": [[]],
+                            "Metrics": [
+                                {"Name": name, "Unit": "Count"} for name in update_stats
+                            ],
+                        }
+                    ],
+                },
+                **update_stats,
+            }
         )
-        zticket = tc_resp.ticket
+    )
+    for name in update_stats:
+        update_stats[name] = 0
+
 
-        zticket.comment = Comment(
-            body=f"Created automatically from HackerOne report: {h1obj['report_url']}\n\nNote: custom fields (left) and the subject are synchronised automatically from HackerOne.\n\nNext steps:\n - find the system or service owner\n - change the 'Requester' to the main contact found (use 'CC' in the top right of the comments box to include additional people)\n - make sure the 'Select a Reply From' has the correct vm email selected\n - use 'Public reply' to inform the requester and CCs of the report\n - use HackerOne to keep the security researcher informed",
+def new_zendesk_ticket(h1obj: dict) -> Ticket:
+    current_datetime = time.strftime("%Y-%m-%d %H:%M", time.localtime())
+    return Ticket(
+        description="HackerOne report",
+        subject=h1obj["title"],
+        comment=Comment(
+            body=f"HackerOne vulnerability information at {current_datetime}: {h1obj['vulnerability_information']}",
             public=False,
             author_id=zendesk_requester,
-        )
+        ),
+        recipient=zendesk_email,
+        submitter_id=zendesk_requester,
+        requester_id=zendesk_requester,
+        # group_id=zendesk_group, # use Zendesk Triggers to assign!
+        ticket_form_id=zendesk_ticket_form,
+    )
+
+
+def created_comment(h1obj: dict) -> Comment:
+    return Comment(
+        body=f"Created automatically from HackerOne report: {h1obj['report_url']}\n\nNote: custom fields (left) and the subject are synchronised automatically from HackerOne.\n\nNext steps:\n - find the system or service owner\n - change the 'Requester' to the main contact found (use 'CC' in the top right of the comments box to include additional people)\n - make sure the 'Select a Reply From' has the correct vm email selected\n - use 'Public reply' to inform the requester and CCs of the report\n - use HackerOne to keep the security researcher informed",
+        public=False,
+        author_id=zendesk_requester,
+    )
 
+
+def build_custom_fields(h1obj: dict) -> list:
     full_timestamps = []
     for ts in h1obj["full_timestamps"]:
         tss = f"{ts.title().replace('_', ' ')}:\n{h1obj['full_timestamps'][ts]}"
         full_timestamps.append(tss)
     h1_timestamps_str = "\n".join(full_timestamps)
 
-    # zticket.subject = h1obj["title"]
-    zticket.custom_fields = [
+    return [
         CustomField(id=13630395133585, value=h1obj["report_id"]),
         CustomField(id=13630685790097, value=h1obj["report_url"]),
         CustomField(id=13630481911185, value=h1obj["closed_at"]),
@@ -101,7 +208,53 @@ def create_or_update_zendesk_ticket(h1obj: dict):
         CustomField(id=13641072614417, value=h1obj["reporter_username"]),
         CustomField(id=18597329201681, value=h1_timestamps_str),
     ]
+
+
+def create_or_update_zendesk_ticket(h1obj: dict, zticket=None, lookup: bool = True):
+    """
+    Sync a report to its ticket, creating the ticket if there isn't one. A
+    caller that has already looked the ticket up passes it (or None, if there
+    isn't one) with lookup=False.
+    """
+    created = False
+
+    if not lookup:
+        pass
+    elif h1obj["issue_tracker_reference_id"]:
+        zticket = get_zendesk_ticket_by_id(h1obj["issue_tracker_reference_id"])
+        if not zticket:
+            print("Reference ID exists, but ticket couldn't be found. Quitting.")
+            return None
+    else:
+        zticket = get_mapped_zendesk_ticket(h1obj["report_id"])
+
+    if not zticket:
+        print("Zendesk ticket doesn't exist, creating...")
+        tc_resp = zenpy_client.tickets.create(new_zendesk_ticket(h1obj))
+        zticket = tc_resp.ticket
+        created = True
+        get_ticket_map().put(h1obj["report_id"], zticket.id)
+
+        zticket.comment = created_comment(h1obj)
+
+    # zticket.subject = h1obj["title"]
+    custom_fields = build_custom_fields(h1obj)
+
+    if created:
+        # also posts the "created automatically" comment
+        zticket.custom_fields = custom_fields
+    else:
+        changed = changed_custom_fields(zticket, custom_fields)
+        update_stats["FieldsUnchanged"] += len(custom_fields) - len(changed)
+        if not changed:
+            print("Zendesk ticket already up to date:", zticket.id)
+            update_stats["TicketUpdatesSkipped"] += 1
+            return zticket.id
+        # Zendesk leaves fields that aren't sent as they are
+        zticket.custom_fields = changed
+
     zenpy_client.tickets.update(zticket)
+    update_stats["TicketsUpdated"] += 1
 
     print(json.dumps({"zendesk_ticket": zticket.to_dict()}, default=str))
 
@@ -0,0 +1,187 @@
+"""
+Runtime helpers shared by the lambdas: lazily built, cached clients, the
+jprint structured logger and a cold start report.
+
+This file is copied into each lambda's package when it's built (by build.sh,
+or email-forwarder's archive_file) and imported as a top-level module, so it
+should only depend on the standard library. boto3, zenpy and friends are
+imported, and their clients built, the first time a client is used rather
+than when the lambda is loaded, so that code paths which never touch them
+don't pay for them on a cold start.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# as early as the lambda imports this module, i.e. roughly the start of init
+loaded_at = time.perf_counter()
+
+# label -> milliseconds, for everything built lazily in this environment
+timings = {}
+timings_lock = threading.Lock()
+
+cold_start = True
+
+
+def jprint(obj):
+    new_obj = {}
+    if type(obj) != dict:
+        obj = {"message": str(obj)}
+    if "_time" not in obj:
+        new_obj["_time"] = time.time()
+    for k in sorted(obj):
+        new_obj[k] = obj[k]
+    print(json.dumps(new_obj, default=str))
+
+
+@contextlib.contextmanager
+def timed(label: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with timings_lock:
+            timings[label] = round(timings.get(label, 0) + elapsed_ms, 1)
+
+
+class LazyClient:
+    """
+    Stands in for a client, building it on first attribute access and then
+    passing everything through to it.
+    """
+
+    def __init__(self, factory, label: str):
+        self._factory = factory
+        self._label = label
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    with timed(self._label):
+                        self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        state = "built" if self._client is not None else "not built"
+        return f"<LazyClient {self._label} ({state})>"
+
+
+def lazy(factory, label: str = None) -> LazyClient:
+    return LazyClient(factory, label or getattr(factory, "__name__", "client"))
+
+
+def boto3_config(options: dict):
+    from botocore.config import Config
+
+    return Config(**options)
+
+
+# one LazyClient per distinct set of arguments, shared by every caller
+boto3_clients = {}
+boto3_clients_lock = threading.Lock()
+
+
+def boto3_lazy(kind: str, service: str, region_name: str = None, **config):
+    key = (kind, service, region_name, json.dumps(config, sort_keys=True))
+    with boto3_clients_lock:
+        if key not in boto3_clients:
+
+            def factory():
+                import boto3
+
+                kwargs = {}
+                if region_name:
+                    kwargs["region_name"] = region_name
+                if config:
+                    kwargs["config"] = boto3_config(config)
+                return getattr(boto3, kind)(service, **kwargs)
+
+            boto3_clients[key] = LazyClient(factory, f"boto3.{kind}:{service}")
+        return boto3_clients[key]
+
+
+def boto3_client(service: str, region_name: str = None, **config) -> LazyClient:
+    """
+    A lazily built boto3 client. Keyword arguments other than region_name are
+    botocore Config options, e.g. signature_version="s3v4".
+    """
+    return boto3_lazy("client", service, region_name, **config)
+
+
+def boto3_resource(service: str, region_name: str = None, **config) -> LazyClient:
+    return boto3_lazy("resource", service, region_name, **config)
+
+
+@functools.lru_cache(maxsize=None)
+def zenpy_client() -> LazyClient:
+    """
+    A lazily built Zenpy client, using the ZENDESK_API_* credentials.
+    """
+
+    def factory():
+        from zenpy import Zenpy
+
+        return Zenpy(
+            email=os.environ["ZENDESK_API_EMAIL"],
+            token=os.environ["ZENDESK_API_KEY"],
+            subdomain=os.environ["ZENDESK_SUBDOMAIN"],
+        )
+
+    return LazyClient(factory, "zenpy")
+
+
+def in_lambda() -> bool:
+    """
+    Whether this is running in Lambda, rather than in tests or locally, where
+    falling back to state that doesn't outlive the process is fine.
+    """
+    return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+
+
+def report_cold_start(handler):
+    """
+    Decorator for lambda_handler. After the first invocation in an execution
+    environment, logs how long init took (from this module being imported to
+    the handler being defined), how long that first invocation took and what
+    was built lazily during either.
+    """
+    init_ms = round((time.perf_counter() - loaded_at) * 1000, 1)
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global cold_start
+        if not cold_start:
+            return handler(event, context)
+
+        cold_start = False
+        started = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            with timings_lock:
+                lazy_ms = dict(timings)
+            jprint(
+                {
+                    "message": "Cold start",
+                    "cold_start": {
+                        "init_ms": init_ms,
+                        "first_invocation_ms": round(
+                            (time.perf_counter() - started) * 1000, 1
+                        ),
+                        "lazy_init_ms": lazy_ms,
+                    },
+                }
+            )
+
+    return wrapper
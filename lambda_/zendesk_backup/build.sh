@@ -7,6 +7,7 @@ mkdir .target
 python3.11 -m pip install -r requirements.txt -t .target/ --upgrade --no-user
 
 cp ./*.py .target/
+cp ../shared/lambda_runtime.py .target/
 
 cd .target/ || exit 1
 
@@ -1,12 +1,11 @@
+import lambda_runtime
 import dataclasses
 import os
 import json
 from typing import Optional, Union, Literal, Any
-import boto3
-import time
 import re
 import functools
-from zenpy import Zenpy
+from lambda_runtime import jprint
 
 
 @functools.cache
@@ -14,35 +13,16 @@ def get_s3_bucket() -> str:
     return os.environ["S3_BUCKET"]
 
 
-@functools.cache
 def s3_client():
-    return boto3.client("s3")
+    return lambda_runtime.boto3_client("s3")
 
 
 s3_helpcentre_prefix = "helpcentre/"
 s3_support_prefix = "support/"
 
 
-@functools.cache
-def zenpy_client() -> Zenpy:
-    zendesk_creds = {
-        "email": os.environ["ZENDESK_API_EMAIL"],
-        "token": os.environ["ZENDESK_API_KEY"],
-        "subdomain": os.environ["ZENDESK_SUBDOMAIN"],
-    }
-
-    return Zenpy(**zendesk_creds)
-
-
-def jprint(obj):
-    new_obj = {}
-    if type(obj) != dict:
-        obj = {"message": str(obj)}
-    if "_time" not in obj:
-        new_obj["_time"] = time.time()
-    for k in sorted(obj):
-        new_obj[k] = obj[k]
-    print(json.dumps(new_obj, default=str))
+def zenpy_client():
+    return lambda_runtime.zenpy_client()
 
 
 def get_key(obj: Optional[dict[str, Any]]) -> Optional[str]:
@@ -232,6 +212,7 @@ def save_helpcentre(article_ids=None):
             )
 
 
+@lambda_runtime.report_cold_start
 def lambda_handler(event, context):
     """
     This is the lambda handler for the code above. At the moment, the only path that's covered is the final 'else'. In
@@ -0,0 +1,35 @@
+import importlib.util
+import os
+import sys
+
+lambdas_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "lambda_")
+
+# lambda_runtime is copied into every lambda's package when it's built
+shared_path = os.path.join(lambdas_path, "shared")
+if shared_path not in sys.path:
+    sys.path.insert(0, shared_path)
+
+
+def load_lambda_module(lambda_name: str, module_name: str = "main"):
+    """
+    Load a module from one of the lambda_/ directories whose names aren't valid Python package names (e.g.
+    "crawler-govuk-reference-content"). The lambda directory is put on sys.path so that sibling imports such as
+    `import zendesk` resolve as they do in the deployed Lambda.
+
+    :param lambda_name:
+    :param module_name:
+    :return:
+    """
+    lambda_path = os.path.join(lambdas_path, lambda_name)
+    if lambda_path not in sys.path:
+        sys.path.insert(0, lambda_path)
+
+    unique_name = f"{lambda_name.replace('-', '_')}_{module_name}"
+    if unique_name in sys.modules:
+        return sys.modules[unique_name]
+
+    spec = importlib.util.spec_from_file_location(unique_name, os.path.join(lambda_path, f"{module_name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[unique_name] = module
+    spec.loader.exec_module(module)
+    return module
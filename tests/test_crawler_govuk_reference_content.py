@@ -0,0 +1,577 @@
+import io
+import json
+import os
+import time
+from unittest import mock
+
+import httpx
+import pytest
+from botocore.exceptions import ClientError
+from tests import load_lambda_module
+
+
+@pytest.fixture(scope="module")
+def crawler():
+    with mock.patch.dict(os.environ, values={"S3_PROCESSED_BUCKET": "test", "AWS_DEFAULT_REGION": "eu-west-2"}):
+        yield load_lambda_module("crawler-govuk-reference-content")
+
+
+@pytest.fixture
+def organisation() -> dict:
+    return {
+        "title": "Example Department",
+        "details": {"content_id": "abc-123", "slug": "example-department"},
+        "content": {
+            "details": {
+                "ordered_corporate_information_pages": [
+                    {"title": "Contact", "href": "mailto:Enquiries@www.Example.gov.uk"},
+                ],
+                "contacts": [
+                    {"body": "Email press@example.gov.uk or foi@other.gov.uk"},
+                    ["nested list with enquiries@example.gov.uk"],
+                ],
+            }
+        },
+    }
+
+
+def test_extract_entities_walks_lists(crawler, organisation):
+    emails, domains = crawler.extract_entities(organisation)
+    assert emails == [
+        "enquiries@example.gov.uk",
+        "enquiries@www.example.gov.uk",
+        "foi@other.gov.uk",
+        "press@example.gov.uk",
+    ]
+    assert domains == ["example.gov.uk", "other.gov.uk"]
+
+
+def test_extract_emails_matches_extract_entities(crawler, organisation):
+    assert crawler.extract_emails(organisation) == crawler.extract_entities(organisation)[0]
+
+
+def test_extract_domain(crawler):
+    assert crawler.extract_domain("https://WWW.Example.gov.uk/path and me@test.gov.uk") == [
+        "example.gov.uk",
+        "test.gov.uk",
+    ]
+
+
+@pytest.fixture
+def domain_index():
+    return load_lambda_module("crawler-govuk-reference-content", "domain_index")
+
+
+def test_parent_domains(domain_index):
+    assert domain_index.parent_domains("a.tax.service.gov.uk") == ["tax.service.gov.uk", "service.gov.uk"]
+    assert domain_index.parent_domains("example.gov.uk") == []
+    assert domain_index.parent_domains("www.example.com") == ["example.com"]
+
+
+def test_domain_index_lookup(domain_index):
+    objects = [
+        {"id": "org-1", "type": "organisation", "discovered_domains": ["example.gov.uk", "hmrc.gov.uk"]},
+        {"id": "org-2", "type": "organisation", "discovered_domains": ["other.gov.uk"]},
+        {"id": "svc-1", "type": "service", "discovered_domains": ["tax.service.gov.uk"]},
+        {"id": "svc-2", "type": "service", "discovered_domains": ["apply.example.gov.uk"]},
+    ]
+    data = domain_index.build_domain_index(objects)
+    keys = [line.split(b"\t")[0] for line in data.split(b"\n")]
+    assert keys == sorted(keys)
+
+    index = domain_index.DomainIndex(data)
+    assert index.lookup("WWW.Example.gov.uk") == {
+        "organisations": ["org-1"],
+        "services": [],
+        "matched": "example.gov.uk",
+    }
+    assert index.lookup("apply.example.gov.uk")["services"] == ["svc-2"]
+    assert index.lookup("new.tax.service.gov.uk") == {
+        "organisations": [],
+        "services": ["svc-1"],
+        "matched": "tax.service.gov.uk",
+    }
+    assert index.lookup("other.service.gov.uk")["matched"] == "*.service.gov.uk"
+    assert index.lookup("unknown.gov.uk") is None
+    for line in data.split(b"\n"):
+        assert index.get(line.split(b"\t")[0].decode()) is not None
+
+
+@pytest.fixture
+def org_graph():
+    return load_lambda_module("crawler-govuk-reference-content", "org_graph")
+
+
+def organisation_ref(slug: str) -> dict:
+    return {"id": f"https://www.gov.uk/api/organisations/{slug}"}
+
+
+def test_build_organisation_graph(org_graph):
+    organisations_raw = [
+        {**organisation_ref("dept"), "child_organisations": [organisation_ref("agency")]},
+        {**organisation_ref("agency"), "child_organisations": [organisation_ref("body")]},
+        {**organisation_ref("body"), "parent_organisations": [organisation_ref("agency")],
+         "superseding_organisations": [organisation_ref("new-body")]},
+        {**organisation_ref("new-body"), "parent_organisations": [organisation_ref("agency")],
+         "superseding_organisations": [organisation_ref("newest-body")]},
+        {**organisation_ref("newest-body")},
+        {**organisation_ref("loop-a"), "parent_organisations": [organisation_ref("loop-b")]},
+        {**organisation_ref("loop-b"), "parent_organisations": [organisation_ref("loop-a")]},
+        {**organisation_ref("merged-a"), "superseding_organisations": [organisation_ref("merged-b")]},
+        {**organisation_ref("merged-b"), "superseding_organisations": [organisation_ref("merged-a")]},
+    ]
+    organisation_pairs = {o["id"]: o["id"].rsplit("/", 1)[1] for o in organisations_raw}
+    graph = org_graph.build_organisation_graph(organisations_raw, organisation_pairs)
+
+    body = graph["nodes"]["body"]
+    assert body["ancestors"] == ["agency", "dept"]
+    assert body["root_organisations"] == ["dept"]
+    assert body["supersession_chain"] == ["new-body", "newest-body"]
+    assert graph["nodes"]["dept"]["descendants"] == ["agency", "body", "new-body"]
+    assert graph["nodes"]["dept"]["root_organisations"] == ["dept"]
+
+    assert graph["cycles"] == [["loop-a", "loop-b"]]
+    assert graph["nodes"]["loop-a"]["hierarchy_cycle"] is True
+    assert graph["nodes"]["loop-a"]["root_organisations"] == []
+    # a broken parent chain and a supersession loop are told apart
+    assert org_graph.hierarchy_fields(graph, "loop-a")["supersession_cycle"] is False
+    merged = org_graph.hierarchy_fields(graph, "merged-a")
+    assert (merged["hierarchy_cycle"], merged["supersession_cycle"]) == (False, True)
+    assert org_graph.hierarchy_fields(graph, "missing")["ancestors"] == []
+
+
+class FakeS3Object:
+    def __init__(self, store: dict, key: str):
+        self.store = store
+        self.key = key
+
+    def put(self, Body):
+        self.store[self.key] = Body
+
+    def get(self):
+        if self.key not in self.store:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.store[self.key])}
+
+
+class FakeS3Resource:
+    def __init__(self):
+        self.store = {}
+
+    def Object(self, bucket: str, key: str):
+        return FakeS3Object(self.store, key)
+
+
+@pytest.fixture
+def fake_s3(crawler):
+    fake = FakeS3Resource()
+    with mock.patch.object(crawler, "s3", fake):
+        yield fake
+
+
+def govuk_service(n: int, public_timestamp: str) -> dict:
+    return {
+        "title": f"Service {n}",
+        "link": f"/service-{n}",
+        "public_timestamp": public_timestamp,
+        "organisation_content_ids": ["org-1"],
+    }
+
+
+def govuk_responses(services: list, fetched: list):
+    def get_url_dict(url: str) -> dict:
+        fetched.append(url)
+        if "/api/search.json" in url and "&fields=content_id&count=1000&" in url:
+            # the listing of every service's content id
+            start = int(url.rsplit("start=", 1)[1])
+            return {
+                "results": [{"content_id": f"svc-{x['link'].rsplit('-', 1)[1]}"} for x in services[start : start + 1000]],
+                "total": len(services),
+            }
+        if "/api/search.json" in url:
+            start = int(url.rsplit("start=", 1)[1])
+            return {"results": services[start : start + 20], "total": len(services)}
+        if "/api/content/service-" in url:
+            n = url.rsplit("-", 1)[1]
+            return {
+                "content_id": f"svc-{n}",
+                "details": {"transaction_start_link": f"https://service-{n}.service.gov.uk"},
+            }
+        return {}
+
+    return get_url_dict
+
+
+def test_fetch_services_incremental(crawler, fake_s3):
+    services = [govuk_service(n, f"2024-01-{n + 1:02d}T00:00:00Z") for n in range(25)]
+    fetched = []
+    with mock.patch.object(crawler, "get_url_dict", govuk_responses(services, fetched)):
+        assert len(crawler.fetch_services()) == 25
+
+    state = json.loads(fake_s3.store["govuk/objects/crawl-state/services.json"])
+    assert state["high_water_mark"] == "2024-01-25T00:00:00+00:00"
+
+    # newest first, as requested with order=-public_timestamp
+    services = [govuk_service(25, "2024-02-01T00:00:00Z"), govuk_service(3, "2024-02-02T00:00:00Z")]
+    services = sorted(services, key=lambda x: x["public_timestamp"], reverse=True) + list(
+        reversed([govuk_service(n, f"2024-01-{n + 1:02d}T00:00:00Z") for n in range(25) if n != 3])
+    )
+    fetched = []
+    with mock.patch.object(crawler, "get_url_dict", govuk_responses(services, fetched)):
+        full_objects = crawler.fetch_services(incremental=True)
+
+    assert "order=-public_timestamp" in fetched[0]
+    assert len([url for url in fetched if "order=-public_timestamp" in url]) == 1
+    assert sorted(url.rsplit("/", 1)[1] for url in fetched if "/api/content/" in url) == [
+        "service-25",
+        "service-3",
+    ]
+    assert len(full_objects) == 26
+    combined = fake_s3.store["govuk/objects/services-combined/services-full.json"].split(b"\n")
+    assert len(combined) == 26
+    state = json.loads(fake_s3.store["govuk/objects/crawl-state/services.json"])
+    assert state["high_water_mark"] == "2024-02-02T00:00:00+00:00"
+    assert state["changed"] == 2
+
+
+def test_fetch_services_incremental_drops_removed_services(crawler, fake_s3):
+    services = [govuk_service(n, f"2024-01-{n + 1:02d}T00:00:00Z") for n in range(3)]
+    with mock.patch.object(crawler, "get_url_dict", govuk_responses(services, [])):
+        crawler.fetch_services()
+
+    # service-1 has been withdrawn from gov.uk, service-2 updated
+    services = [govuk_service(2, "2024-02-01T00:00:00Z"), govuk_service(0, "2024-01-01T00:00:00Z")]
+    with mock.patch.object(crawler, "get_url_dict", govuk_responses(services, [])):
+        full_objects = crawler.fetch_services(incremental=True)
+
+    assert sorted(x["id"] for x in full_objects) == ["svc-0", "svc-2"]
+    combined = fake_s3.store["govuk/objects/services-combined/services-full.json"].split(b"\n")
+    assert sorted(json.loads(x)["id"] for x in combined) == ["svc-0", "svc-2"]
+
+
+def test_fetch_services_keeps_previous_when_id_listing_fails(crawler, fake_s3):
+    services = [govuk_service(n, f"2024-01-{n + 1:02d}T00:00:00Z") for n in range(3)]
+    with mock.patch.object(crawler, "get_url_dict", govuk_responses(services, [])):
+        crawler.fetch_services()
+
+    responses = govuk_responses(services[:1], [])
+
+    def get_url_dict(url):
+        if "&count=1000&" in url:
+            raise crawler.FetchError(url, "HTTP 503")
+        return responses(url)
+
+    with mock.patch.object(crawler, "get_url_dict", get_url_dict):
+        full_objects = crawler.fetch_services(incremental=True)
+
+    assert len(full_objects) == 3
+
+
+def test_read_object_missing_and_denied(crawler, fake_s3):
+    assert crawler.read_object("govuk/objects/missing.json") is None
+
+    denied = ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+    with mock.patch.object(FakeS3Object, "get", side_effect=denied):
+        with pytest.raises(ClientError):
+            crawler.read_object("govuk/objects/missing.json")
+
+
+def govuk_organisation(slug: str, updated_at: str, parents: list = None) -> dict:
+    return {
+        "id": f"https://www.gov.uk/api/organisations/{slug}",
+        "title": slug,
+        "updated_at": updated_at,
+        "details": {"slug": slug, "content_id": f"cid-{slug}"},
+        "parent_organisations": [{"id": f"https://www.gov.uk/api/organisations/{p}"} for p in parents or []],
+    }
+
+
+def test_high_water_mark_compares_naive_and_aware_timestamps(crawler):
+    # a mark stored without an offset, against gov.uk timestamps with one
+    mark = crawler.parse_timestamp("2024-01-01T10:00:00")
+    assert crawler.is_after_mark("2024-01-01T10:30:00+01:00", mark) is False
+    assert crawler.is_after_mark("2024-01-01T10:30:00Z", mark) is True
+    assert crawler.is_before_mark([{"public_timestamp": "2024-01-01T09:00:00.000+00:00"}], mark) is True
+    assert crawler.max_timestamp(["2024-01-01T10:00:00", "2024-01-01T10:30:00+01:00"]) == "2024-01-01T10:00:00+00:00"
+
+
+def test_fetch_organisations_incremental(crawler, fake_s3):
+    organisations = [
+        govuk_organisation("dept", "2024-01-01T00:00:00.000+00:00"),
+        govuk_organisation("agency", "2024-01-01T00:00:00.000+00:00", ["dept"]),
+        govuk_organisation("body", "2024-01-01T00:00:00.000+00:00"),
+        govuk_organisation("unrelated", "2024-01-01T00:00:00.000+00:00"),
+    ]
+    fetched = []
+
+    def get_url_dict(url):
+        fetched.append(url)
+        if url.endswith("/api/organisations"):
+            return {"results": [dict(o) for o in organisations], "pages": 1}
+        return {}
+
+    with mock.patch.object(crawler, "get_url_dict", get_url_dict):
+        assert len(crawler.fetch_organisations()) == 4
+
+    # "dept" is updated and "agency" gains "body" as a child without either
+    # "agency" or "body" changing their updated_at; both need re-processing
+    # because their place in the hierarchy moved, "unrelated" doesn't
+    organisations[0] = govuk_organisation("dept", "2024-02-01T00:00:00.000+00:00")
+    organisations[1]["child_organisations"] = [{"id": "https://www.gov.uk/api/organisations/body"}]
+    fetched = []
+    with mock.patch.object(crawler, "get_url_dict", get_url_dict):
+        full_objects = crawler.fetch_organisations(incremental=True)
+
+    content_fetches = sorted(url.rsplit("/", 1)[1] for url in fetched if "/api/content/" in url)
+    assert content_fetches == ["agency", "body", "dept"]
+    assert len(full_objects) == 4
+    body = [x for x in full_objects if x["id"] == "cid-body"][0]
+    assert body["root_organisations"] == ["cid-dept"]
+
+
+@pytest.fixture
+def fetcher():
+    return load_lambda_module("crawler-govuk-reference-content", "fetcher")
+
+
+def test_fetcher_retries_honour_retry_after(fetcher):
+    responses = [
+        httpx.Response(429, headers={"retry-after": "7"}),
+        httpx.Response(503),
+        httpx.Response(200, json={"results": []}),
+    ]
+    client = httpx.Client(transport=httpx.MockTransport(lambda request: responses.pop(0)))
+    sleeps = []
+    f = fetcher.Fetcher(client, "test", requests_per_second=0, sleep=sleeps.append)
+
+    assert f.get_json("https://www.gov.uk/api/organisations") == {"results": []}
+    assert sleeps[0] == 7
+    assert 0 <= sleeps[1] <= f.backoff_base * 2
+    assert f.stats == {"requests": 3, "retries": 2, "failures": 0}
+
+
+def test_fetcher_gives_up(fetcher):
+    client = httpx.Client(transport=httpx.MockTransport(lambda request: httpx.Response(500)))
+    f = fetcher.Fetcher(client, "test", requests_per_second=0, max_retries=2, sleep=lambda x: None)
+
+    with pytest.raises(fetcher.FetchError):
+        f.get_json("https://www.gov.uk/api/organisations")
+    assert f.stats["requests"] == 3
+
+    client = httpx.Client(transport=httpx.MockTransport(lambda request: httpx.Response(404)))
+    f = fetcher.Fetcher(client, "test", requests_per_second=0, sleep=lambda x: None)
+    assert f.get_json("https://www.gov.uk/api/content/missing") == {}
+    assert f.stats["requests"] == 1
+
+
+def test_host_rate_limiter(fetcher):
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+
+    limiter = fetcher.HostRateLimiter(4, clock=lambda: now[0], sleep=sleep)
+    for _ in range(3):
+        limiter.wait("www.gov.uk")
+    limiter.wait("other.gov.uk")
+    assert sleeps == [0.25, 0.5]
+    assert fetcher.parse_retry_after("Wed, 21 Oct 2015 07:28:10 GMT", now=1445412480) == 10
+
+
+def test_fetch_services_isolates_failures(crawler, fake_s3, fetcher):
+    services = [govuk_service(n, f"2024-01-{n + 1:02d}T00:00:00Z") for n in range(3)]
+    responses = govuk_responses(services, [])
+    attempts = []
+
+    def get_url_dict(url):
+        if url.endswith("/service-1"):
+            attempts.append(url)
+            raise fetcher.FetchError(url, "HTTP 503")
+        return responses(url)
+
+    with mock.patch.object(crawler, "get_url_dict", get_url_dict):
+        full_objects = crawler.fetch_services()
+
+    assert sorted(x["id"] for x in full_objects) == ["svc-0", "svc-2"]
+    assert len(attempts) == 2
+    assert "govuk/objects/crawl-state/services.json" not in fake_s3.store
+
+
+@pytest.fixture
+def output_formats():
+    return load_lambda_module("crawler-govuk-reference-content", "output_formats")
+
+
+def test_output_format_keys(output_formats):
+    key = "govuk/objects/organisations-combined/organisations-full.json"
+    assert output_formats.format_key(key, "json") == key
+    assert (
+        output_formats.format_key(key, "ndjson-gz")
+        == "govuk/objects/organisations-combined-ndjson-gz/organisations-full.json.gz"
+    )
+    assert output_formats.parse_formats("") == ["json"]
+    with pytest.raises(ValueError):
+        output_formats.parse_formats("json,csv")
+
+
+def test_output_formats_round_trip(output_formats, crawler, fake_s3):
+    organisations = [
+        govuk_organisation("dept", "2024-01-01T00:00:00.000+00:00"),
+        govuk_organisation("agency", "2024-01-01T00:00:00.000+00:00", ["dept"]),
+    ]
+    organisation_pairs = {o["id"]: o["details"]["content_id"] for o in organisations}
+    full_objects = [crawler.process_organisation(o, organisation_pairs)[1] for o in organisations]
+
+    body = output_formats.encode(full_objects, "organisation", "ndjson-gz")
+    assert output_formats.decode(body, "ndjson-gz") == full_objects
+
+    pytest.importorskip("pyarrow")
+    body = output_formats.encode(full_objects, "organisation", "parquet")
+    decoded = output_formats.decode(body, "parquet")
+    assert [x["parents"] for x in decoded] == [[], ["cid-dept"]]
+    assert decoded[1]["other_identifiers"]["govuk_slug"] == "agency"
+    assert decoded[1]["other_identifiers"]["govuk_analytics_identifier"] is None
+
+
+def test_read_combined_falls_back_to_written_format(output_formats, crawler, fake_s3):
+    key = "govuk/objects/services-combined/services-full.json"
+    services = [{"id": "svc-0", "type": "service", "name": "Service 0"}]
+    fake_s3.store[output_formats.format_key(key, "ndjson-gz")] = output_formats.encode(
+        services, "service", "ndjson-gz"
+    )
+
+    # json is preferred, but only the ndjson-gz object has been written
+    with mock.patch.object(crawler, "combined_formats", ["json", "ndjson-gz"]):
+        assert crawler.read_combined(key) == services
+    with mock.patch.object(crawler, "combined_formats", ["json"]):
+        assert crawler.read_combined(key) == []
+
+
+def test_fetch_services_uses_projected_fields(crawler, fake_s3):
+    services = [govuk_service(n, f"2024-01-{n + 1:02d}T00:00:00Z") for n in range(4)]
+    for n, service in enumerate(services[:2]):
+        service.update(
+            {
+                "content_id": f"svc-{n}",
+                "phase": "live",
+                "first_published_at": "2023-01-01T00:00:00Z",
+                "transaction_start_link": f"https://service-{n}.service.gov.uk/start",
+            }
+        )
+    # a partial projection, without the start link
+    services[3].update({"content_id": "svc-3", "phase": "beta", "first_published_at": "2023-01-01T00:00:00Z"})
+    fetched = []
+    with mock.patch.object(crawler, "get_url_dict", govuk_responses(services, fetched)):
+        full_objects = crawler.fetch_services()
+
+    assert "&fields=content_id&" in fetched[0]
+    # only the results without every projected field go to the content API
+    assert sorted(url for url in fetched if "/api/content/" in url) == [
+        "https://www.gov.uk/api/content/service-2",
+        "https://www.gov.uk/api/content/service-3",
+    ]
+    svc = [x for x in full_objects if x["id"] == "svc-0"][0]
+    assert svc["statuses"] == {"phase": "live"}
+    assert svc["discovered_domains"] == ["service-0.service.gov.uk"]
+    assert svc["created_at"] == "2023-01-01 00:00:00"
+    assert svc["updated_at"] == "2024-01-01 00:00:00"
+    svc = [x for x in full_objects if x["id"] == "svc-3"][0]
+    assert svc["discovered_domains"] == ["service-3.service.gov.uk"]
+
+
+def test_fan_out_crawl_in_process(crawler, fake_s3):
+    invokers = load_lambda_module("crawler-govuk-reference-content", "invokers")
+    organisations = [
+        govuk_organisation("dept", "2024-01-01T00:00:00.000+00:00"),
+        govuk_organisation("agency", "2024-01-01T00:00:00.000+00:00", ["dept"]),
+        govuk_organisation("body", "2024-01-01T00:00:00.000+00:00", ["agency"]),
+    ]
+    services = [govuk_service(n, f"2024-01-{n + 1:02d}T00:00:00Z") for n in range(5)]
+    service_responses = govuk_responses(services, [])
+
+    def get_url_dict(url):
+        if url.endswith("/api/organisations"):
+            return {"results": [dict(o) for o in organisations], "pages": 1}
+        return service_responses(url)
+
+    payloads = []
+
+    def handler(event, context):
+        payloads.append(event)
+        return crawler.lambda_handler(event, context)
+
+    with mock.patch.object(crawler, "get_url_dict", get_url_dict), mock.patch.object(
+        crawler, "invoker", invokers.InProcessInvoker(handler)
+    ), mock.patch.object(crawler, "fan_out_shard_size", 2):
+        crawler.lambda_handler({"fan_out": True}, None)
+
+    shards = sorted((p["fan_out_worker"]["kind"], p["fan_out_worker"]["shard"]) for p in payloads)
+    assert shards == [("organisations", 0), ("organisations", 1), ("services", 0), ("services", 1), ("services", 2)]
+
+    combined = fake_s3.store["govuk/objects/organisations-combined/organisations-full.json"].split(b"\n")
+    body = [json.loads(x) for x in combined if json.loads(x)["id"] == "cid-body"][0]
+    assert body["root_organisations"] == ["cid-dept"]
+    assert len(fake_s3.store["govuk/objects/services-combined/services-full.json"].split(b"\n")) == 5
+    assert b"service-4.service.gov.uk\t\tsvc-4" in fake_s3.store["govuk/objects/domain-index/domain-index.tsv"]
+
+
+def test_fan_out_splits_rate_and_keeps_reduce_time(crawler, fake_s3):
+    invokers = load_lambda_module("crawler-govuk-reference-content", "invokers")
+    services = [govuk_service(n, f"2024-01-{n + 1:02d}T00:00:00Z") for n in range(6)]
+    service_responses = govuk_responses(services, [])
+
+    def get_url_dict(url):
+        if url.endswith("/api/organisations"):
+            return {"results": [], "pages": 1}
+        return service_responses(url)
+
+    tasks = []
+
+    def handler(event, context):
+        tasks.append(event["fan_out_worker"])
+        return crawler.lambda_handler(event, context)
+
+    class SeparateInvoker(invokers.InProcessInvoker):
+        separate_containers = True
+
+    context = mock.Mock()
+    context.get_remaining_time_in_millis.return_value = 900_000
+    with mock.patch.object(crawler, "get_url_dict", get_url_dict), mock.patch.object(
+        crawler, "invoker", SeparateInvoker(handler)
+    ), mock.patch.object(crawler, "fan_out_shard_size", 2), mock.patch.object(
+        crawler, "fan_out_concurrency", 2
+    ), mock.patch.object(crawler, "fan_out_reduce_seconds", 100):
+        crawler.fan_out_crawl(context)
+        # each of the two workers at a time gets half the rate
+        assert [t["requests_per_second"] for t in tasks] == [crawler.govuk_requests_per_second / 2] * 3
+        assert all(t["deadline"] <= time.time() + 800 for t in tasks)
+
+        # with no time left beyond the reduce margin, nothing is invoked
+        tasks.clear()
+        context.get_remaining_time_in_millis.return_value = 100_000
+        res = crawler.fan_out_crawl(context)
+
+    assert tasks == []
+    assert res["failed_services"] == 6
+
+
+def test_fan_out_worker_uses_task_rate(crawler, fake_s3):
+    rates = []
+
+    def fetch_service(service):
+        rates.append(crawler.fetcher.limiter.requests_per_second)
+
+    task = {"run_id": "run", "kind": "services", "shard": 0, "entities": [{}], "requests_per_second": 2.5}
+    with mock.patch.object(crawler, "fetch_service", fetch_service):
+        crawler.run_fan_out_worker(task)
+
+    assert rates == [2.5]
+    # and put back for whatever this container runs next
+    assert crawler.fetcher.limiter.requests_per_second == crawler.govuk_requests_per_second
+
+
+def test_process_isolated_stops_at_deadline(crawler):
+    results, failed = crawler.process_isolated([1, 2, 3], lambda x: x, "test", deadline=0)
+    assert results == []
+    assert failed == [1, 2, 3]
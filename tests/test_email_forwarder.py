@@ -0,0 +1,519 @@
+import io
+import json
+import os
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+from tests import lambdas_path, load_lambda_module
+
+raw_email = (
+    b"Received-SPF: pass\r\n"
+    b"DKIM-Signature: v=1; a=rsa-sha256; d=example.gov.uk\r\n"
+    b"From: Sender <sender@example.gov.uk>\r\n"
+    b"To: contact@gc3.security.gov.uk\r\n"
+    b"Subject: Hello\r\n"
+    b"Message-ID: <abc@example.gov.uk>\r\n"
+    b"\r\n"
+    b"Body text\r\n"
+)
+
+
+@pytest.fixture(scope="module")
+def forwarder():
+    with mock.patch.dict(
+        os.environ,
+        values={
+            "AWS_DEFAULT_REGION": "eu-west-1",
+            "Region": "eu-west-1",
+            "MailS3Bucket": "mailbox.test",
+            "MailSenderDomain": "gc3.security.gov.uk",
+        },
+    ):
+        yield load_lambda_module("email-forwarder")
+
+
+@pytest.fixture(scope="module")
+def claims(forwarder):
+    return load_lambda_module("email-forwarder", "claims")
+
+
+def ses_event(message_id: str, recipients: list) -> dict:
+    return {
+        "Records": [
+            {
+                "eventSource": "aws:ses",
+                "ses": {
+                    "mail": {"messageId": message_id},
+                    "receipt": {"recipients": recipients},
+                },
+            }
+        ]
+    }
+
+
+@pytest.fixture
+def aws(forwarder, claims):
+    s3_client = mock.Mock()
+    s3_client.get_object.side_effect = lambda **kwargs: {"Body": io.BytesIO(raw_email)}
+    ses_client = mock.Mock()
+    ses_client.send_raw_email.return_value = {"MessageId": "sent-id"}
+    with mock.patch.object(forwarder, "client_s3", s3_client), mock.patch.object(
+        forwarder, "claim_store", claims.InMemoryClaimStore()
+    ), mock.patch.object(forwarder, "client_ses", ses_client), mock.patch.object(
+        forwarder, "send_scheduler", None
+    ), mock.patch.object(
+        forwarder.time, "sleep"
+    ):
+        yield s3_client, ses_client
+
+
+def test_lambda_handler_forwards_once(forwarder, aws):
+    s3_client, ses_client = aws
+    event = ses_event("message-1", ["Contact@gc3.security.gov.uk"])
+
+    forwarder.lambda_handler(event, None)
+    forwarder.lambda_handler(event, None)
+
+    assert ses_client.send_raw_email.call_count == 1
+    s3_client.put_object_tagging.assert_called_once()
+
+
+def test_lambda_handler_releases_claim_on_failure(forwarder, aws):
+    s3_client, ses_client = aws
+    s3_client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+    )
+    event = ses_event("message-2", ["contact@gc3.security.gov.uk"])
+
+    with pytest.raises(ClientError):
+        forwarder.lambda_handler(event, None)
+    assert s3_client.get_object.call_count == len(forwarder.s3_read_delays) + 1
+
+    s3_client.get_object.side_effect = lambda **kwargs: {"Body": io.BytesIO(raw_email)}
+    forwarder.lambda_handler(event, None)
+    assert ses_client.send_raw_email.call_count == 1
+
+
+def test_lambda_handler_fails_while_another_invocation_holds_the_claim(
+    forwarder, claims, aws
+):
+    s3_client, ses_client = aws
+    event = ses_event("message-3", ["contact@gc3.security.gov.uk"])
+    # e.g. an invocation that timed out, whose claim hasn't expired yet
+    forwarder.claim_store.claim("message-3")
+
+    # fail, so that SES retries it, rather than drop the email
+    with pytest.raises(claims.ClaimInProgress):
+        forwarder.lambda_handler(event, None)
+    ses_client.send_raw_email.assert_not_called()
+
+
+def test_ses_client_leaves_retries_to_the_scheduler(forwarder):
+    client = forwarder.client_ses._factory()
+    assert client.meta.config.retries["total_max_attempts"] == 1
+
+
+def test_in_memory_claim_store_expiry(claims):
+    now = [0]
+    store = claims.InMemoryClaimStore(ttl=10, clock=lambda: now[0])
+    assert store.claim("a") is True
+    with pytest.raises(claims.ClaimInProgress):
+        store.claim("a")
+    now[0] = 11
+    assert store.claim("a") is True
+    store.complete("a")
+    now[0] = 100
+    assert store.claim("a") is False
+
+
+def test_s3_claim_store_conditional_writes(claims):
+    s3_client = mock.Mock()
+    conflict = ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+    store = claims.S3ClaimStore(s3_client, "bucket", ttl=10, clock=lambda: 100)
+
+    assert store.claim("a") is True
+    assert s3_client.put_object.call_args.kwargs["IfNoneMatch"] == "*"
+
+    # an expired processing claim is taken over with If-Match on its ETag
+    s3_client.put_object.side_effect = [conflict, None]
+    s3_client.get_object.return_value = {
+        "Body": io.BytesIO(b'{"status": "processing", "expires_at": 50}'),
+        "ETag": '"etag"',
+    }
+    assert store.claim("a") is True
+    assert s3_client.put_object.call_args.kwargs["IfMatch"] == '"etag"'
+
+    s3_client.put_object.side_effect = [conflict]
+    s3_client.get_object.return_value = {
+        "Body": io.BytesIO(b'{"status": "processing", "expires_at": 105}'),
+        "ETag": '"etag"',
+    }
+    with pytest.raises(claims.ClaimInProgress):
+        store.claim("a")
+
+    s3_client.put_object.side_effect = [conflict]
+    s3_client.get_object.return_value = {
+        "Body": io.BytesIO(b'{"status": "done"}'),
+        "ETag": '"etag"',
+    }
+    assert store.claim("a") is False
+
+
+def test_lambda_handler_sends_once_per_target(forwarder, aws):
+    s3_client, ses_client = aws
+    event = ses_event(
+        "message-3",
+        [
+            "contact@gc3.security.gov.uk",
+            "security@gc3.security.gov.uk",
+            "im@gc3.security.gov.uk",
+        ],
+    )
+
+    with mock.patch.object(
+        forwarder.email, "message_from_bytes", wraps=forwarder.email.message_from_bytes
+    ) as parse:
+        forwarder.lambda_handler(event, None)
+        # not a send-as email, so only the headers are touched
+        assert parse.call_count == 0
+
+    sent = sorted(
+        c.kwargs["Destinations"][0] for c in ses_client.send_raw_email.call_args_list
+    )
+    assert sent == ["contact@gccc.zendesk.com", "im@gccc.zendesk.com"]
+    for c in ses_client.send_raw_email.call_args_list:
+        data = c.kwargs["RawMessage"]["Data"]
+        assert data.count(b"\nTo: ") == 1
+        assert b"DKIM-Signature" not in data
+        assert b"X-SES-Received-SPF: pass" in data
+
+
+def test_packaged_botocore_makes_conditional_writes(claims):
+    with open(os.path.join(lambdas_path, "email-forwarder", "requirements.txt")) as f:
+        pins = dict(line.strip().split("==") for line in f if "==" in line)
+    assert claims.version_tuple(pins["botocore"]) >= claims.min_botocore_version
+
+
+def test_lambda_handler_sqs_partial_batch(forwarder, aws):
+    s3_client, ses_client = aws
+
+    def get_object(Bucket, Key):
+        if Key == "bad":
+            raise ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+        return {"Body": io.BytesIO(raw_email)}
+
+    s3_client.get_object.side_effect = get_object
+
+    def sqs_record(sqs_id: str, message_id: str, via_sns: bool = False) -> dict:
+        body = json.dumps(
+            ses_event(message_id, ["im@gc3.security.gov.uk"])["Records"][0]["ses"]
+        )
+        if via_sns:
+            body = json.dumps({"Type": "Notification", "Message": body})
+        return {"eventSource": "aws:sqs", "messageId": sqs_id, "body": body}
+
+    event = {
+        "Records": [
+            sqs_record("sqs-1", "good-1"),
+            sqs_record("sqs-2", "bad"),
+            sqs_record("sqs-3", "good-2", via_sns=True),
+        ]
+    }
+    assert forwarder.lambda_handler(event, None) == {
+        "batchItemFailures": [{"itemIdentifier": "sqs-2"}]
+    }
+    assert ses_client.send_raw_email.call_count == 2
+
+
+def test_lambda_handler_oversized_email_sends_notice(forwarder, aws, capsys):
+    s3_client, ses_client = aws
+    attachment = b"A" * 100_000
+    body = io.BytesIO(raw_email + attachment)
+    body.close = mock.Mock()
+    s3_client.get_object.side_effect = lambda **kwargs: {
+        "Body": body,
+        "ContentLength": len(raw_email) + len(attachment),
+    }
+
+    with mock.patch.object(forwarder, "max_raw_message_bytes", 1024):
+        forwarder.lambda_handler(
+            ses_event("message-big", ["vm@gc3.security.gov.uk"]), None
+        )
+
+    # only the header block was read from the stream
+    assert body.tell() < len(raw_email) + len(attachment)
+    data = ses_client.send_raw_email.call_args.kwargs["RawMessage"]["Data"]
+    assert b"Subject: [Too large to forward] Hello" in data
+    assert b"s3://mailbox.test/message-big" in data
+    assert attachment not in data
+    assert ses_client.send_raw_email.call_args.kwargs["Destinations"] == [
+        "vm@gccc.zendesk.com"
+    ]
+    assert "AAAA" not in capsys.readouterr().out
+
+
+def test_read_header_block(forwarder):
+    assert (
+        forwarder.read_header_block(io.BytesIO(raw_email), chunk_size=8)
+        == raw_email[: raw_email.index(b"\r\n\r\n") + 4]
+    )
+
+
+@pytest.fixture(scope="module")
+def header_rewrite(forwarder):
+    return load_lambda_module("email-forwarder", "header_rewrite")
+
+
+multipart_email = (
+    b"Received-SPF: pass (spfCheck: domain of example.gov.uk)\r\n"
+    b"Authentication-Results: amazonses.com;\r\n"
+    b"\tspf=pass smtp.mailfrom=example.gov.uk;\r\n"
+    b"DKIM-Signature: v=1; a=rsa-sha256; d=example.gov.uk;\r\n"
+    b"  h=From:To:Subject; bh=abc=\r\n"
+    b"From: =?utf-8?q?S=C3=A9nder?= <sender@example.gov.uk>\r\n"
+    b"Return-Path: <bounce@example.gov.uk>\r\n"
+    b"To: report@gc3.security.gov.uk\r\n"
+    b"Subject: Incident\r\n"
+    b"MIME-Version: 1.0\r\n"
+    b'Content-Type: multipart/mixed; boundary="b1"\r\n'
+    b"\r\n"
+    b"--b1\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Transfer-Encoding: 8bit\r\n"
+    b"\r\n"
+    b"caf\xc3\xa9 \r\n"
+    b"--b1\r\n"
+    b"Content-Type: application/octet-stream\r\n"
+    b"Content-Transfer-Encoding: base64\r\n"
+    b"\r\n"
+    b"AAECAwQFBgcICQ==\r\n"
+    b"--b1--\r\n"
+)
+
+
+def test_rewrite_headers_keeps_body_identical(header_rewrite):
+    for raw in [multipart_email, multipart_email.replace(b"\r\n", b"\n")]:
+        _, body_offset, line_ending = header_rewrite.split_message(raw)
+        data = header_rewrite.rewrite_headers(
+            raw, "im@gc3.security.gov.uk", "gc3.security.gov.uk"
+        )
+
+        new_header_block, new_body_offset, _ = header_rewrite.split_message(data)
+        assert data[new_body_offset:] == raw[body_offset:]
+
+        names = [name for name, _ in header_rewrite.split_fields(new_header_block)]
+        assert names == [
+            "x-ses-received-spf",
+            "x-ses-authentication-results",
+            "subject",
+            "mime-version",
+            "content-type",
+            "from",
+            "reply-to",
+            "to",
+        ]
+        assert (
+            b"X-SES-Authentication-Results: amazonses.com;"
+            + line_ending
+            + b"\tspf=pass"
+            in data
+        )
+        assert b"From: im@gc3.security.gov.uk" + line_ending in data
+        assert (
+            b"Reply-To: =?utf-8?q?S=C3=A9nder?= <sender@example.gov.uk>" + line_ending
+            in data
+        )
+        assert b"To: im@gc3.security.gov.uk" + line_ending in data
+
+
+def test_rewrite_headers_matches_create_message(forwarder, header_rewrite):
+    import email
+
+    file_dict = {"file": multipart_email}
+    parsed = forwarder.create_message(
+        file_dict, "im@gccc.zendesk.com", "im@gc3.security.gov.uk"
+    )
+    fast = forwarder.create_forward_message(
+        file_dict, "im@gccc.zendesk.com", "im@gc3.security.gov.uk"
+    )
+    assert fast["Source"] == parsed["Source"]
+    assert fast["Destinations"] == parsed["Destinations"]
+
+    parsed_headers = email.message_from_bytes(parsed["Data"]).items()
+    fast_headers = email.message_from_bytes(fast["Data"]).items()
+    assert [(k, " ".join(v.split())) for k, v in fast_headers] == [
+        (k, " ".join(v.split())) for k, v in parsed_headers
+    ]
+    assert (
+        header_rewrite.rewrite_headers(b"Subject: no sender\r\n\r\nbody", "a@b", "b")
+        is None
+    )
+
+
+@pytest.fixture(scope="module")
+def routing(forwarder):
+    return load_lambda_module("email-forwarder", "routing")
+
+
+def test_default_routes_resolve_aliases(forwarder):
+    assert forwarder.get_forward_mappings("Security@gc3.security.gov.uk") == {
+        "system_email": "contact@gccc.zendesk.com",
+        "reply_from": "contact@gc3.security.gov.uk",
+    }
+    assert forwarder.get_forward_mappings("tm@gc3.security.gov.uk")["reply_from"] == (
+        "threat@gc3.security.gov.uk"
+    )
+    assert forwarder.get_forward_mappings("nobody@gc3.security.gov.uk") == {}
+    assert forwarder.group_destinations(
+        ["contact@gc3.security.gov.uk", "security@gc3.security.gov.uk"]
+    ) == {"contact@gccc.zendesk.com": "contact@gc3.security.gov.uk"}
+
+
+def test_routing_table_lookup_order(routing):
+    def target(name):
+        return {"system_email": f"{name}@zendesk.test", "reply_from": f"{name}@test"}
+
+    table = routing.RoutingTable.compile(
+        {
+            "routes": {
+                "contact": target("contact"),
+                "security": "contact",
+                "contact@staging.test": target("staging-contact"),
+                "*@staging.test": target("staging"),
+                "*": "contact",
+            },
+            "allowed_send_as_emails": ["Someone@Example.gov.uk"],
+        }
+    )
+
+    assert table.lookup("contact@staging.test") == target("staging-contact")
+    assert table.lookup("security@staging.test") == target("contact")
+    assert table.lookup("other@staging.test") == target("staging")
+    assert table.lookup("other@elsewhere.test") == target("contact")
+    assert table.is_send_as_allowed("someone@example.gov.uk")
+    assert not table.is_send_as_allowed(None)
+
+
+@pytest.mark.parametrize(
+    "routes",
+    [
+        {"a": "b", "b": "a"},
+        {"a": "missing"},
+        {"a": {"system_email": "not-an-email", "reply_from": "a@test"}},
+        {"a@*": {"system_email": "a@test", "reply_from": "a@test"}},
+    ],
+)
+def test_routing_table_rejects_invalid_config(routing, routes):
+    with pytest.raises(routing.RoutingConfigError):
+        routing.RoutingTable.compile({"routes": routes})
+
+
+@pytest.mark.parametrize("send_as", ["a@test", [None], [123], ["a@test", ["b@test"]], ["nobody"]])
+def test_routing_table_rejects_invalid_send_as(routing, send_as):
+    config = {"routes": {"*": {"system_email": "a@test", "reply_from": "b@test"}}}
+    with pytest.raises(routing.RoutingConfigError, match="allowed_send_as_emails"):
+        routing.RoutingTable.compile({**config, "allowed_send_as_emails": send_as})
+
+
+def test_routing_config_loader_caches_s3_config(routing):
+    config = {"routes": {"*": {"system_email": "a@test", "reply_from": "b@test"}}}
+    s3_client = mock.Mock()
+    s3_client.get_object.side_effect = lambda **kwargs: {
+        "Body": io.BytesIO(json.dumps(config).encode())
+    }
+    now = [0]
+    loader = routing.RoutingConfigLoader(
+        default_config={"routes": {}},
+        s3_uri="s3://config.test/routing.json",
+        s3_client=s3_client,
+        ttl=60,
+        clock=lambda: now[0],
+    )
+
+    assert loader.get().lookup("x@test")["system_email"] == "a@test"
+    now[0] = 30
+    loader.get()
+    assert s3_client.get_object.call_count == 1
+    s3_client.get_object.assert_called_with(Bucket="config.test", Key="routing.json")
+
+    # an invalid refresh keeps the last good table
+    config = {"routes": {"a": "missing"}}
+    now[0] = 61
+    assert loader.get().lookup("x@test")["system_email"] == "a@test"
+    assert s3_client.get_object.call_count == 2
+
+
+@pytest.fixture(scope="module")
+def send_scheduler(forwarder):
+    return load_lambda_module("email-forwarder", "send_scheduler")
+
+
+def ses_error(code: str, message: str = "error") -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": message}}, "SendRawEmail")
+
+
+def test_lambda_handler_retries_throttled_sends(forwarder, aws, capsys):
+    s3_client, ses_client = aws
+    ses_client.send_raw_email.side_effect = [
+        ses_error("Throttling", "Maximum sending rate exceeded."),
+        {"MessageId": "sent-id"},
+    ]
+
+    forwarder.lambda_handler(ses_event("message-6", ["im@gc3.security.gov.uk"]), None)
+
+    assert ses_client.send_raw_email.call_count == 2
+    s3_client.put_object_tagging.assert_called_once()
+    out = capsys.readouterr().out
+    assert '"EmailsSent": 1, "EmailsThrottled": 1, "EmailsFailed": 0' in out
+
+
+def test_lambda_handler_only_resends_failed_destinations(forwarder, aws):
+    s3_client, ses_client = aws
+
+    def send_raw_email(Source, Destinations, RawMessage):
+        if Destinations == ["im@gccc.zendesk.com"]:
+            raise ses_error("MessageRejected")
+        return {"MessageId": "sent-id"}
+
+    ses_client.send_raw_email.side_effect = send_raw_email
+    event = ses_event(
+        "message-7", ["contact@gc3.security.gov.uk", "im@gc3.security.gov.uk"]
+    )
+
+    with pytest.raises(forwarder.SendError):
+        forwarder.lambda_handler(event, None)
+    s3_client.put_object_tagging.assert_not_called()
+
+    ses_client.send_raw_email.reset_mock(side_effect=True)
+    forwarder.lambda_handler(event, None)
+
+    ses_client.send_raw_email.assert_called_once()
+    assert ses_client.send_raw_email.call_args.kwargs["Destinations"] == [
+        "im@gccc.zendesk.com"
+    ]
+    s3_client.put_object_tagging.assert_called_once()
+
+
+def test_send_scheduler_gives_up_on_daily_quota(send_scheduler):
+    client = mock.Mock()
+    client.send_raw_email.side_effect = ses_error(
+        "Throttling", "Daily message quota exceeded."
+    )
+    scheduler = send_scheduler.SendScheduler(lambda: client, sleep=mock.Mock())
+    message = {"Source": "a@test", "Destinations": ["b@test"], "Data": b""}
+
+    with pytest.raises(send_scheduler.SendError):
+        scheduler.send(message)
+    assert client.send_raw_email.call_count == 1
+    assert scheduler.stats == {"sent": 0, "throttled": 1, "failed": 1}
+
+
+def test_token_bucket_paces_bursts(send_scheduler):
+    now = [0]
+    bucket = send_scheduler.TokenBucket(rate=2, clock=lambda: now[0])
+
+    assert [bucket.reserve() for _ in range(4)] == [0, 0, 0.5, 1.0]
+    # the two delayed sends have used up what refilled since
+    now[0] = 1
+    assert bucket.reserve() == 0.5
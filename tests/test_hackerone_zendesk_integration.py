@@ -0,0 +1,796 @@
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import threading
+from unittest import mock
+
+import httpx
+import pytest
+from botocore.exceptions import ClientError
+from tests import load_lambda_module
+from zenpy.lib.api_objects import JobStatus
+
+lambda_dir = "hackerone-zendesk-integration"
+
+
+@pytest.fixture(scope="module")
+def integration():
+    with mock.patch.dict(
+        os.environ,
+        values={
+            "HACKERONE_API_USER": "h1-user",
+            "HACKERONE_API_PASS": "h1-pass",
+            "ZENDESK_API_EMAIL": "api@example.gov.uk",
+            "ZENDESK_API_KEY": "key",
+            "ZENDESK_SUBDOMAIN": "example",
+            "ZENDESK_EMAIL": "vm@example.gov.uk",
+        },
+    ):
+        yield load_lambda_module(lambda_dir)
+
+
+# the sibling modules as main imported them, so that patches reach the handler
+@pytest.fixture(scope="module")
+def hackerone(integration):
+    return integration.hackerone
+
+
+def h1_report(report_id: str = "123", **attributes) -> dict:
+    return {
+        "data": {
+            "id": report_id,
+            "type": "report",
+            "attributes": {
+                "title": " SQL injection ",
+                "vulnerability_information": "Details",
+                "state": "triaged",
+                "main_state": "open",
+                "created_at": "2024-05-01T10:00:00.000Z",
+                "triaged_at": "2024-05-02T10:00:00.000Z",
+                "last_activity_at": "2024-05-03T10:00:00.000Z",
+                "issue_tracker_reference_id": None,
+                "cve_ids": ["CVE-2024-0001"],
+                **attributes,
+            },
+            "relationships": {
+                "program": {"data": {"attributes": {"handle": "gc3"}}},
+                "severity": {"data": {"attributes": {"rating": "high"}}},
+            },
+        }
+    }
+
+
+@pytest.fixture
+def h1_api(hackerone):
+    """
+    Routes HackerOne API requests to handlers registered by path, through the
+    module's pooled client built on a mock transport.
+    """
+    handlers = {}
+    requests = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        handler = handlers[(request.method, request.url.path)]
+        return handler(request) if callable(handler) else handler.pop(0)
+
+    transport = httpx.MockTransport(handle)
+    with mock.patch.object(
+        hackerone, "client", hackerone.create_client(transport)
+    ), mock.patch.object(
+        hackerone, "async_client", hackerone.create_async_client(transport)
+    ), mock.patch.object(
+        hackerone.time, "sleep"
+    ):
+        yield handlers, requests
+    hackerone.endpoint_stats.clear()
+
+
+def test_get_hackerone_report_reuses_client_and_retries(hackerone, h1_api, capsys):
+    handlers, requests = h1_api
+    handlers[("GET", "/v1/reports/123")] = [
+        httpx.Response(429, headers={"Retry-After": "1"}),
+        httpx.Response(503),
+        httpx.Response(200, json=h1_report()),
+    ]
+
+    report = hackerone.get_hackerone_report("123")
+
+    assert report["title"] == "SQL injection"
+    assert report["state"] == "Triaged (Open)"
+    assert report["triaged_at"] == "2024-05-02"
+    assert report["program"] == "gc3"
+    assert len(requests) == 3
+    assert requests[0].headers["Authorization"] == "Basic aDEtdXNlcjpoMS1wYXNz"
+    hackerone.time.sleep.assert_any_call(1.0)
+
+    hackerone.log_endpoint_stats()
+    stats = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert stats["hackerone_api_stats"]["/reports/{id}"]["requests"] == 3
+    assert stats["hackerone_api_stats"]["/reports/{id}"]["retries"] == 2
+
+
+def test_retry_delay_is_clamped(hackerone):
+    response = httpx.Response(429, headers={"Retry-After": "3600"})
+    assert hackerone.retry_delay(0, response) == hackerone.retry_delay_max
+    assert hackerone.retry_delay(20) <= hackerone.retry_delay_max
+
+
+def test_request_gives_up_retrying_near_the_deadline(hackerone, h1_api):
+    handlers, requests = h1_api
+    handlers[("GET", "/v1/reports/123")] = lambda request: httpx.Response(
+        503, headers={"Retry-After": "5"}
+    )
+    context = mock.Mock()
+    # enough for one request, but not a wait and another request
+    context.get_remaining_time_in_millis.return_value = (
+        hackerone.deadline_margin + hackerone.hackerone_timeout + 1
+    ) * 1000
+
+    hackerone.set_deadline(context)
+    try:
+        assert hackerone.get_hackerone_report("123") is None
+    finally:
+        hackerone.set_deadline(None)
+
+    assert len(requests) == 1
+    hackerone.time.sleep.assert_not_called()
+
+
+def test_get_hackerone_report_gives_up(hackerone, h1_api):
+    handlers, requests = h1_api
+    handlers[("GET", "/v1/reports/404")] = lambda request: httpx.Response(404)
+    handlers[("GET", "/v1/reports/500")] = lambda request: httpx.Response(500)
+
+    assert hackerone.get_hackerone_report("404") is None
+    assert len(requests) == 1
+    assert hackerone.get_hackerone_report("500") is None
+    assert len(requests) == 2 + hackerone.hackerone_max_retries
+
+    # for reconciliation, only a report that's gone is None
+    assert hackerone.get_hackerone_report("404", raise_errors=True) is None
+    with pytest.raises(httpx.HTTPStatusError):
+        hackerone.get_hackerone_report("500", raise_errors=True)
+
+
+def test_set_hackerone_reference(hackerone, h1_api):
+    handlers, requests = h1_api
+    path = "/v1/reports/123/issue_tracker_reference_id"
+    handlers[("POST", path)] = lambda request: httpx.Response(200, json={})
+
+    hackerone.set_hackerone_reference(hackerone_id="123", zendesk_id=456)
+
+    body = json.loads(requests[0].content)
+    assert body["data"]["attributes"]["reference"] == "456"
+
+
+@pytest.fixture(scope="module")
+def zendesk(integration):
+    return integration.zendesk
+
+
+@pytest.fixture
+def zenpy(zendesk, tmp_path):
+    """
+    A fake Zenpy client holding tickets by id, with a fresh ticket map
+    backed by a temporary directory.
+    """
+    tickets = {}
+    client = mock.Mock()
+
+    def get_ticket(id):
+        if int(id) not in tickets:
+            raise zendesk.RecordNotFoundException("not found")
+        return tickets[int(id)]
+
+    def create_ticket(ticket):
+        ticket.id = 1000 + len(tickets)
+        tickets[ticket.id] = ticket
+        return mock.Mock(ticket=ticket)
+
+    client.tickets.side_effect = get_ticket
+    client.tickets.create.side_effect = create_ticket
+    client.search_export.return_value = []
+    ticket_map = zendesk.TicketMap(zendesk.LocalTicketMap(str(tmp_path)))
+    with mock.patch.object(zendesk, "zenpy_client", client), mock.patch.object(
+        zendesk, "ticket_map", ticket_map
+    ), mock.patch.dict(zendesk.update_stats, dict.fromkeys(zendesk.update_stats, 0)):
+        yield client, tickets
+
+
+def test_created_ticket_is_mapped_before_search(
+    hackerone, h1_api, zendesk, zenpy, tmp_path
+):
+    client, tickets = zenpy
+    handlers, _ = h1_api
+    handlers[("GET", "/v1/reports/123")] = lambda r: httpx.Response(
+        200, json=h1_report()
+    )
+    report = hackerone.get_hackerone_report("123")
+
+    zid = zendesk.create_or_update_zendesk_ticket(report)
+    assert client.search_export.call_count == 1
+    client.tickets.create.assert_called_once()
+
+    # a second event before Zendesk's search index catches up
+    assert zendesk.create_or_update_zendesk_ticket(report) == zid
+    assert client.search_export.call_count == 1
+    client.tickets.create.assert_called_once()
+
+    # and from the durable layer in a new execution environment
+    durable = zendesk.TicketMap(zendesk.LocalTicketMap(str(tmp_path)))
+    assert durable.get("123") == zid
+
+
+def test_missing_mapped_ticket_falls_back_to_search(zendesk, zenpy):
+    client, tickets = zenpy
+    found = zendesk.Ticket(id=77)
+    client.search_export.return_value = [found]
+    zendesk.get_ticket_map().put("123", 5)
+
+    assert zendesk.get_mapped_zendesk_ticket("123") is found
+    assert zendesk.get_ticket_map().get("123") == 77
+
+
+@pytest.mark.parametrize("store", ["ticket_map", "cursor"])
+def test_s3_stores_only_treat_no_such_key_as_missing(integration, zendesk, store):
+    s3_client = mock.Mock()
+    if store == "ticket_map":
+        durable = zendesk.S3TicketMap(s3_client, "bucket")
+        get = lambda: durable.get("123")
+    else:
+        durable = integration.reconcile.S3CursorStore(s3_client, "bucket")
+        get = durable.get
+
+    s3_client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+    )
+    assert get() is None
+
+    # what a missing key looks like without s3:ListBucket
+    s3_client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "GetObject"
+    )
+    with pytest.raises(ClientError):
+        get()
+
+
+@pytest.fixture(scope="module")
+def report_lock(integration):
+    return integration.report_lock
+
+
+def test_in_memory_lock_store_expiry(report_lock):
+    now = [0]
+    store = report_lock.InMemoryLockStore(clock=lambda: now[0])
+    assert store.acquire("a", "one", ttl=10) is True
+    assert store.acquire("a", "two", ttl=10) is False
+    assert store.acquire("b", "two", ttl=10) is True
+    store.release("a", "two")
+    assert store.acquire("a", "two", ttl=10) is False
+    now[0] = 11
+    assert store.acquire("a", "two", ttl=10) is True
+
+
+def test_s3_lock_store_conditional_writes(report_lock):
+    s3_client = mock.Mock()
+    s3_client.put_object.return_value = {"ETag": '"mine"'}
+    conflict = ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+    store = report_lock.S3LockStore(s3_client, "bucket", clock=lambda: 100)
+
+    assert store.acquire("a", "one", ttl=10) is True
+    assert s3_client.put_object.call_args.kwargs["IfNoneMatch"] == "*"
+    store.release("a", "one")
+    assert s3_client.delete_object.call_args.kwargs["IfMatch"] == '"mine"'
+
+    s3_client.put_object.side_effect = [conflict]
+    s3_client.get_object.return_value = {
+        "Body": io.BytesIO(b'{"owner": "two", "expires_at": 105}'),
+        "ETag": '"theirs"',
+    }
+    assert store.acquire("a", "one", ttl=10) is False
+
+    # an expired lease is taken over with If-Match on its ETag
+    s3_client.put_object.side_effect = [conflict, {"ETag": '"mine"'}]
+    s3_client.get_object.return_value = {
+        "Body": io.BytesIO(b'{"owner": "two", "expires_at": 50}'),
+        "ETag": '"theirs"',
+    }
+    assert store.acquire("a", "one", ttl=10) is True
+    assert s3_client.put_object.call_args.kwargs["IfMatch"] == '"theirs"'
+
+
+def test_hold_serialises_same_report_only(report_lock):
+    store = report_lock.InMemoryLockStore()
+    events = []
+    first_holding = threading.Event()
+    release_first = threading.Event()
+
+    def first():
+        with report_lock.hold(store, "report-1"):
+            events.append("first")
+            first_holding.set()
+            release_first.wait(5)
+        events.append("first released")
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    first_holding.wait(5)
+
+    with report_lock.hold(store, "report-2", wait=0):
+        events.append("other report")
+    with pytest.raises(report_lock.LockTimeout):
+        with report_lock.hold(store, "report-1", wait=0):
+            pass
+
+    release_first.set()
+    with report_lock.hold(store, "report-1", wait=5):
+        events.append("second")
+    thread.join()
+
+    assert events == ["first", "other report", "first released", "second"]
+
+
+def test_lambda_handler_does_not_sleep(integration, hackerone, h1_api, zenpy):
+    handlers, requests = h1_api
+    handlers[("GET", "/v1/reports/123")] = lambda r: httpx.Response(
+        200, json=h1_report(triaged_at=None)
+    )
+
+    with mock.patch.object(integration, "lock_store", None), mock.patch.object(
+        integration.report_lock.time, "sleep"
+    ) as sleep:
+        integration.lambda_handler({"report_id": "123"}, None)
+
+    sleep.assert_not_called()
+    assert len(requests) == 1
+
+
+def test_lock_store_fails_closed_in_lambda(integration, h1_api):
+    handlers, requests = h1_api
+
+    with mock.patch.object(integration, "lock_store", None), mock.patch.dict(
+        os.environ, {"AWS_LAMBDA_FUNCTION_NAME": "hackerone-zendesk-integration"}
+    ):
+        with pytest.raises(ValueError, match="REPORT_LOCK_BUCKET"):
+            integration.lambda_handler({"report_id": "123"}, None)
+
+    assert requests == []
+
+
+def test_cursor_store_fails_closed_in_lambda(integration, h1_api):
+    handlers, requests = h1_api
+    with mock.patch.object(
+        integration, "hackerone_program", "gc3"
+    ), mock.patch.dict(
+        os.environ, {"AWS_LAMBDA_FUNCTION_NAME": "hackerone-zendesk-integration"}
+    ):
+        with pytest.raises(ValueError, match="RECONCILE_CURSOR_BUCKET"):
+            integration.lambda_handler({"reconcile": True}, None)
+
+    assert requests == []
+
+
+def test_ticket_map_fails_closed_in_lambda(zendesk):
+    with mock.patch.object(zendesk, "ticket_map", None), mock.patch.dict(
+        os.environ, {"AWS_LAMBDA_FUNCTION_NAME": "hackerone-zendesk-integration"}
+    ):
+        with pytest.raises(ValueError, match="TICKET_MAP_BUCKET"):
+            zendesk.get_ticket_map()
+
+
+def test_unchanged_ticket_is_not_updated(hackerone, h1_api, zendesk, zenpy, capsys):
+    client, tickets = zenpy
+    handlers, _ = h1_api
+    handlers[("GET", "/v1/reports/123")] = lambda r: httpx.Response(
+        200, json=h1_report()
+    )
+    report = hackerone.get_hackerone_report("123")
+    zid = zendesk.create_or_update_zendesk_ticket(report)
+    assert client.tickets.update.call_count == 1
+
+    # as Zendesk returns it: plain dicts, strings, None for empty fields
+    tickets[zid] = zendesk.Ticket(
+        id=zid,
+        custom_fields=[
+            {"id": f.id, "value": zendesk.custom_field_value(f.value)}
+            for f in tickets[zid].custom_fields
+        ],
+    )
+    assert zendesk.create_or_update_zendesk_ticket(report) == zid
+    assert client.tickets.update.call_count == 1
+
+    report["state"] = "Resolved (Closed)"
+    zendesk.create_or_update_zendesk_ticket(report)
+    assert client.tickets.update.call_count == 2
+    updated = client.tickets.update.call_args.args[0]
+    assert [(f.id, f.value) for f in updated.custom_fields] == [
+        (13630456602001, "Resolved (Closed)")
+    ]
+
+    zendesk.log_update_stats()
+    stats = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert stats["TicketsUpdated"] == 2
+    assert stats["TicketUpdatesSkipped"] == 1
+    assert stats["FieldsUnchanged"] == 2 * 17 - 1
+
+
+def test_reconcile_applies_changes_in_bulk(integration, hackerone, h1_api, zendesk):
+    handlers, requests = h1_api
+    reconcile = integration.reconcile
+    reports = {
+        "1": h1_report("1", issue_tracker_reference_id="501", state="resolved"),
+        "2": h1_report("2"),
+        "3": h1_report("3", triaged_at=None),
+    }
+    listing = [
+        {"id": id, "attributes": {"last_activity_at": f"2024-06-0{id}T00:00:00Z"}}
+        for id in reports
+    ]
+    handlers[("GET", "/v1/reports")] = [
+        httpx.Response(
+            200,
+            json={
+                "data": listing[:2],
+                "links": {"next": "https://api.hackerone.com/v1/reports?page=2"},
+            },
+        ),
+        httpx.Response(200, json={"data": listing[2:], "links": {}}),
+    ]
+    for id, report in reports.items():
+        handlers[("GET", f"/v1/reports/{id}")] = lambda r, report=report: (
+            httpx.Response(200, json=report)
+        )
+    handlers[("POST", "/v1/reports/2/issue_tracker_reference_id")] = (
+        lambda r: httpx.Response(200, json={})
+    )
+
+    existing = zendesk.Ticket(
+        id=501,
+        custom_fields=[
+            {"id": f.id, "value": zendesk.custom_field_value(f.value)}
+            for f in zendesk.build_custom_fields(
+                hackerone.get_hackerone_report("1") | {"state": "Triaged (Open)"}
+            )
+        ],
+    )
+    client = mock.Mock()
+    client.tickets.side_effect = lambda ids: [existing] if 501 in ids else []
+    client.search_export.return_value = []
+    client.tickets.create.return_value = JobStatus(id="create", status="queued")
+    client.job_status.return_value = JobStatus(
+        id="create", status="completed", results=[{"index": 0, "id": 502}]
+    )
+    client.tickets.update.return_value = JobStatus(
+        id="update", status="completed", results=[]
+    )
+    cursor_store = mock.Mock()
+    cursor_store.get.return_value = "2024-05-01T00:00:00Z"
+    cursor_store.get_retries.return_value = {}
+
+    with mock.patch.object(zendesk, "zenpy_client", client), mock.patch.object(
+        zendesk, "ticket_map", zendesk.TicketMap()
+    ):
+        summary = reconcile.reconcile(cursor_store, "gc3", sleep=mock.Mock())
+        assert zendesk.get_ticket_map().get("2") == 502
+
+    assert summary == {
+        "listed": 3,
+        "retried": 0,
+        "created": 1,
+        "updated": 1,
+        "unchanged": 0,
+        "missing": 0,
+        "failed": 0,
+        "gave_up": 0,
+        "cursor_moved": True,
+    }
+    list_request = requests[1]
+    assert list_request.url.params["filter[program][]"] == "gc3"
+    assert list_request.url.params["filter[last_activity_at__gt]"] == (
+        "2024-05-01T00:00:00Z"
+    )
+    client.tickets.assert_called_once_with(ids=[501])
+    assert len(client.tickets.create.call_args.args[0]) == 1
+
+    # one bulk update: the changed field on 501 and the comment on 502
+    updated = {t.id: t for t in client.tickets.update.call_args.args[0]}
+    assert [(f.id, f.value) for f in updated[501].custom_fields] == [
+        (13630456602001, "Resolved (Open)")
+    ]
+    assert "Created automatically" in updated[502].comment.body
+    cursor_store.put.assert_called_once_with("2024-06-03T00:00:00Z")
+
+
+def test_reconcile_leases_reports_and_checkpoints(
+    integration, hackerone, h1_api, zendesk, report_lock
+):
+    handlers, requests = h1_api
+    reconcile = integration.reconcile
+    reports = {
+        "1": h1_report("1", issue_tracker_reference_id="501"),
+        "2": h1_report("2"),
+        "3": h1_report("3"),
+        "4": h1_report("4"),
+    }
+    listing = [
+        {"id": id, "attributes": {"last_activity_at": f"2024-06-0{id}T00:00:00Z"}}
+        for id in reports
+    ]
+    handlers[("GET", "/v1/reports")] = [
+        httpx.Response(200, json={"data": listing[::-1], "links": {}})
+    ]
+    for id, report in reports.items():
+        handlers[("GET", f"/v1/reports/{id}")] = lambda r, report=report: (
+            httpx.Response(200, json=report)
+        )
+    for id in ["2", "4"]:
+        handlers[("POST", f"/v1/reports/{id}/issue_tracker_reference_id")] = (
+            lambda r: httpx.Response(200, json={})
+        )
+
+    existing = zendesk.Ticket(
+        id=501,
+        custom_fields=[
+            {"id": f.id, "value": zendesk.custom_field_value(f.value)}
+            for f in zendesk.build_custom_fields(hackerone.get_hackerone_report("1"))
+        ],
+    )
+    client = mock.Mock()
+    client.tickets.side_effect = lambda ids: [existing] if 501 in ids else []
+    client.search_export.return_value = []
+    client.tickets.create.return_value = JobStatus(id="create", status="queued")
+    client.job_status.return_value = JobStatus(
+        id="create", status="completed", results=[{"index": 0, "id": 502}]
+    )
+    client.tickets.update.return_value = JobStatus(
+        id="update", status="completed", results=[]
+    )
+    cursor_store = mock.Mock()
+    cursor_store.get.return_value = None
+    cursor_store.get_retries.return_value = {}
+    # a webhook is syncing report 3
+    lock_store = report_lock.InMemoryLockStore()
+    assert lock_store.acquire(report_lock.report_key("3"), "webhook", 60)
+
+    with mock.patch.object(zendesk, "zenpy_client", client), mock.patch.object(
+        zendesk, "ticket_map", zendesk.TicketMap()
+    ), mock.patch.object(reconcile, "batch_size", 2):
+        summary = reconcile.reconcile(
+            cursor_store, "gc3", lock_store=lock_store, sleep=mock.Mock()
+        )
+
+    assert summary["created"] == 2
+    assert summary["failed"] == 1
+    # the first run only goes back as far as the lookback
+    list_request = [r for r in requests if r.url.path == "/v1/reports"][0]
+    after = list_request.url.params["filter[last_activity_at__gt]"]
+    assert after.endswith("Z") and after > "2024-06-04T00:00:00Z"
+    # one search for both unmapped reports in the second batch
+    assert client.search_export.call_args_list[-1] == mock.call(
+        type="ticket", custom_field_13630395133585=["3", "4"]
+    )
+    # 3 was left for the next run, 4 created without it
+    assert [
+        [zendesk.current_custom_fields(t)[13630395133585] for t in c.args[0]]
+        for c in client.tickets.create.call_args_list
+    ] == [["2"], ["4"]]
+    # the cursor is moved on after each batch, oldest first, once the locked
+    # report is stored to be retried
+    assert cursor_store.put.call_args_list == [
+        mock.call("2024-06-02T00:00:00Z"),
+        mock.call("2024-06-04T00:00:00Z"),
+    ]
+    cursor_store.put_retries.assert_called_once_with({"3": 1})
+    assert lock_store.acquire(report_lock.report_key("2"), "webhook", 60)
+
+
+def test_reconcile_retries_unfetched_reports(
+    integration, hackerone, h1_api, zendesk
+):
+    handlers, requests = h1_api
+    reconcile = integration.reconcile
+    report = h1_report("1", issue_tracker_reference_id="501")
+    listing = [
+        {"id": id, "attributes": {"last_activity_at": f"2024-06-0{id}T00:00:00Z"}}
+        for id in ["1", "2"]
+    ]
+    handlers[("GET", "/v1/reports")] = [
+        httpx.Response(200, json={"data": listing, "links": {}})
+    ]
+    handlers[("GET", "/v1/reports/1")] = lambda r: httpx.Response(200, json=report)
+    # still failing once the retries are used up
+    handlers[("GET", "/v1/reports/2")] = lambda r: httpx.Response(503)
+
+    existing = zendesk.Ticket(
+        id=501,
+        custom_fields=[
+            {"id": f.id, "value": zendesk.custom_field_value(f.value)}
+            for f in zendesk.build_custom_fields(hackerone.get_hackerone_report("1"))
+        ],
+    )
+    client = mock.Mock()
+    client.tickets.side_effect = lambda ids: [existing] if 501 in ids else []
+    cursor_store = mock.Mock()
+    cursor_store.get.return_value = "2024-05-01T00:00:00Z"
+    cursor_store.get_retries.return_value = {}
+
+    with mock.patch.object(zendesk, "zenpy_client", client), mock.patch.object(
+        zendesk, "ticket_map", zendesk.TicketMap()
+    ), mock.patch.object(reconcile, "batch_size", 1):
+        summary = reconcile.reconcile(cursor_store, "gc3", sleep=mock.Mock())
+
+        assert summary["unchanged"] == 1
+        assert summary["failed"] == 1
+        # stored to be retried before the cursor moved past it
+        assert cursor_store.method_calls[-2:] == [
+            mock.call.put_retries({"2": 1}),
+            mock.call.put("2024-06-02T00:00:00Z"),
+        ]
+
+        # retried by later runs though it's no longer listed, until it's used
+        # up its retries
+        handlers[("GET", "/v1/reports")] = [
+            httpx.Response(200, json={"data": [], "links": {}})
+        ]
+        cursor_store.reset_mock()
+        cursor_store.get.return_value = "2024-06-02T00:00:00Z"
+        cursor_store.get_retries.return_value = {
+            "2": reconcile.max_report_retries
+        }
+        summary = reconcile.reconcile(cursor_store, "gc3", sleep=mock.Mock())
+
+    assert requests[-1].url.path == "/v1/reports/2"
+    assert summary["retried"] == 1
+    assert summary["gave_up"] == 1
+    assert summary["cursor_moved"] is False
+    cursor_store.put_retries.assert_called_once_with({})
+    cursor_store.put.assert_not_called()
+
+
+def webhook_payload(report: dict) -> dict:
+    return {"data": {"activity": {"type": "activity-bug-triaged"}, "report": report}}
+
+
+def test_lambda_handler_uses_webhook_report(
+    integration, hackerone, h1_api, zendesk, zenpy
+):
+    handlers, requests = h1_api
+    client, tickets = zenpy
+    tickets[501] = zendesk.Ticket(id=501)
+    report = h1_report("123", issue_tracker_reference_id="501")["data"]
+
+    with mock.patch.object(
+        zendesk, "create_or_update_zendesk_ticket", return_value=501
+    ) as sync:
+        integration.lambda_handler(webhook_payload(report), None)
+
+    assert requests == []
+    synced = sync.call_args.args[0]
+    assert synced == hackerone.normalise_report("123", report)
+    assert synced["state"] == "Triaged (Open)"
+
+
+def test_lambda_handler_fetches_incomplete_webhook_report(
+    integration, hackerone, h1_api, zendesk, zenpy
+):
+    handlers, requests = h1_api
+    client, tickets = zenpy
+    tickets[501] = zendesk.Ticket(id=501)
+    report = h1_report("123", issue_tracker_reference_id="501")["data"]
+    handlers[("GET", "/v1/reports/123")] = lambda r: httpx.Response(
+        200, json={"data": report}
+    )
+    del report["relationships"]["severity"]
+    http_event = {
+        "body": base64.b64encode(json.dumps(webhook_payload(report)).encode()),
+        "isBase64Encoded": True,
+    }
+
+    with mock.patch.object(
+        zendesk, "create_or_update_zendesk_ticket", return_value=501
+    ) as sync:
+        integration.lambda_handler(http_event, None)
+
+    assert [r.url.path for r in requests] == ["/v1/reports/123"]
+    assert sync.call_args.args[0]["report_id"] == "123"
+
+
+def signed_http_event(payload: dict, secret: str = "webhook-secret") -> dict:
+    body = json.dumps(payload)
+    digest = hmac.new(secret.encode(), body.encode(), hashlib.sha256).hexdigest()
+    return {"headers": {"X-H1-Signature": f"sha256={digest}"}, "body": body}
+
+
+def test_lambda_handler_uses_signed_webhook_report(
+    integration, hackerone, h1_api, zendesk, zenpy
+):
+    handlers, requests = h1_api
+    client, tickets = zenpy
+    tickets[501] = zendesk.Ticket(id=501)
+    report = h1_report("123", issue_tracker_reference_id="501")["data"]
+
+    with mock.patch.object(
+        integration, "webhook_secret", "webhook-secret"
+    ), mock.patch.object(
+        zendesk, "create_or_update_zendesk_ticket", return_value=501
+    ) as sync:
+        integration.lambda_handler(signed_http_event(webhook_payload(report)), None)
+
+    assert requests == []
+    assert sync.call_args.args[0] == hackerone.normalise_report("123", report)
+
+
+def test_lambda_handler_rejects_tampered_webhook(integration, h1_api, zendesk, zenpy):
+    handlers, requests = h1_api
+    report = h1_report("123")["data"]
+    event = signed_http_event(webhook_payload(report))
+    event["body"] = event["body"].replace("triaged", "resolved")
+
+    with mock.patch.object(
+        integration, "webhook_secret", "webhook-secret"
+    ), mock.patch.object(zendesk, "create_or_update_zendesk_ticket") as sync:
+        res = integration.lambda_handler(event, None)
+
+    assert res == {"statusCode": 401}
+    assert requests == []
+    sync.assert_not_called()
+
+
+def test_lambda_handler_rejects_unsigned_webhook(integration, h1_api, zendesk, zenpy):
+    handlers, requests = h1_api
+    event = {"body": json.dumps(webhook_payload(h1_report("123")["data"]))}
+
+    with mock.patch.object(
+        integration, "webhook_secret", "webhook-secret"
+    ), mock.patch.object(zendesk, "create_or_update_zendesk_ticket") as sync:
+        res = integration.lambda_handler(event, None)
+
+    assert res == {"statusCode": 401}
+    sync.assert_not_called()
+
+
+def test_lambda_handler_refetches_unverifiable_webhook(
+    integration, hackerone, h1_api, zendesk, zenpy
+):
+    handlers, requests = h1_api
+    client, tickets = zenpy
+    tickets[501] = zendesk.Ticket(id=501)
+    report = h1_report("123", issue_tracker_reference_id="501")["data"]
+    handlers[("GET", "/v1/reports/123")] = lambda r: httpx.Response(
+        200, json={"data": report}
+    )
+    # no secret configured, so the body's own report can't be trusted
+    event = {"body": json.dumps(webhook_payload(dict(report, attributes={})))}
+
+    with mock.patch.object(
+        zendesk, "create_or_update_zendesk_ticket", return_value=501
+    ) as sync:
+        integration.lambda_handler(event, None)
+
+    assert [r.url.path for r in requests] == ["/v1/reports/123"]
+    assert sync.call_args.args[0] == hackerone.normalise_report("123", report)
+
+
+def test_async_sync_uses_mapped_ticket(integration, hackerone, h1_api, zendesk, zenpy):
+    handlers, requests = h1_api
+    client, tickets = zenpy
+    handlers[("GET", "/v1/reports/123")] = lambda r: httpx.Response(
+        200, json=h1_report()
+    )
+    handlers[("POST", "/v1/reports/123/issue_tracker_reference_id")] = (
+        lambda r: httpx.Response(200, json={})
+    )
+    tickets[600] = zendesk.Ticket(id=600, custom_fields=[])
+    zendesk.get_ticket_map().put("123", 600)
+
+    assert integration.async_sync.run("123") == 600
+
+    client.search_export.assert_not_called()
+    client.tickets.create.assert_not_called()
+    assert client.tickets.update.call_args.args[0].id == 600
+    reference = json.loads(requests[-1].content)
+    assert reference["data"]["attributes"]["reference"] == "600"
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+from benchmarks import bench_hot_paths
+
+# how much slower than its baseline, relative to the calibration workload, a
+# function can get before this fails; 1.0 is twice as slow
+tolerance = float(os.getenv("HOT_PATH_TOLERANCE", "1.0"))
+
+baseline = bench_hot_paths.load_baseline()
+
+
+@pytest.fixture(scope="module")
+def timings():
+    # shorter than the benchmark's defaults, which the tolerance allows for
+    return bench_hot_paths.measure(min_time=0.01, rounds=9)
+
+
+def test_every_hot_path_has_a_baseline(timings):
+    assert sorted(timings) == sorted(baseline)
+
+
+@pytest.mark.parametrize("name", sorted(baseline))
+def test_hot_path_timing(timings, name):
+    relative = timings[name]["relative"]
+    limit = baseline[name]["relative"] * (1 + tolerance)
+    assert relative <= limit, (
+        f"{name} costs {relative:.2f}x the calibration workload, its baseline is "
+        f"{baseline[name]['relative']:.2f}x; if that's expected, run "
+        "python -m benchmarks.bench_hot_paths --update-baseline"
+    )
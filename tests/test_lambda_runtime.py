@@ -0,0 +1,67 @@
+import json
+from unittest import mock
+
+import pytest
+
+import lambda_runtime
+
+
+def test_lazy_client_builds_once_on_first_use():
+    factory = mock.Mock(return_value=mock.Mock(name="client"))
+    client = lambda_runtime.lazy(factory, "test.client")
+
+    factory.assert_not_called()
+    client.get_object(Bucket="b", Key="k")
+    client.put_object(Bucket="b", Key="k")
+
+    factory.assert_called_once_with()
+    factory.return_value.get_object.assert_called_once_with(Bucket="b", Key="k")
+    assert "test.client" in lambda_runtime.timings
+
+
+def test_boto3_client_shared_per_arguments():
+    assert lambda_runtime.boto3_client("s3") is lambda_runtime.boto3_client("s3")
+    assert lambda_runtime.boto3_client("s3") is not lambda_runtime.boto3_client(
+        "s3", signature_version="s3v4"
+    )
+
+
+def test_boto3_client_not_built_until_used():
+    with mock.patch.dict(lambda_runtime.boto3_clients, clear=True):
+        client = lambda_runtime.boto3_client("athena", region_name="eu-west-2")
+        assert client._client is None
+
+
+@pytest.fixture
+def cold():
+    with mock.patch.object(lambda_runtime, "cold_start", True):
+        yield
+
+
+def test_report_cold_start_only_on_first_invocation(cold, capsys):
+    @lambda_runtime.report_cold_start
+    def handler(event, context):
+        return event
+
+    assert handler({"a": 1}, None) == {"a": 1}
+    assert handler({"a": 2}, None) == {"a": 2}
+
+    lines = [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+    assert len(lines) == 1
+    assert lines[0]["message"] == "Cold start"
+    assert set(lines[0]["cold_start"]) == {
+        "init_ms",
+        "first_invocation_ms",
+        "lazy_init_ms",
+    }
+
+
+def test_report_cold_start_when_handler_raises(cold, capsys):
+    @lambda_runtime.report_cold_start
+    def handler(event, context):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        handler({}, None)
+
+    assert "Cold start" in capsys.readouterr().out